@@ -0,0 +1,522 @@
+from __future__ import annotations
+
+from typing import Any, AsyncIterator, Callable, Optional, Sequence, Tuple, Union
+from collections import OrderedDict
+
+import asyncio
+
+from indice import Page
+from protocol import VERSION, AsyncFrameReader, Compression, Compressor, ReadChunks
+from protocol import Request, RequestInner, Response
+
+HOST = 'localhost'
+PORT = 5000
+
+class ReadCache:
+    """
+    As últimas `size` chaves lidas, invalidadas pelo servidor
+    (`Request.Track`).
+
+    Um aviso pode chegar antes da resposta de uma leitura que já foi
+    pedida; essas leituras ficam marcadas, e não são guardadas.
+    """
+    size: int
+    # Least recently used first
+    entries: OrderedDict[str, list[str]]
+    # Key -> reads of it waiting for a response
+    reading: dict[str, int]
+    # Keys invalidated while being read
+    stale: set[str]
+    hits: int
+    misses: int
+
+    def __init__(self, size: int) -> None:
+        assert size > 0
+        self.size = size
+        self.entries = OrderedDict()
+        self.reading = dict()
+        self.stale = set()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: str) -> Optional[list[str]]:
+        val_list: Optional[list[str]] = self.entries.get(key)
+        if val_list is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.entries.move_to_end(key)
+        return list(val_list)
+
+    def begin(self, key: str) -> None:
+        self.reading[key] = self.reading.get(key, 0) + 1
+
+    def end(self, key: str, val_list: Optional[list[str]]) -> None:
+        """
+        Sem `val_list`, a leitura falhou.
+        """
+        if val_list is not None and key not in self.stale:
+            self.entries[key] = list(val_list)
+            self.entries.move_to_end(key)
+            if len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+        count: int = self.reading[key] - 1
+        if count == 0:
+            del self.reading[key]
+            self.stale.discard(key)
+        else:
+            self.reading[key] = count
+
+    def invalidate(self, keys: Optional[list[str]]) -> None:
+        """
+        Sem `keys`, invalida tudo.
+        """
+        if keys is None:
+            self.entries.clear()
+            self.stale.update(self.reading)
+            return
+        for key in keys:
+            self.entries.pop(key, None)
+            if key in self.reading:
+                self.stale.add(key)
+
+# A piece of a streamed read, or why the connection failed
+Piece = Union[Response, Exception]
+
+class AsyncConnection:
+    """
+    Uma conexão com várias requisições em andamento ao mesmo tempo.
+    Cada requisição leva um id, e `receive` entrega cada resposta
+    para quem espera a requisição com o mesmo id. Os pedaços de uma
+    leitura (v2) são juntados numa resposta só, menos os de uma
+    `read_stream`, entregues um a um.
+    """
+    reader: AsyncFrameReader
+    writer: asyncio.StreamWriter
+    # Request id -> who waits for its response
+    waiting: dict[int, asyncio.Future[Response]]
+    # Request id -> pieces of a `read_stream` not taken yet (`None`
+    # once the stream is abandoned: the rest is dropped)
+    streams: dict[int, Optional[asyncio.Queue[Piece]]]
+    next_id: int
+    receiver: asyncio.Task[None]
+    error: Optional[Exception]
+    # Of the protocol, v1 until `open` negotiates it
+    version: int
+    # If `open` negotiated compression
+    compressor: Optional[Compressor]
+    # Called with the keys of each `Response.Invalidate`, and with
+    # `None` (everything) if the connection fails
+    on_invalidate: Optional[Callable[[Optional[list[str]]], None]]
+
+    def __init__(
+            self,
+            reader: asyncio.StreamReader,
+            writer: asyncio.StreamWriter,
+            on_invalidate: Optional[Callable[[Optional[list[str]]], None]] = None,
+            ) -> None:
+        self.reader = AsyncFrameReader(reader)
+        self.writer = writer
+        self.waiting = dict()
+        self.streams = dict()
+        self.next_id = 0
+        self.error = None
+        self.version = 1
+        self.compressor = None
+        self.on_invalidate = on_invalidate
+        self.receiver = asyncio.create_task(self.receive())
+
+    @staticmethod
+    async def open(
+            host: str = HOST,
+            port: int = PORT,
+            on_invalidate: Optional[Callable[[Optional[list[str]]], None]] = None,
+            compression: Sequence[Compression] = (),
+            ) -> AsyncConnection:
+        """
+        Combina a versão do protocolo e, com `compression`, o método de
+        compressão. Com `on_invalidate`, pede o `Request.Track` antes
+        de retornar.
+        """
+        reader, writer = await asyncio.open_connection(host, port)
+        conn: AsyncConnection = AsyncConnection(reader, writer, on_invalidate)
+        hello: Response = await conn.request(Request.Hello(version=VERSION))
+        assert isinstance(hello.inner, Response.Hello)
+        conn.version = hello.inner.version
+        if len(compression) > 0:
+            compress: Response = await conn.request(
+                Request.Compress(methods=list(compression)),
+            )
+            assert isinstance(compress.inner, Response.Compress)
+            if compress.inner.method != Compression.NONE:
+                conn.compressor = Compressor(compress.inner.method)
+        if on_invalidate is not None:
+            response: Response = await conn.request(Request.Track())
+            assert isinstance(response.inner, Response.Tracking)
+            if not response.inner.enabled:
+                conn.on_invalidate = None
+        return conn
+
+    def tracking(self) -> bool:
+        return self.on_invalidate is not None
+
+    def closed(self) -> bool:
+        return self.error is not None
+
+    def load(self) -> int:
+        return len(self.waiting) + len(self.streams)
+
+    def new_id(self) -> int:
+        if self.error is not None:
+            raise self.error
+        req_id: int = self.next_id
+        self.next_id = (self.next_id + 1) & 0xFFFFFFFF
+        return req_id
+
+    async def send(self, inner: RequestInner, req_id: int) -> None:
+        # Requests from concurrent calls are written back to back:
+        # they reach the server pipelined
+        self.writer.write(
+            Request(inner, req_id, self.version).encode(compressor=self.compressor)
+        )
+        try:
+            await self.writer.drain()
+        except ConnectionError as e:
+            self.fail(e)
+
+    async def request(self, inner: RequestInner) -> Response:
+        req_id: int = self.new_id()
+        future: asyncio.Future[Response] = \
+            asyncio.get_running_loop().create_future()
+        self.waiting[req_id] = future
+        await self.send(inner, req_id)
+        return await future
+
+    async def read_stream(self, key: str) -> AsyncIterator[list[str]]:
+        """
+        Os valores de `key` conforme chegam, um pedaço de cada vez
+        (na v1, num pedaço só). Os pedaços esperam numa fila até serem
+        pedidos, sem segurar as outras respostas da conexão.
+        """
+        req_id: int = self.new_id()
+        pieces: asyncio.Queue[Piece] = asyncio.Queue()
+        self.streams[req_id] = pieces
+        done: bool = False
+        try:
+            await self.send(Request.Read(key=key), req_id)
+            while not done:
+                piece: Piece = await pieces.get()
+                if isinstance(piece, Exception):
+                    raise piece
+                assert isinstance(piece.inner, Response.Read)
+                done = not piece.inner.more
+                yield piece.inner.val_list
+        finally:
+            if not done and req_id in self.streams:
+                self.streams[req_id] = None
+
+    async def receive(self) -> None:
+        chunks: ReadChunks = ReadChunks()
+        try:
+            while True:
+                response: Optional[Response] = \
+                    await Response.aread(self.reader)
+                if response is None:
+                    self.fail(ConnectionError('Connection closed'))
+                    return
+                if isinstance(response.inner, Response.Read) \
+                        and response.req_id in self.streams:
+                    assert response.req_id is not None
+                    pieces: Optional[asyncio.Queue[Piece]] = \
+                        self.streams[response.req_id]
+                    if not response.inner.more:
+                        del self.streams[response.req_id]
+                    if pieces is not None:
+                        pieces.put_nowait(response)
+                    continue
+                # Only a whole read goes to who waits for it
+                response = chunks.add(response)
+                if response is None:
+                    continue
+                if isinstance(response.inner, Response.Busy):
+                    self.fail(ConnectionRefusedError('Server busy'))
+                    return
+                if isinstance(response.inner, Response.Invalidate):
+                    if self.on_invalidate is not None:
+                        self.on_invalidate(response.inner.keys)
+                    continue
+                assert response.req_id is not None
+                future: Optional[asyncio.Future[Response]] = \
+                    self.waiting.pop(response.req_id, None)
+                if future is not None and not future.done():
+                    future.set_result(response)
+        except ConnectionError as e:
+            self.fail(e)
+
+    def fail(self, error: Exception) -> None:
+        """
+        Quem ainda espera uma resposta recebe `error`, e a conexão
+        não aceita mais requisições.
+        """
+        if self.error is None:
+            self.error = error
+            # Nothing read through this connection is tracked anymore
+            if self.on_invalidate is not None:
+                self.on_invalidate(None)
+        waiting: dict[int, asyncio.Future[Response]] = self.waiting
+        self.waiting = dict()
+        for future in waiting.values():
+            if not future.done():
+                future.set_exception(error)
+        streams: dict[int, Optional[asyncio.Queue[Piece]]] = self.streams
+        self.streams = dict()
+        for pieces in streams.values():
+            if pieces is not None:
+                pieces.put_nowait(error)
+        self.writer.close()
+
+    async def close(self) -> None:
+        self.fail(ConnectionError('Connection closed'))
+        self.receiver.cancel()
+        try:
+            await self.receiver
+        except asyncio.CancelledError:
+            pass
+        try:
+            await self.writer.wait_closed()
+        except ConnectionError:
+            pass
+
+class AsyncClient:
+    """
+    Cliente asyncio do protocolo HDD, para usar de dentro de serviços
+    assíncronos:
+
+        async with await AsyncClient.connect(host, port) as hdd:
+            await hdd.append(key, val)
+            vals = await hdd.read(key)
+            async for piece in hdd.read_stream(key):
+                ...
+
+    As chamadas concorrentes são divididas entre `connections` conexões
+    (vai para a que tem menos respostas pendentes). Uma conexão que cai
+    falha as chamadas pendentes com `ConnectionError` e é reaberta na
+    próxima chamada.
+
+    Com `cache_size`, as leituras passam por um `ReadCache` com as
+    últimas `cache_size` chaves lidas. Se o servidor não avisa das
+    mudanças (como o motor `processes`), o cache é desligado.
+
+    Com `compression`, cada conexão pede a compressão dos frames
+    grandes (`Request.Compress`).
+    """
+    host: str
+    port: int
+    conns: list[AsyncConnection]
+    lock: asyncio.Lock
+    cache: Optional[ReadCache]
+    compression: Sequence[Compression]
+
+    def __init__(
+            self,
+            host: str,
+            port: int,
+            conns: list[AsyncConnection],
+            cache: Optional[ReadCache] = None,
+            compression: Sequence[Compression] = (),
+            ) -> None:
+        assert len(conns) > 0
+        self.host = host
+        self.port = port
+        self.conns = conns
+        self.lock = asyncio.Lock()
+        self.cache = cache
+        self.compression = compression
+        if not all(conn.tracking() for conn in conns):
+            self.cache = None
+
+    @staticmethod
+    async def connect(
+            host: str = HOST,
+            port: int = PORT,
+            connections: int = 4,
+            cache_size: int = 0,
+            compression: Sequence[Compression] = (),
+            ) -> AsyncClient:
+        cache: Optional[ReadCache] = \
+            ReadCache(cache_size) if cache_size > 0 else None
+        on_invalidate: Optional[Callable[[Optional[list[str]]], None]] = \
+            cache.invalidate if cache is not None else None
+        conns: list[AsyncConnection] = list(await asyncio.gather(*(
+            AsyncConnection.open(host, port, on_invalidate, compression)
+            for _ in range(connections)
+        )))
+        return AsyncClient(host, port, conns, cache, compression)
+
+    async def __aenter__(self) -> AsyncClient:
+        return self
+
+    async def __aexit__(self, *args: Any) -> None:
+        await self.close()
+
+    async def close(self) -> None:
+        await asyncio.gather(*(conn.close() for conn in self.conns))
+
+    async def conn(self) -> AsyncConnection:
+        best: AsyncConnection = min(self.conns, key=AsyncConnection.load)
+        if not best.closed():
+            return best
+        async with self.lock:
+            for i, conn in enumerate(self.conns):
+                if conn.closed():
+                    await conn.close()
+                    self.conns[i] = await AsyncConnection.open(
+                        self.host, self.port,
+                        self.cache.invalidate if self.cache is not None else None,
+                        self.compression,
+                    )
+        return min(self.conns, key=AsyncConnection.load)
+
+    async def request(self, inner: RequestInner) -> Response:
+        conn: AsyncConnection = await self.conn()
+        response: Response = await conn.request(inner)
+        if isinstance(response.inner, Response.ReadOnly):
+            raise PermissionError('Read-only replica, write to the primary')
+        return response
+
+    async def read(self, key: str) -> list[str]:
+        """
+        Todos os valores de `key`: os pedaços da resposta (v2) são
+        juntados numa lista só. Para não ter a lista inteira na
+        memória, `read_stream`.
+        """
+        cache: Optional[ReadCache] = self.cache
+        if cache is None:
+            response: Response = await self.request(Request.Read(key=key))
+            assert isinstance(response.inner, Response.Read)
+            return response.inner.val_list
+        cached: Optional[list[str]] = cache.get(key)
+        if cached is not None:
+            return cached
+        val_list: Optional[list[str]] = None
+        cache.begin(key)
+        try:
+            response = await self.request(Request.Read(key=key))
+            assert isinstance(response.inner, Response.Read)
+            val_list = response.inner.val_list
+        finally:
+            cache.end(key, val_list)
+        return val_list
+
+    async def read_stream(self, key: str) -> AsyncIterator[list[str]]:
+        """
+        Os valores de `key` conforme chegam, um pedaço de cada vez (sem
+        passar pelo cache). Um consumidor mais lento que a rede acumula
+        os pedaços que ainda não pediu.
+        """
+        conn: AsyncConnection = await self.conn()
+        async for piece in conn.read_stream(key):
+            yield piece
+
+    async def read_range(
+            self,
+            key: str,
+            offset: int = 0,
+            limit: int = 100,
+            from_end: bool = False,
+            ) -> Tuple[int, int, list[str]]:
+        """
+        Até `limit` valores de `key` (sem passar pelo cache): a posição
+        do primeiro, quantos a chave tem no total, e os valores.
+        """
+        response: Response = await self.request(Request.ReadRange(
+            key=key, offset=offset, limit=limit, from_end=from_end,
+        ))
+        assert isinstance(response.inner, Response.ReadRange)
+        return (
+            response.inner.offset, response.inner.length,
+            response.inner.val_list,
+        )
+
+    async def length(self, key: str) -> int:
+        response: Response = await self.request(Request.Length(key=key))
+        assert isinstance(response.inner, Response.Length)
+        return response.inner.length
+
+    async def append(self, key: str, val: str) -> bool:
+        """
+        Retorna se `key` já existia.
+        """
+        response: Response = \
+            await self.request(Request.Append(key=key, val=val))
+        # Read-your-writes: the server's notice may still be on its way
+        if self.cache is not None:
+            self.cache.invalidate([key])
+        if isinstance(response.inner, Response.AppendExists):
+            return True
+        assert isinstance(response.inner, Response.AppendNotExists)
+        return False
+
+    async def read_many(self, keys: list[str]) -> list[list[str]]:
+        cache: Optional[ReadCache] = self.cache
+        if cache is None:
+            response: Response = await self.request(Request.MultiRead(keys=keys))
+            assert isinstance(response.inner, Response.MultiRead)
+            return [ val_list for _, val_list in response.inner.entries ]
+        found: dict[str, list[str]] = dict()
+        for key in keys:
+            cached: Optional[list[str]] = cache.get(key)
+            if cached is not None:
+                found[key] = cached
+        missing: list[str] = list(dict.fromkeys(
+            key for key in keys if key not in found
+        ))
+        if len(missing) > 0:
+            for key in missing:
+                cache.begin(key)
+            entries: dict[str, list[str]] = dict()
+            try:
+                response = await self.request(Request.MultiRead(keys=missing))
+                assert isinstance(response.inner, Response.MultiRead)
+                entries = dict(response.inner.entries)
+            finally:
+                for key in missing:
+                    cache.end(key, entries.get(key))
+            found.update(entries)
+        return [ list(found[key]) for key in keys ]
+
+    async def append_many(self, pairs: list[Tuple[str, str]]) -> list[bool]:
+        response: Response = \
+            await self.request(Request.MultiAppend(pairs=pairs))
+        if self.cache is not None:
+            self.cache.invalidate([ key for key, _ in pairs ])
+        assert isinstance(response.inner, Response.MultiAppend)
+        return response.inner.existed_before
+
+    async def scan(
+            self,
+            start: Optional[str] = None,
+            stop: Optional[str] = None,
+            cursor: Optional[str] = None,
+            limit: int = 100,
+            ) -> Page:
+        """
+        Uma página de chaves, em ordem, e o cursor da próxima.
+        """
+        response: Response = await self.request(Request.Scan(
+            start=start, stop=stop, cursor=cursor, limit=limit,
+        ))
+        assert isinstance(response.inner, Response.Keys)
+        return (response.inner.keys, response.inner.cursor)
+
+    async def prefix(
+            self,
+            prefix: str,
+            cursor: Optional[str] = None,
+            limit: int = 100,
+            ) -> Page:
+        response: Response = await self.request(Request.Prefix(
+            prefix=prefix, cursor=cursor, limit=limit,
+        ))
+        assert isinstance(response.inner, Response.Keys)
+        return (response.inner.keys, response.inner.cursor)
@@ -0,0 +1,215 @@
+from __future__ import annotations
+
+from typing import Any, Awaitable, Callable, Iterator, Optional, TextIO, Tuple
+from typing import Generic, TypeVar
+from dataclasses import dataclass
+
+import asyncio
+import sys
+
+from concorrencia import WouldBlock
+from disco import DiskDict
+from invalidacao import Tracker
+from protocol import BUF_SIZE, AsyncFrameReader, Compression, Compressor
+from protocol import ProtocolError, Request
+from server import HOST, Options, SharedDict
+from server import answer, close_shared, init, is_mutation, run_user
+
+T = TypeVar('T')
+
+def log(s: str) -> None:
+    print(s, file=sys.stderr)
+
+@dataclass()
+class AsyncServer(Generic[T]):
+    """
+    Alternativa ao `Server` com threads: todas as conexões são
+    atendidas por um único event loop.
+    """
+    host: str
+    port: int
+    shared_mut: T
+    on_start: Callable[[T], None]
+    on_stdin: Callable[[T, TextIO, TextIO], bool]
+    on_newconn: Callable[
+        [T, asyncio.StreamReader, asyncio.StreamWriter],
+        Awaitable[None]
+    ]
+    on_exit: Callable[[T], None]
+
+    def __enter__(self) -> AsyncServer[T]:
+        return self
+
+    def __exit__(self, *args: Any) -> None:
+        self.on_exit(self.shared_mut)
+
+    async def stdin_loop(self) -> None:
+        loop = asyncio.get_running_loop()
+        stop: bool = False
+        while not stop:
+            # `on_stdin` blocks while the admin types the arguments,
+            # so it runs outside of the event loop
+            stop = await loop.run_in_executor(
+                None,
+                self.on_stdin, self.shared_mut, sys.stdin, sys.stdout
+            )
+
+    async def serve(self) -> None:
+        conns: set[asyncio.Task[None]] = set()
+
+        async def on_conn(
+                reader: asyncio.StreamReader,
+                writer: asyncio.StreamWriter,
+                ) -> None:
+            task: Optional[asyncio.Task[None]] = asyncio.current_task()
+            assert task is not None
+            conns.add(task)
+            try:
+                await self.on_newconn(self.shared_mut, reader, writer)
+            except asyncio.CancelledError:
+                # Cancelled by `serve` on exit; a cancelled task here
+                # would be reported by asyncio as an error
+                pass
+            finally:
+                conns.discard(task)
+
+        server: asyncio.Server = await asyncio.start_server(
+            on_conn, self.host, self.port,
+        )
+        log(f"Running on port {self.port} (asyncio)...")
+        self.on_start(self.shared_mut)
+        async with server:
+            await self.stdin_loop()
+            log(f"Closing socket...")
+            server.close()
+            log(f"Closing connections...")
+            for task in list(conns):
+                task.cancel()
+            await asyncio.gather(*conns, return_exceptions=True)
+        log(f"Exiting...")
+
+    def run(self) -> None:
+        asyncio.run(self.serve())
+
+async def wait_durable(shared_mut: SharedDict, point: int) -> None:
+    if not shared_mut.process.is_durable(point):
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(
+            None, shared_mut.process.wait_durable, point,
+        )
+
+def blocks(shared_mut: SharedDict, request: Request) -> bool:
+    """
+    Se `answer` tem que rodar fora do event loop: as escritas podem
+    esperar as travas (e o `fsync`), e com o `DiskDict` uma leitura
+    pode ir ao disco. As outras leituras só esperariam uma trava, e
+    são tentadas no event loop sem esperar (`WouldBlock`).
+    """
+    return is_mutation(request) \
+        or isinstance(shared_mut.process.dic.dic, DiskDict)
+
+async def run_conn(
+        shared_mut: SharedDict,
+        stream_reader: asyncio.StreamReader,
+        writer: asyncio.StreamWriter,
+        ) -> None:
+    peer: Tuple[str, int] = writer.get_extra_info('peername')
+    addr: str = peer[0] + ' : ' + str(peer[1])
+    log(f"Client connected: {addr} ...")
+    reader: AsyncFrameReader = AsyncFrameReader(stream_reader)
+    out: bytearray = bytearray()
+    loop = asyncio.get_running_loop()
+    # Invalidations come from another thread, which waits for them
+    # to be sent
+    async def write(data: bytes) -> None:
+        writer.write(data)
+        await writer.drain()
+
+    def send(data: bytes) -> None:
+        asyncio.run_coroutine_threadsafe(write(data), loop).result()
+
+    def close() -> None:
+        # Without flushing what the client is not reading
+        try:
+            loop.call_soon_threadsafe(writer.transport.abort)
+        except RuntimeError:
+            # The event loop is closed, and the connection with it
+            pass
+
+    tracker: Tracker = Tracker(send, close)
+    # Set by a `Request.Compress`
+    compressor: Optional[Compressor] = None
+    durable_point: int = 0
+    try:
+        while True:
+            # Compressed frames only with the method negotiated here
+            accept: Optional[Compression] = \
+                None if compressor is None else compressor.method
+            request: Optional[Request] = \
+                reader.read_buffered(Request.parser(accept))
+            if request is None:
+                if len(out) > 0:
+                    await wait_durable(shared_mut, durable_point)
+                    writer.write(out)
+                    out = bytearray()
+                    await writer.drain()
+                    log(f"Response sent to {addr}")
+                request = await Request.aread(reader, accept)
+                if request is None:
+                    break
+            log(f"Received request from {addr}")
+            if request.packed is not None:
+                shared_mut.wire.received(*request.packed)
+            chunks: Optional[Iterator[bytearray]] = None
+            go_around: bool = blocks(shared_mut, request)
+            if not go_around:
+                try:
+                    chunks = answer(
+                        shared_mut, request, tracker, out, compressor,
+                        blocking = False,
+                    )
+                except WouldBlock:
+                    # A writer (or an admin `load`) holds the lock
+                    go_around = True
+            if go_around:
+                chunks = await loop.run_in_executor(
+                    None, answer, shared_mut, request, tracker, out, compressor,
+                )
+            if is_mutation(request):
+                durable_point = shared_mut.process.durable_point()
+            elif isinstance(request.inner, Request.Compress):
+                compressor = shared_mut.compressor(request.inner.methods)
+            for chunk in chunks or ():
+                if len(out) >= BUF_SIZE:
+                    await wait_durable(shared_mut, durable_point)
+                    writer.write(out)
+                    out = bytearray()
+                    await writer.drain()
+                out += chunk
+            if len(out) >= BUF_SIZE:
+                await wait_durable(shared_mut, durable_point)
+                writer.write(out)
+                out = bytearray()
+                await writer.drain()
+    except ConnectionError:
+        pass
+    except ProtocolError as e:
+        log(f"Protocol error from {addr}: {e}")
+    finally:
+        shared_mut.tracking.disable(tracker)
+        writer.close()
+    log(f"Client disconnected: {addr} ...")
+
+def create_async_server(
+        dict_file: str,
+        options: Options,
+        ) -> AsyncServer[SharedDict]:
+    shared_dict: SharedDict = SharedDict.from_file(dict_file, options)
+    return AsyncServer(
+        HOST, options.port,
+        shared_mut = shared_dict,
+        on_start = init,
+        on_stdin = run_user,
+        on_newconn = run_conn,
+        on_exit = close_shared,
+    )
@@ -0,0 +1,159 @@
+from typing import Tuple, cast
+
+import subprocess
+import argparse
+import tempfile
+import base64
+import random
+import socket
+import time
+import sys
+import os
+
+from bench_processes import wait_port
+from client import Connection
+from protocol import Compression, Request
+
+KINDS: list[str] = ['text', 'random']
+
+class CountedSocket:
+    """
+    Conta os bytes recebidos, para saber quanto passou pela rede.
+    """
+    sock: socket.socket
+    received: int
+
+    def __init__(self, sock: socket.socket) -> None:
+        self.sock = sock
+        self.received = 0
+
+    def recv_into(self, buf: memoryview) -> int:
+        n: int = self.sock.recv_into(buf)
+        self.received += n
+        return n
+
+    def sendall(self, data: bytes) -> None:
+        self.sock.sendall(data)
+
+    def close(self) -> None:
+        self.sock.close()
+
+def values(kind: str, size: int, rng: random.Random, count: int) -> list[str]:
+    """
+    `text` parece com registros de verdade (repete muito);
+    `random` não tem o que comprimir, além do base64.
+    """
+    vals: list[str] = []
+    for i in range(count):
+        if kind == 'text':
+            val: str = (f'{{"user": {rng.randrange(10**6)}, "status": '
+                f'"{rng.choice(["active", "idle", "away"])}", '
+                f'"region": "sa-east-1", "seq": {i}}}')
+        else:
+            val = base64.b64encode(rng.randbytes(size)).decode()
+        vals.append(val.ljust(size)[:size])
+    return vals
+
+def measure(
+        port: int,
+        method: Compression,
+        key: str,
+        reads: int,
+        ) -> Tuple[float, float]:
+    """
+    Segundos e bytes recebidos por leitura de `key`.
+    """
+    counted: CountedSocket = \
+        CountedSocket(socket.create_connection(('localhost', port)))
+    sock: socket.socket = cast(socket.socket, counted)
+    conn: Connection = Connection.of(sock).negotiate(
+        [] if method == Compression.NONE else [method],
+    )
+    assert conn.compressor is None or conn.compressor.method == method
+    conn.request(Request.Read(key=key))
+    counted.received = 0
+    start: float = time.perf_counter()
+    for _ in range(reads):
+        conn.request(Request.Read(key=key))
+    end: float = time.perf_counter()
+    conn.close()
+    return ((end - start) / reads, counted.received / reads)
+
+def main() -> int:
+    parser = argparse.ArgumentParser(
+        description='Bytes on the wire and time per read, with and without '
+            'compression, and the time it would take over slower links',
+    )
+    parser.add_argument('--port', type=int, default=5100)
+    parser.add_argument('--sizes', default='256,4096,65536',
+        help='comma-separated bytes of values per read response')
+    parser.add_argument('--value-size', type=int, default=64,
+        help='bytes per value')
+    parser.add_argument('--reads', type=int, default=200,
+        help='reads per measure')
+    parser.add_argument('--threshold', type=int, default=1024,
+        help='--compress-threshold of the server')
+    parser.add_argument('--links', default='10,100,1000',
+        help='comma-separated link speeds, in Mbit/s, to estimate the '
+            'time of a read over them (wire bytes / speed, plus the local time)')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    sizes: list[int] = [ int(s) for s in args.sizes.split(',') ]
+    links: list[float] = [ float(l) for l in args.links.split(',') ]
+    rng: random.Random = random.Random(args.seed)
+    with tempfile.TemporaryDirectory() as tmp:
+        server: subprocess.Popen[bytes] = subprocess.Popen(
+            [ sys.executable, 'server.py', '--port', str(args.port),
+                '--dict-file', os.path.join(tmp, 'bench.json'),
+                '--compression', 'zlib,lzma',
+                '--compress-threshold', str(args.threshold) ],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+        )
+        try:
+            wait_port(args.port)
+            conn: Connection = Connection.connect('localhost', args.port)
+            for kind in KINDS:
+                for size in sizes:
+                    count: int = max(1, size // args.value_size)
+                    conn.pipeline([
+                        Request.Append(key=f'{kind} {size}', val=val)
+                        for val in values(kind, args.value_size, rng, count)
+                    ])
+            conn.close()
+
+            print(f"{args.reads} reads each, threshold {args.threshold} bytes")
+            print(f"{'values':<7} {'bytes':>6} {'method':<6} {'wire':>7} "
+                f"{'ratio':>6} {'local':>8}"
+                + ''.join( f" {f'{link:g} Mb/s':>10}" for link in links ))
+            for kind in KINDS:
+                for size in sizes:
+                    base: float = 0.0
+                    for method in Compression:
+                        seconds, wire = measure(
+                            args.port, method, f'{kind} {size}', args.reads,
+                        )
+                        if method == Compression.NONE:
+                            base = wire
+                        over: list[float] = [
+                            seconds + wire * 8 / (link * 10**6)
+                            for link in links
+                        ]
+                        print(f"{kind:<7} {size:>6} {method.name.lower():<6} "
+                            f"{wire:>7.0f} {wire / base:>6.0%} "
+                            f"{seconds * 10**6:>6.0f}us"
+                            + ''.join(
+                                f" {t * 10**3:>8.3f}ms" for t in over
+                            ))
+                        sys.stdout.flush()
+        finally:
+            assert server.stdin is not None
+            server.stdin.close()
+            server.wait()
+    return 0
+
+if __name__ == '__main__':
+    retcode: int = main()
+    sys.exit(retcode)
@@ -0,0 +1,151 @@
+from typing import Any, ContextManager, Iterable, Tuple
+
+import argparse
+import threading
+import random
+import socket
+import time
+import sys
+
+import server
+from concorrencia import KeyLocks
+from dicionario import Dicionario
+from processamento import Process
+from protocol import FrameReader, Request, RequestInner, Response
+from server import SharedDict, run_thread
+
+class GlobalGuard:
+    lock: threading.Lock
+
+    def __init__(self, lock: threading.Lock) -> None:
+        self.lock = lock
+
+    def __enter__(self) -> None:
+        self.lock.acquire()
+
+    def __exit__(self, *args: Any) -> None:
+        self.lock.release()
+
+class GlobalLock(KeyLocks):
+    """
+    Uma única trava para tudo, como era antes de `KeyLocks`.
+    Mantida aqui só para comparação.
+    """
+    guard: GlobalGuard
+
+    def __init__(self) -> None:
+        super().__init__(stripes=1)
+        self.guard = GlobalGuard(threading.Lock())
+
+    # Only measured with the threaded engine, which always blocks
+    def read(self, key: str, blocking: bool = True) -> ContextManager[None]:
+        return self.guard
+
+    def write(self, key: str) -> ContextManager[None]:
+        return self.guard
+
+    def read_many(
+            self,
+            keys: Iterable[str],
+            blocking: bool = True,
+            ) -> ContextManager[None]:
+        return self.guard
+
+    def write_many(self, keys: Iterable[str]) -> ContextManager[None]:
+        return self.guard
+
+    def exclusive(self) -> ContextManager[None]:
+        return self.guard
+
+def client(
+        sock: socket.socket,
+        requests: list[RequestInner],
+        ) -> None:
+    reader: FrameReader = FrameReader(sock)
+    for inner in requests:
+        Request(inner).write(sock)
+        response = Response.read(reader)
+        assert response is not None
+    sock.close()
+
+def make_requests(
+        rng: random.Random,
+        count: int,
+        keys: int,
+        read_ratio: float,
+        ) -> list[RequestInner]:
+    requests: list[RequestInner] = []
+    for i in range(count):
+        key: str = f'key {rng.randrange(keys)}'
+        if rng.random() < read_ratio:
+            requests.append(Request.Read(key=key))
+        else:
+            requests.append(Request.Append(key=key, val=f'value {i}'))
+    return requests
+
+def bench(
+        locks: KeyLocks,
+        args: argparse.Namespace,
+        ) -> float:
+    shared: SharedDict = SharedDict(
+        Process(dic=Dicionario(), filename='/dev/null'),
+        locks,
+    )
+    rng: random.Random = random.Random(args.seed)
+    # Keep the values lists short enough for a READ response
+    for k in range(args.keys):
+        shared.process.append(f'key {k}', 'value')
+    threads: list[threading.Thread] = []
+    for c in range(args.clients):
+        requests = make_requests(
+            rng, args.requests, args.keys, args.read_ratio,
+        )
+        a, b = socket.socketpair()
+        threads.append(threading.Thread(
+            target=run_thread,
+            args=(shared, (b, ('client', c))),
+        ))
+        threads.append(threading.Thread(
+            target=client,
+            args=(a, requests),
+        ))
+    start: float = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    end: float = time.perf_counter()
+    clients: int = args.clients
+    requests_per_client: int = args.requests
+    return clients * requests_per_client / (end - start)
+
+def main() -> int:
+    parser = argparse.ArgumentParser(
+        description='Many client threads against run_thread',
+    )
+    parser.add_argument('--clients', type=int, default=32)
+    parser.add_argument('--requests', type=int, default=2000,
+        help='requests per client')
+    parser.add_argument('--keys', type=int, default=10000)
+    parser.add_argument('--read-ratio', type=float, default=0.9)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    # The per-request logging would dominate the measurement
+    server.log = lambda s: None
+
+    cases: list[Tuple[str, KeyLocks]] = [
+        ('global lock', GlobalLock()),
+        ('rw, 1 stripe', KeyLocks(stripes=1)),
+        ('rw, 64 stripes', KeyLocks(stripes=64)),
+    ]
+    print(f"{args.clients} clients x {args.requests} requests, "
+        f"{args.keys} keys, {args.read_ratio:.0%} reads")
+    for name, locks in cases:
+        rate: float = bench(locks, args)
+        print(f"{name:<16} {rate:>10.0f} req/s")
+    return 0
+
+if __name__ == '__main__':
+    retcode: int = main()
+    sys.exit(retcode)
@@ -0,0 +1,90 @@
+from typing import Callable
+from dataclasses import dataclass
+
+import threading
+import socket
+import time
+import sys
+
+from protocol import MAGIC, RespAction, Response
+
+ROUNDS = 2000
+
+class PerField:
+    """
+    Caminho antigo: um `sock.send` por campo do frame.
+    Mantido aqui só para comparação.
+    """
+    @staticmethod
+    def write_one_str_utf8(sock: socket.socket, s: str) -> None:
+        data: bytes = s.encode('utf-8')
+        sock.send((len(data) - 1).to_bytes(1, 'big'))
+        sock.send(data)
+
+    @staticmethod
+    def write_read(sock: socket.socket, resp: Response.Read) -> None:
+        sock.send(MAGIC)
+        sock.send(RespAction.READ.to_byte())
+        PerField.write_one_str_utf8(sock, resp.key)
+        sock.send(len(resp.val_list).to_bytes(1, 'big'))
+        for val in resp.val_list:
+            PerField.write_one_str_utf8(sock, val)
+
+@dataclass(frozen=True, kw_only=True)
+class Case:
+    name: str
+    resp: Response.Read
+
+def drain(sock: socket.socket, total: int) -> None:
+    buf: bytearray = bytearray(64 * 1024)
+    got: int = 0
+    while got < total:
+        n: int = sock.recv_into(buf)
+        if n == 0:
+            break
+        got += n
+
+def bench(
+        case: Case,
+        write: Callable[[socket.socket, Response.Read], None],
+        ) -> float:
+    frame_len: int = len(Response(case.resp).encode())
+    a, b = socket.socketpair()
+    with a, b:
+        drainer: threading.Thread = threading.Thread(
+            target=drain,
+            args=(b, frame_len * ROUNDS),
+        )
+        drainer.start()
+        start: float = time.perf_counter()
+        for _ in range(ROUNDS):
+            write(a, case.resp)
+        drainer.join()
+        end: float = time.perf_counter()
+    return (end - start) / ROUNDS
+
+def single_buffer(sock: socket.socket, resp: Response.Read) -> None:
+    Response(resp).write(sock)
+
+def main() -> int:
+    cases: list[Case] = [
+        Case(name='1 value', resp=Response.Read(
+            key='key', val_list=['value'],
+        )),
+        Case(name='16 values', resp=Response.Read(
+            key='key', val_list=[f'value {i}' for i in range(16)],
+        )),
+        Case(name='255 values', resp=Response.Read(
+            key='key', val_list=[f'value {i}' * 8 for i in range(255)],
+        )),
+    ]
+    print(f"{'case':<12} {'per-field (us)':>15} {'single (us)':>12} {'speedup':>8}")
+    for case in cases:
+        old: float = bench(case, PerField.write_read)
+        new: float = bench(case, single_buffer)
+        print(f"{case.name:<12} {old * 1e6:>15.2f} {new * 1e6:>12.2f} {old / new:>7.1f}x")
+    return 0
+
+if __name__ == '__main__':
+    retcode: int = main()
+    sys.exit(retcode)
@@ -0,0 +1,392 @@
+from __future__ import annotations
+
+from typing import Any, Optional, Tuple
+from array import array
+from bisect import bisect
+from itertools import accumulate
+
+import multiprocessing
+import multiprocessing.connection
+import multiprocessing.synchronize
+import subprocess
+import threading
+import argparse
+import tempfile
+import platform
+import random
+import math
+import shlex
+import json
+import time
+import sys
+import os
+
+from bench_processes import wait_port
+from client import Connection
+from protocol import Request, RequestInner, Response
+
+DISTRIBUTIONS: list[str] = ['uniform', 'zipfian']
+PERCENTILES: list[Tuple[str, float]] = [
+    ('p50', 0.50), ('p90', 0.90), ('p99', 0.99), ('p999', 0.999),
+]
+
+class KeyChooser:
+    """
+    Sorteia as keys: todas com a mesma chance (`uniform`), ou a de
+    posição `i` com chance proporcional a `1 / (i + 1) ** s`
+    (`zipfian`), com umas poucas keys quentes, como num cache de verdade.
+    """
+    keys: int
+    # Zipfian only: accumulated weights, searched with a random number
+    cumulative: Optional[list[float]]
+
+    def __init__(self, keys: int, distribution: str, s: float) -> None:
+        assert keys > 0
+        self.keys = keys
+        self.cumulative = None
+        if distribution == 'zipfian':
+            self.cumulative = list(accumulate(
+                1 / (i + 1) ** s for i in range(keys)
+            ))
+
+    def choose(self, rng: random.Random) -> str:
+        i: int
+        if self.cumulative is None:
+            i = rng.randrange(self.keys)
+        else:
+            i = bisect(self.cumulative, rng.random() * self.cumulative[-1])
+            i = min(i, self.keys - 1)
+        return f'key {i}'
+
+def value_sizes(arg: str) -> Tuple[int, int]:
+    """
+    `N` ou `MIN-MAX` (sorteado entre os dois, inclusive).
+    """
+    low, _, high = arg.partition('-')
+    sizes: Tuple[int, int] = (int(low), int(high or low))
+    if not 1 <= sizes[0] <= sizes[1]:
+        raise argparse.ArgumentTypeError(f"invalid value size: '{arg}'")
+    return sizes
+
+def make_workload(
+        rng: random.Random,
+        chooser: KeyChooser,
+        args: argparse.Namespace,
+        ) -> list[RequestInner]:
+    """
+    As requisições de uma conexão, sorteadas antes de começar a medir.
+    """
+    low, high = args.value_size
+    requests: list[RequestInner] = []
+    for i in range(args.requests):
+        key: str = chooser.choose(rng)
+        if rng.random() < args.read_ratio:
+            requests.append(Request.Read(key=key))
+        else:
+            size: int = rng.randint(low, high)
+            requests.append(Request.Append(
+                key = key,
+                val = rng.randbytes((size + 1) // 2).hex()[:size],
+            ))
+    return requests
+
+class Latencies:
+    """
+    Os tempos, em segundos, das requisições de uma conexão.
+    """
+    reads: array[float]
+    appends: array[float]
+    errors: int
+
+    def __init__(self) -> None:
+        self.reads = array('d')
+        self.appends = array('d')
+        self.errors = 0
+
+def drive(
+        address: Tuple[str, int],
+        requests: list[RequestInner],
+        depth: int,
+        latencies: Latencies,
+        ) -> None:
+    """
+    Uma conexão em malha fechada: envia `depth` requisições de uma vez
+    e espera as respostas antes das próximas. Cada requisição conta o
+    tempo do seu lote inteiro.
+    Conecta já medindo: com `--workers`, uma conexão na fila espera
+    uma thread livre, como um cliente de verdade.
+    """
+    try:
+        conn: Connection = Connection.connect(*address)
+    except OSError:
+        # Refused, or busy
+        latencies.errors = len(requests)
+        return
+    try:
+        for i in range(0, len(requests), depth):
+            batch: list[RequestInner] = requests[i : i + depth]
+            start: float = time.perf_counter()
+            responses: list[Optional[Response]] = \
+                [ conn.request(batch[0]) ] if depth == 1 \
+                else list(conn.pipeline(batch))
+            elapsed: float = time.perf_counter() - start
+            for inner, response in zip(batch, responses):
+                if response is None or isinstance(
+                        response.inner, (Response.Busy, Response.ReadOnly)):
+                    latencies.errors += 1
+                elif isinstance(inner, Request.Read):
+                    latencies.reads.append(elapsed)
+                else:
+                    latencies.appends.append(elapsed)
+    except (ConnectionError, AssertionError):
+        # The rest of the requests never got an answer
+        latencies.errors = len(requests) - len(latencies.reads) \
+            - len(latencies.appends)
+    finally:
+        conn.close()
+
+def client_process(
+        index: int,
+        procs: int,
+        args: argparse.Namespace,
+        barrier: multiprocessing.synchronize.Barrier,
+        out: multiprocessing.connection.Connection,
+        ) -> None:
+    """
+    Corpo de um processo cliente, com uma thread por conexão (as
+    conexões `index`, `index + procs`, ...). Todos os processos começam
+    juntos, depois de sortear as requisições.
+    """
+    chooser: KeyChooser = KeyChooser(args.keys, args.distribution, args.zipf_s)
+    conn_ids: list[int] = list(range(index, args.connections, procs))
+    workloads: list[list[RequestInner]] = [
+        make_workload(random.Random(f'{args.seed}:{c}'), chooser, args)
+        for c in conn_ids
+    ]
+    results: list[Latencies] = [ Latencies() for _ in conn_ids ]
+    threads: list[threading.Thread] = [
+        threading.Thread(
+            target=drive, args=(args.address, workload, args.depth, result),
+        )
+        for workload, result in zip(workloads, results)
+    ]
+    barrier.wait()
+    start: float = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    end: float = time.perf_counter()
+    reads: array[float] = array('d')
+    appends: array[float] = array('d')
+    for result in results:
+        reads.extend(result.reads)
+        appends.extend(result.appends)
+    out.send((
+        start, end, reads.tobytes(), appends.tobytes(),
+        sum( result.errors for result in results ),
+    ))
+    out.close()
+
+def summary(samples: list[float]) -> dict[str, Any]:
+    """
+    Em milissegundos; os percentis pelo posto mais próximo.
+    """
+    if len(samples) == 0:
+        return { 'count': 0 }
+    ordered: list[float] = sorted(samples)
+    stats: dict[str, Any] = {
+        'count': len(ordered),
+        'mean': sum(ordered) / len(ordered) * 1000,
+    }
+    for name, fraction in PERCENTILES:
+        rank: int = max(1, math.ceil(fraction * len(ordered)))
+        stats[name] = ordered[rank - 1] * 1000
+    stats['max'] = ordered[-1] * 1000
+    return stats
+
+def preload(host: str, port: int, args: argparse.Namespace) -> None:
+    """
+    `--preload` valores em cada key, para as leituras acharem algo.
+    """
+    rng: random.Random = random.Random(f'{args.seed}:preload')
+    low, high = args.value_size
+    conn: Connection = Connection.connect(host, port)
+    batch: list[RequestInner] = []
+    for i in range(args.keys):
+        for _ in range(args.preload):
+            size: int = rng.randint(low, high)
+            batch.append(Request.Append(
+                key = f'key {i}',
+                val = rng.randbytes((size + 1) // 2).hex()[:size],
+            ))
+        if len(batch) >= 1024 or i == args.keys - 1:
+            conn.pipeline(batch)
+            batch = []
+    conn.close()
+
+def run_load(args: argparse.Namespace) -> dict[str, Any]:
+    host, port = args.address
+    if args.preload > 0:
+        preload(host, port, args)
+    procs: int = min(args.connections, args.client_procs)
+    context = multiprocessing.get_context('fork')
+    barrier: multiprocessing.synchronize.Barrier = context.Barrier(procs + 1)
+    pipes: list[multiprocessing.connection.Connection] = []
+    processes: list[multiprocessing.process.BaseProcess] = []
+    for index in range(procs):
+        parent_end, child_end = context.Pipe(duplex=False)
+        process: multiprocessing.process.BaseProcess = context.Process(
+            target=client_process,
+            args=(index, procs, args, barrier, child_end),
+        )
+        process.start()
+        child_end.close()
+        pipes.append(parent_end)
+        processes.append(process)
+    barrier.wait()
+    starts: list[float] = []
+    ends: list[float] = []
+    reads: array[float] = array('d')
+    appends: array[float] = array('d')
+    errors: int = 0
+    for pipe in pipes:
+        start, end, read_bytes, append_bytes, proc_errors = pipe.recv()
+        starts.append(start)
+        ends.append(end)
+        reads.frombytes(read_bytes)
+        appends.frombytes(append_bytes)
+        errors += proc_errors
+    for process in processes:
+        process.join()
+    seconds: float = max(ends) - min(starts)
+    done: int = len(reads) + len(appends)
+    return {
+        'requests': done,
+        'errors': errors,
+        'seconds': seconds,
+        'throughput': done / seconds,
+        'latency_ms': {
+            'all': summary(list(reads) + list(appends)),
+            'read': summary(list(reads)),
+            'append': summary(list(appends)),
+        },
+    }
+
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', 'HEAD'],
+            capture_output=True, text=True, check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def print_report(report: dict[str, Any]) -> None:
+    config: dict[str, Any] = report['config']
+    results: dict[str, Any] = report['results']
+    low, high = config['value_size']
+    target: str = config['server'] \
+        or f"server.py {config['server_args']}".strip()
+    print(f"{config['connections']} connections "
+        f"({config['client_procs']} client processes), depth "
+        f"{config['depth']}, {config['requests']} requests each, "
+        f"{config['read_ratio']:.0%} reads")
+    print(f"{config['keys']} keys ({config['distribution']}), values of "
+        f"{low if low == high else f'{low}-{high}'} bytes, "
+        f"server: {target}")
+    print(f"{results['requests']} requests in {results['seconds']:.2f}s: "
+        f"{results['throughput']:.0f} req/s, {results['errors']} errors")
+    print(f"{'ms':<8} {'count':>8} {'mean':>8}"
+        + ''.join( f" {name:>8}" for name, _ in PERCENTILES )
+        + f" {'max':>8}")
+    for op, stats in results['latency_ms'].items():
+        if stats['count'] == 0:
+            continue
+        print(f"{op:<8} {stats['count']:>8} {stats['mean']:>8.3f}"
+            + ''.join( f" {stats[name]:>8.3f}" for name, _ in PERCENTILES )
+            + f" {stats['max']:>8.3f}")
+
+def main() -> int:
+    parser = argparse.ArgumentParser(
+        description='Closed-loop load generator: throughput and latency '
+            'percentiles of the server, for a read/append mix',
+    )
+    parser.add_argument('--server', default=None, metavar='HOST:PORT',
+        help='an already running server (default: start server.py on --port)')
+    parser.add_argument('--port', type=int, default=5100)
+    parser.add_argument('--server-args', default='',
+        help='arguments for the started server, e.g. "--engine asyncio"')
+    parser.add_argument('--connections', type=int, default=16)
+    parser.add_argument('--client-procs', type=int,
+        default=os.cpu_count() or 1,
+        help='processes sharing the connections, one thread per connection')
+    parser.add_argument('--requests', type=int, default=5000,
+        help='requests per connection')
+    parser.add_argument('--depth', type=int, default=1,
+        help='requests pipelined together by each connection')
+    parser.add_argument('--read-ratio', type=float, default=0.9)
+    parser.add_argument('--keys', type=int, default=10000)
+    parser.add_argument('--distribution', choices=DISTRIBUTIONS,
+        default='uniform')
+    parser.add_argument('--zipf-s', type=float, default=0.99,
+        help='zipfian exponent: bigger is more skewed')
+    parser.add_argument('--value-size', type=value_sizes, default=(16, 16),
+        metavar='N|MIN-MAX', help='bytes per appended value')
+    parser.add_argument('--preload', type=int, default=1,
+        help='values appended to every key before measuring')
+    parser.add_argument('--seed', type=int, default=0,
+        help='the same seed sends the same requests')
+    parser.add_argument('--json', default=None, metavar='FILE',
+        help='also write the results as JSON ("-" for stdout only)')
+    args = parser.parse_args()
+    if not 0 <= args.read_ratio <= 1:
+        parser.error('--read-ratio goes from 0 to 1')
+    if args.connections < 1 or args.depth < 1 or args.requests < 1:
+        parser.error('--connections, --depth and --requests must be positive')
+
+    report: dict[str, Any] = {
+        'commit': git_commit(),
+        'python': platform.python_version(),
+        'config': {
+            key: val for key, val in vars(args).items() if key != 'json'
+        },
+    }
+    report['config']['client_procs'] = min(args.connections, args.client_procs)
+    if args.server is not None:
+        host, port = args.server.rsplit(':', 1)
+        args.address = (host, int(port))
+        report['results'] = run_load(args)
+    else:
+        args.address = ('localhost', args.port)
+        with tempfile.TemporaryDirectory() as tmp:
+            server: subprocess.Popen[bytes] = subprocess.Popen(
+                [ sys.executable, 'server.py', '--port', str(args.port),
+                    '--dict-file', os.path.join(tmp, 'bench.json') ]
+                    + shlex.split(args.server_args),
+                stdin=subprocess.PIPE,
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.DEVNULL,
+            )
+            try:
+                wait_port(args.port)
+                report['results'] = run_load(args)
+            finally:
+                assert server.stdin is not None
+                server.stdin.close()
+                server.wait()
+
+    if args.json != '-':
+        print_report(report)
+    if args.json == '-':
+        json.dump(report, sys.stdout, indent=2)
+        print()
+    elif args.json is not None:
+        with open(args.json, 'w') as file:
+            json.dump(report, file, indent=2)
+            file.write('\n')
+    return 0
+
+if __name__ == '__main__':
+    retcode: int = main()
+    sys.exit(retcode)
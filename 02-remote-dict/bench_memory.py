@@ -0,0 +1,107 @@
+from typing import Optional, Tuple
+
+import multiprocessing
+import multiprocessing.connection
+import argparse
+import time
+import sys
+import gc
+import os
+
+from dicionario import CompactDict, Dicionario
+
+def rss() -> int:
+    """
+    Memória residente do processo, em bytes (Linux).
+    """
+    with open('/proc/self/statm') as file:
+        pages: int = int(file.read().split()[1])
+    return pages * os.sysconf('SC_PAGE_SIZE')
+
+def build(
+        compact: bool,
+        values: int,
+        args: argparse.Namespace,
+        out: multiprocessing.connection.Connection,
+        ) -> None:
+    """
+    Corpo do processo filho: monta o dicionário com `values` valores
+    e manda para o pai quantos bytes ele ocupou, e em quanto tempo.
+    """
+    gc.collect()
+    before: int = rss()
+    start: float = time.perf_counter()
+    dic: Dicionario = Dicionario(CompactDict() if compact else dict())
+    for i in range(values):
+        dic.append(f'key:{i // args.per_key}', f'{i:0{args.value_size}d}')
+    end: float = time.perf_counter()
+    gc.collect()
+    after: int = rss()
+    # Still all there, and still readable
+    last: str = f'key:{(values - 1) // args.per_key}'
+    assert dic.read(last)[-1] == f'{values - 1:0{args.value_size}d}'
+    out.send((after - before, end - start))
+    out.close()
+
+def measure(
+        compact: bool,
+        values: int,
+        args: argparse.Namespace,
+        ) -> Optional[Tuple[int, float]]:
+    """
+    Num processo novo, para começar com a memória limpa.
+    `None` se ele morreu (falta de memória, provavelmente).
+    """
+    context = multiprocessing.get_context('fork')
+    parent_end, child_end = context.Pipe(duplex=False)
+    process = context.Process(
+        target=build, args=(compact, values, args, child_end),
+    )
+    process.start()
+    child_end.close()
+    result: Optional[Tuple[int, float]] = None
+    try:
+        result = parent_end.recv()
+    except EOFError:
+        pass
+    process.join()
+    return result
+
+def main() -> int:
+    parser = argparse.ArgumentParser(
+        description='Memory per value of the dictionary, '
+            'with str lists and with CompactDict',
+    )
+    parser.add_argument('--values', default='1000000,10000000,50000000',
+        help='comma-separated counts of values to store')
+    parser.add_argument('--per-key', type=int, default=10,
+        help='values per key')
+    parser.add_argument('--value-size', type=int, default=16,
+        help='characters per value')
+    args = parser.parse_args()
+
+    counts: list[int] = [ int(v) for v in args.values.split(',') ]
+    print(f"{args.per_key} values per key, {args.value_size} chars per value")
+    print(f"{'values':>10} {'backend':<8} {'MiB':>9} {'bytes/value':>12} "
+        f"{'build (s)':>10}")
+    for values in counts:
+        sizes: dict[bool, int] = dict()
+        for compact in (False, True):
+            name: str = 'compact' if compact else 'memory'
+            result: Optional[Tuple[int, float]] = measure(compact, values, args)
+            if result is None:
+                print(f"{values:>10} {name:<8} {'failed (out of memory?)':>33}")
+                continue
+            size, seconds = result
+            sizes[compact] = size
+            print(f"{values:>10} {name:<8} {size / 2**20:>9.1f} "
+                f"{size / values:>12.1f} {seconds:>10.1f}")
+            sys.stdout.flush()
+        if len(sizes) == 2:
+            print(f"{'':>10} compact uses {sizes[True] / sizes[False]:.0%} "
+                f"of the memory")
+    return 0
+
+if __name__ == '__main__':
+    retcode: int = main()
+    sys.exit(retcode)
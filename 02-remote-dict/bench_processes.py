@@ -0,0 +1,103 @@
+from typing import Optional
+
+import multiprocessing
+import subprocess
+import argparse
+import tempfile
+import random
+import socket
+import time
+import sys
+import os
+
+from client import Connection
+from protocol import Request, RequestInner
+
+def client(port: int, args: argparse.Namespace, seed: int) -> None:
+    rng: random.Random = random.Random(seed)
+    conn: Connection = Connection.of(socket.create_connection(('localhost', port)))
+    for batch in range(args.requests // args.depth):
+        requests: list[RequestInner] = []
+        for i in range(args.depth):
+            key: str = f'key {rng.randrange(args.keys)}'
+            if rng.random() < args.read_ratio:
+                requests.append(Request.Read(key=key))
+            else:
+                requests.append(Request.Append(key=key, val=f'value {i}'))
+        conn.pipeline(requests)
+    conn.close()
+
+def wait_port(port: int) -> None:
+    for _ in range(100):
+        try:
+            socket.create_connection(('localhost', port)).close()
+            return
+        except ConnectionRefusedError:
+            time.sleep(0.1)
+    assert False, f"Server did not start on port {port}"
+
+def bench(server_args: list[str], args: argparse.Namespace) -> float:
+    with tempfile.TemporaryDirectory() as tmp:
+        server: subprocess.Popen[bytes] = subprocess.Popen(
+            [ sys.executable, 'server.py', '--port', str(args.port),
+                '--dict-file', os.path.join(tmp, 'bench.json') ] + server_args,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+        )
+        try:
+            wait_port(args.port)
+            clients: list[multiprocessing.Process] = [
+                multiprocessing.Process(target=client, args=(args.port, args, c))
+                for c in range(args.clients)
+            ]
+            start: float = time.perf_counter()
+            for p in clients:
+                p.start()
+            for p in clients:
+                p.join()
+            end: float = time.perf_counter()
+        finally:
+            assert server.stdin is not None
+            server.stdin.close()
+            server.wait()
+    client_count: int = args.clients
+    # Each client sends only whole pipelines of `depth` requests
+    sent: int = args.requests // args.depth * args.depth
+    return client_count * sent / (end - start)
+
+def main() -> int:
+    parser = argparse.ArgumentParser(
+        description='Throughput of the threaded engine against worker processes',
+    )
+    parser.add_argument('--port', type=int, default=5100)
+    parser.add_argument('--clients', type=int, default=16,
+        help='client processes, one connection each')
+    parser.add_argument('--requests', type=int, default=20000,
+        help='requests per client')
+    parser.add_argument('--depth', type=int, default=32,
+        help='requests pipelined together')
+    parser.add_argument('--keys', type=int, default=10000)
+    parser.add_argument('--read-ratio', type=float, default=0.9)
+    parser.add_argument('--processes', type=int, nargs='*', default=None,
+        help='worker process counts to try (default: 1, 2, 4, ... up to the cores)')
+    args = parser.parse_args()
+
+    counts: Optional[list[int]] = args.processes
+    if counts is None:
+        cores: int = os.cpu_count() or 1
+        counts = [ 1 << i for i in range(cores.bit_length()) ]
+        if counts[-1] != cores:
+            counts.append(cores)
+    print(f"{args.clients} clients x {args.requests} requests "
+        f"(depth {args.depth}), {args.keys} keys, {args.read_ratio:.0%} reads")
+    rate: float = bench(['--engine', 'threaded'], args)
+    print(f"{'threaded':<16} {rate:>10.0f} req/s")
+    for count in counts:
+        rate = bench(['--engine', 'processes', '--processes', str(count)], args)
+        print(f"{f'{count} processes':<16} {rate:>10.0f} req/s")
+    return 0
+
+if __name__ == '__main__':
+    retcode: int = main()
+    sys.exit(retcode)
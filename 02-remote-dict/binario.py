@@ -0,0 +1,185 @@
+from __future__ import annotations
+
+from typing import BinaryIO, Callable, ItemsView, Iterator, Mapping, Optional, Tuple
+from typing import TypeAlias, Union
+from array import array
+
+import struct
+import mmap
+import sys
+import os
+
+from dicionario import IterItems
+
+Buffer: TypeAlias = Union[bytes, bytearray, memoryview, mmap.mmap]
+
+class Binario:
+    """
+    Formato binário do snapshot (inteiros little-endian):
+
+        header: MAGIC (8 bytes) | count (u64) | index_offset (u64)
+        arena:  count entradas, em ordem crescente de chave:
+                key_len (u32) | key | val_count (u32) | (val_len (u32) | val)*
+        index:  count offsets (u64) das entradas na arena
+
+    Strings em UTF-8; a ordem dos bytes em UTF-8 é a mesma de `str`.
+    """
+    MAGIC: bytes = b'HDDSNAP\x01'
+    HEADER: struct.Struct = struct.Struct('<8sQQ')
+    U32: struct.Struct = struct.Struct('<I')
+    U64: struct.Struct = struct.Struct('<Q')
+
+    @staticmethod
+    def is_binary(filename: str) -> bool:
+        if not os.path.exists(filename):
+            return False
+        with open(filename, 'rb') as file:
+            return file.read(len(Binario.MAGIC)) == Binario.MAGIC
+
+    @staticmethod
+    def write(
+            file: BinaryIO,
+            dic: Mapping[str, list[str]],
+            progress: Optional[Callable[[int], None]] = None,
+            ) -> None:
+        """
+        Só as chaves são ordenadas na memória: os valores são buscados
+        uma entrada por vez, então um `LazyDict` ou `DiskDict` não é
+        decodificado inteiro.
+        """
+        keys: list[str] = sorted(dic)
+        step: int = max(1, len(keys) // 100)
+        offsets: array[int] = array('Q')
+        offset: int = Binario.HEADER.size
+        file.write(Binario.HEADER.pack(Binario.MAGIC, 0, 0))
+        for i, key in enumerate(keys):
+            buf: bytearray = bytearray()
+            Binario.write_entry(buf, key, dic[key])
+            file.write(buf)
+            offsets.append(offset)
+            offset += len(buf)
+            if progress is not None and (i + 1) % step == 0:
+                progress(i + 1)
+        if sys.byteorder != 'little':
+            offsets.byteswap()
+        file.write(offsets.tobytes())
+        file.seek(0)
+        file.write(Binario.HEADER.pack(Binario.MAGIC, len(keys), offset))
+        if progress is not None:
+            progress(len(keys))
+
+    @staticmethod
+    def write_entry(buf: bytearray, key: str, vals: list[str]) -> None:
+        Binario.write_str(buf, key)
+        buf += Binario.U32.pack(len(vals))
+        for val in vals:
+            Binario.write_str(buf, val)
+
+    @staticmethod
+    def write_str(buf: bytearray, s: str) -> None:
+        data: bytes = s.encode('utf-8')
+        buf += Binario.U32.pack(len(data))
+        buf += data
+
+    @staticmethod
+    def read_str(buf: Buffer, off: int) -> Tuple[bytes, int]:
+        size: int = Binario.U32.unpack_from(buf, off)[0]
+        start: int = off + 4
+        return bytes(buf[start : start + size]), start + size
+
+    @staticmethod
+    def read_vals(buf: Buffer, off: int) -> Tuple[list[str], int]:
+        count: int = Binario.U32.unpack_from(buf, off)[0]
+        off += 4
+        vals: list[str] = []
+        for _ in range(count):
+            data, off = Binario.read_str(buf, off)
+            vals.append(data.decode('utf-8'))
+        return vals, off
+
+class BinSnapshot(Mapping[str, list[str]]):
+    """
+    Snapshot binário mapeado em memória (`mmap`), somente leitura.
+    Nada é decodificado na abertura: cada acesso faz uma busca binária
+    no índice e decodifica só a entrada encontrada.
+    """
+    mm: mmap.mmap
+    count: int
+    index_offset: int
+
+    def __init__(self, filename: str) -> None:
+        with open(filename, 'rb') as file:
+            self.mm = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.count, self.index_offset = \
+            Binario.HEADER.unpack_from(self.mm, 0)
+        assert magic == Binario.MAGIC, \
+            f"Not a binary snapshot: '{filename}'"
+
+    def entry_offset(self, i: int) -> int:
+        off: int = Binario.U64.unpack_from(self.mm, self.index_offset + 8 * i)[0]
+        return off
+
+    def find(self, key: str) -> Optional[int]:
+        """
+        Offset dos valores de `key`, se ela estiver no snapshot.
+        """
+        target: bytes = key.encode('utf-8')
+        lo: int = 0
+        hi: int = self.count
+        while lo < hi:
+            mid: int = (lo + hi) // 2
+            data, vals_off = Binario.read_str(self.mm, self.entry_offset(mid))
+            if data < target:
+                lo = mid + 1
+            elif data > target:
+                hi = mid
+            else:
+                return vals_off
+        return None
+
+    def __getitem__(self, key: str) -> list[str]:
+        off: Optional[int] = self.find(key)
+        if off is None:
+            raise KeyError(key)
+        return Binario.read_vals(self.mm, off)[0]
+
+    def __contains__(self, key: object) -> bool:
+        return isinstance(key, str) and self.find(key) is not None
+
+    def __len__(self) -> int:
+        return self.count
+
+    def __iter__(self) -> Iterator[str]:
+        # Through the index, without decoding the values
+        for i in range(self.count):
+            data, _ = Binario.read_str(self.mm, self.entry_offset(i))
+            yield data.decode('utf-8')
+
+    def iter_items(self) -> Iterator[Tuple[str, list[str]]]:
+        # The arena is in key order: walk it instead of the index
+        off: int = Binario.HEADER.size
+        for _ in range(self.count):
+            data, off = Binario.read_str(self.mm, off)
+            vals, off = Binario.read_vals(self.mm, off)
+            yield data.decode('utf-8'), vals
+
+    def items(self) -> ItemsView[str, list[str]]:
+        return IterItems(self)
+
+def main(argv: list[str]) -> int:
+    from persistencia import Persistencia, SnapshotFormat
+    formats: dict[str, SnapshotFormat] = {
+        'to-binary': SnapshotFormat.BINARY,
+        'to-json': SnapshotFormat.JSON,
+    }
+    if len(argv) != 4 or argv[1] not in formats:
+        print(f"usage: {argv[0]} to-binary|to-json <input> <output>",
+            file=sys.stderr)
+        return 1
+    _, direction, src, dst = argv
+    Persistencia.store(dst, Persistencia.load(src), format=formats[direction])
+    return 0
+
+if __name__ == '__main__':
+    retcode: int = main(sys.argv)
+    sys.exit(retcode)
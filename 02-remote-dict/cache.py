@@ -0,0 +1,83 @@
+from __future__ import annotations
+
+from typing import Optional, Tuple
+from collections import OrderedDict
+
+import threading
+
+from protocol import VERSION
+
+class FrameCache:
+    """
+    As `Response.Read` das chaves lidas há pouco, já codificadas
+    (só o corpo, sem o cabeçalho, que depende do id da requisição),
+    até `max_bytes` no total: as menos lidas saem primeiro.
+    Cada versão do protocolo tem o seu; leituras que vão em vários
+    pedaços não são guardadas.
+
+    É uma das `feeds` do `Process`, então cada mutação tira a chave
+    do cache. `get` e `put` precisam da trava de leitura da chave:
+    como as mutações têm a de escrita, um `put` nunca guarda um
+    valor velho.
+    """
+    max_bytes: int
+    lock: threading.Lock
+    # Least recently read first
+    bodies: OrderedDict[Tuple[str, int], bytes]
+    size: int
+    hits: int
+    misses: int
+
+    def __init__(self, max_bytes: int) -> None:
+        assert max_bytes > 0
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.bodies = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: str, version: int = 1) -> Optional[bytes]:
+        with self.lock:
+            body: Optional[bytes] = self.bodies.get((key, version))
+            if body is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self.bodies.move_to_end((key, version))
+            return body
+
+    def put(self, key: str, version: int, body: bytes) -> None:
+        if len(body) > self.max_bytes:
+            return
+        with self.lock:
+            old: Optional[bytes] = self.bodies.pop((key, version), None)
+            if old is not None:
+                self.size -= len(old)
+            self.bodies[(key, version)] = body
+            self.size += len(body)
+            while self.size > self.max_bytes:
+                _, evicted = self.bodies.popitem(last=False)
+                self.size -= len(evicted)
+
+    def record(self, record: list[str]) -> None:
+        with self.lock:
+            if record[0] == 'l':
+                self.bodies.clear()
+                self.size = 0
+            else:
+                for version in range(1, VERSION + 1):
+                    old: Optional[bytes] = \
+                        self.bodies.pop((record[1], version), None)
+                    if old is not None:
+                        self.size -= len(old)
+
+    def status(self) -> str:
+        with self.lock:
+            total: int = self.hits + self.misses
+            ratio: float = self.hits / total if total > 0 else 0.0
+            return (
+                f"{len(self.bodies)} keys, {self.size} of {self.max_bytes} "
+                f"bytes, {self.hits} hits, {self.misses} misses "
+                f"({ratio:.1%} hits)"
+            )
@@ -30,8 +30,11 @@ class UserCli:
             UserCli.help(file)
             return None
         else:
-            args: list[str] = \
-                Private.args(UserCli.CMDS[cmd_i], input, file)
+            try:
+                args: list[str] = \
+                    Private.args(UserCli.CMDS[cmd_i], input, file)
+            except EOFError:
+                return ParsedCommand('exit', [])
             return ParsedCommand(UserCli.CMDS[cmd_i][0], args)
 
 class AdminCli:
@@ -39,8 +42,14 @@ class AdminCli:
         ('append', ['key', 'value']),
         ('read', ['key']),
         ('remove', ['key']),
+        # `-` for no start or stop
+        ('scan', ['start', 'stop']),
+        ('prefix', ['prefix']),
         ('load', []),
         ('store', []),
+        ('replication', []),
+        ('cache', []),
+        ('compression', []),
         ('exit', []),
         ('help', []),
     ]
@@ -59,8 +68,11 @@ class AdminCli:
             AdminCli.help(file)
             return None
         else:
-            args: list[str] = \
-                Private.args(AdminCli.CMDS[cmd_i], input, file)
+            try:
+                args: list[str] = \
+                    Private.args(AdminCli.CMDS[cmd_i], input, file)
+            except EOFError:
+                return ParsedCommand('exit', [])
             return ParsedCommand(AdminCli.CMDS[cmd_i][0], args)
 
 class Private:
@@ -126,6 +138,9 @@ class Private:
                 file: TextIO,
                 ) -> Optional[int]:
         cmd_str: str = input.readline()
+        if cmd_str == '':
+            # End of input: same as 'exit', otherwise nobody stops us
+            cmd_str = 'exit'
         cmd_str_trimed: str = Private.trim(cmd_str)
         for i, cmd in enumerate(cmds):
             if cmd_str_trimed == cmd[0]:
@@ -148,6 +163,8 @@ class Private:
                 print(f"{cmd}: {cmd_arg}> ", file=file, end='')
                 file.flush()
                 arg: str = input.readline()
+                if arg == '':
+                    raise EOFError(f"End of input while reading '{cmd}'")
                 arg_trimed: str = Private.trim(arg)
                 if len(arg_trimed) > 0:
                     ret_list.append(arg_trimed)
@@ -1,11 +1,18 @@
-from typing import Any, TextIO, Optional
+from __future__ import annotations
+
+from typing import Any, Iterator, TextIO, Optional, Protocol, Sequence, Tuple, TypeAlias, Union
 from dataclasses import dataclass, field
 
+import threading
+import argparse
 import socket
 import sys
 
 from cli import UserCli, ParsedCommand
-from protocol import Request, Response
+from hashring import HashRing
+from indice import KeyIndex, Page
+from protocol import VERSION, Compression, Compressor, FrameReader, ReadChunks
+from protocol import Request, RequestInner, Response
 
 HOST = 'localhost'
 PORT = 5000
@@ -13,6 +20,13 @@ PORT = 5000
 def log(s: str) -> None:
     print(s, file=sys.stderr)
 
+class ServerBusy(ConnectionRefusedError):
+    """
+    O servidor respondeu `Response.Busy`: não tem como atender a
+    conexão agora.
+    """
+    pass
+
 @dataclass(eq=False, kw_only=True, slots=True)
 class SockMan:
     host: str
@@ -34,23 +48,394 @@ def create_sock(
         ) -> SockMan:
     return SockMan(host=host, port=port)
 
+def pipeline(
+        sock: socket.socket,
+        reader: FrameReader,
+        requests: list[RequestInner],
+        version: int = 1,
+        compressor: Optional[Compressor] = None,
+        ) -> list[Response]:
+    """
+    Envia todas as `requests` de uma vez e espera as respostas.
+    Cada requisição leva seu índice como id, então a resposta `i`
+    corresponde à requisição `i`.
+    Um `Response.Busy` sem id (servidor cheio) vira `ServerBusy`.
+    """
+    out: bytearray = bytearray()
+    for req_id, inner in enumerate(requests):
+        Request(inner, req_id, version).encode(out, compressor)
+    # Responses are read while sending, otherwise both sides can block
+    # on full socket buffers
+
+    def send() -> None:
+        try:
+            sock.sendall(out)
+        except OSError:
+            # Reading the responses reports the closed connection
+            pass
+
+    sender: threading.Thread = threading.Thread(target=send)
+    sender.start()
+    responses: list[Optional[Response]] = [None] * len(requests)
+    chunks: ReadChunks = ReadChunks()
+    remaining: int = len(requests)
+    while remaining > 0:
+        response: Optional[Response] = Response.read(reader)
+        assert response is not None, 'Connection closed'
+        response = chunks.add(response)
+        if response is None:
+            continue
+        if response.req_id is None:
+            if isinstance(response.inner, Response.Busy):
+                raise ServerBusy('Server busy')
+            raise ConnectionError(f"Untagged response: {response.inner}")
+        assert responses[response.req_id] is None
+        responses[response.req_id] = response
+        remaining -= 1
+    sender.join()
+    return [ r for r in responses if r is not None ]
+
+@dataclass(eq=False, slots=True)
+class Connection:
+    """
+    Conexão com um único servidor.
+    Usa a v1 do protocolo, e sem compressão, até `negotiate`.
+    """
+    sock: socket.socket
+    reader: FrameReader
+    version: int = 1
+    compressor: Optional[Compressor] = None
+
+    @staticmethod
+    def of(sock: socket.socket) -> Connection:
+        return Connection(sock, FrameReader(sock))
+
+    @staticmethod
+    def connect(
+            host: str,
+            port: int,
+            compression: Sequence[Compression] = (),
+            ) -> Connection:
+        """
+        Já combinando a versão do protocolo (e a compressão).
+        """
+        conn: Connection = \
+            Connection.of(socket.create_connection((host, port)))
+        try:
+            return conn.negotiate(compression)
+        except BaseException:
+            conn.close()
+            raise
+
+    def negotiate(self, compression: Sequence[Compression] = ()) -> Connection:
+        """
+        Com `compression`, pede também a compressão, com o primeiro
+        desses métodos que o servidor aceitar.
+        """
+        response: Optional[Response] = \
+            self.request(Request.Hello(version=VERSION))
+        assert response is not None, 'Connection closed'
+        if isinstance(response.inner, Response.Busy):
+            raise ServerBusy('Server busy')
+        assert isinstance(response.inner, Response.Hello)
+        self.version = response.inner.version
+        if len(compression) > 0:
+            response = self.request(Request.Compress(methods=list(compression)))
+            assert response is not None, 'Connection closed'
+            assert isinstance(response.inner, Response.Compress)
+            if response.inner.method != Compression.NONE:
+                self.compressor = Compressor(response.inner.method)
+        return self
+
+    def request(self, inner: RequestInner) -> Optional[Response]:
+        # The handshake itself always goes in v1
+        version: int = 1 if isinstance(inner, Request.Hello) else self.version
+        self.sock.sendall(
+            Request(inner, None, version).encode(compressor=self.compressor)
+        )
+        chunks: ReadChunks = ReadChunks()
+        while True:
+            response: Optional[Response] = Response.read(self.reader)
+            if response is None:
+                return None
+            response = chunks.add(response)
+            if response is not None:
+                return response
+
+    def read_stream(self, key: str) -> Iterator[list[str]]:
+        """
+        Os valores de `key` conforme chegam, um pedaço de cada vez
+        (na v1, num pedaço só).
+        """
+        Request(Request.Read(key=key), None, self.version).write(self.sock)
+        while True:
+            response: Optional[Response] = Response.read(self.reader)
+            if response is None:
+                raise ConnectionError('Connection closed')
+            assert isinstance(response.inner, Response.Read)
+            yield response.inner.val_list
+            if not response.inner.more:
+                return
+
+    def pipeline(self, requests: list[RequestInner]) -> list[Response]:
+        return pipeline(
+            self.sock, self.reader, requests, self.version, self.compressor,
+        )
+
+    def close(self) -> None:
+        self.sock.close()
+
+class Shard(Protocol):
+    """
+    Uma parte das chaves do `ShardedClient`: normalmente uma
+    `Connection`, mas pode ser atendida no próprio processo.
+    """
+    def pipeline(self, requests: list[RequestInner]) -> list[Response]: ...
+
+    def close(self) -> None: ...
+
+# Where each piece of a request went: the server, the index of the
+# piece in that server's pipeline and, for multi requests, the
+# positions of its keys in the original request
+Part: TypeAlias = Tuple[str, int, list[int]]
+
+@dataclass(eq=False, slots=True)
+class ShardedClient:
+    """
+    Cliente de vários servidores, cada um dono de uma parte das chaves,
+    escolhido pelo `HashRing`.
+    Requisições multi são divididas entre os donos das suas chaves,
+    e as respostas são remontadas na ordem pedida;
+    `scan` e `prefix` vão para todos, e as páginas são intercaladas.
+    """
+    ring: HashRing
+    conns: dict[str, Shard]
+
+    @staticmethod
+    def connect(
+            addrs: list[str],
+            vnodes: int = 128,
+            compression: Sequence[Compression] = (),
+            ) -> ShardedClient:
+        """
+        `addrs` no formato `host:port`.
+        """
+        conns: dict[str, Shard] = dict()
+        for addr in addrs:
+            host, port = addr.rsplit(':', 1)
+            conns[addr] = Connection.connect(host, int(port), compression)
+        return ShardedClient(HashRing(addrs, vnodes), conns)
+
+    def __enter__(self) -> ShardedClient:
+        return self
+
+    def __exit__(self, *args: Any) -> None:
+        self.close()
+
+    def close(self) -> None:
+        for conn in self.conns.values():
+            conn.close()
+
+    def split(self, inner: RequestInner) -> list[Tuple[str, RequestInner, list[int]]]:
+        if isinstance(inner, (
+                Request.Read, Request.Append, Request.ReadRange, Request.Length,
+                )):
+            return [ (self.ring.node_of(inner.key), inner, [0]) ]
+        elif isinstance(inner, Request.MultiRead):
+            keys: list[str] = inner.keys
+            return [
+                (node, Request.MultiRead(keys=[ keys[i] for i in idxs ]), idxs)
+                for node, idxs in self.ring.split(keys).items()
+            ]
+        elif isinstance(inner, Request.MultiAppend):
+            pairs: list[Tuple[str, str]] = inner.pairs
+            return [
+                (node, Request.MultiAppend(pairs=[ pairs[i] for i in idxs ]), idxs)
+                for node, idxs in self.ring.split(
+                    [ key for key, _ in pairs ]
+                ).items()
+            ]
+        elif isinstance(inner, (Request.Scan, Request.Prefix)):
+            # Keys of any node may be in the page
+            return [ (node, inner, []) for node in self.conns ]
+        else:
+            assert False, f"Unknown request: '{inner}'"
+
+    def pipeline(self, requests: list[RequestInner]) -> list[Response]:
+        """
+        Como `pipeline`, com os servidores atendendo em paralelo.
+        """
+        sent: dict[str, list[RequestInner]] = \
+            { node: [] for node in self.conns }
+        parts: list[list[Part]] = []
+        for inner in requests:
+            req_parts: list[Part] = []
+            for node, piece, idxs in self.split(inner):
+                req_parts.append((node, len(sent[node]), idxs))
+                sent[node].append(piece)
+            parts.append(req_parts)
+
+        received: dict[str, list[Response]] = dict()
+
+        def run(node: str) -> None:
+            received[node] = self.conns[node].pipeline(sent[node])
+
+        busy: list[str] = [
+            node for node, pieces in sent.items() if len(pieces) > 0
+        ]
+        # The last one runs in this thread
+        threads: list[threading.Thread] = [
+            threading.Thread(target=run, args=(node,))
+            for node in busy[:-1]
+        ]
+        for t in threads:
+            t.start()
+        if len(busy) > 0:
+            run(busy[-1])
+        for t in threads:
+            t.join()
+        return [
+            self.merge(inner, [ (received[node][i], idxs) for node, i, idxs in req_parts ])
+            for inner, req_parts in zip(requests, parts)
+        ]
+
+    @staticmethod
+    def merge(
+            inner: RequestInner,
+            pieces: list[Tuple[Response, list[int]]],
+            ) -> Response:
+        for response, _ in pieces:
+            if isinstance(response.inner, (Response.Busy, Response.ReadOnly)):
+                return Response(response.inner)
+        if isinstance(inner, (
+                Request.Read, Request.Append, Request.ReadRange, Request.Length,
+                )):
+            assert len(pieces) == 1
+            return Response(pieces[0][0].inner)
+        elif isinstance(inner, Request.MultiRead):
+            entries: list[Tuple[str, list[str]]] = [ ('', []) ] * len(inner.keys)
+            for response, idxs in pieces:
+                assert isinstance(response.inner, Response.MultiRead)
+                for i, entry in zip(idxs, response.inner.entries):
+                    entries[i] = entry
+            return Response(Response.MultiRead(entries=entries))
+        elif isinstance(inner, Request.MultiAppend):
+            existed: list[bool] = [ False ] * len(inner.pairs)
+            for response, idxs in pieces:
+                assert isinstance(response.inner, Response.MultiAppend)
+                for i, flag in zip(idxs, response.inner.existed_before):
+                    existed[i] = flag
+            return Response(Response.MultiAppend(existed_before=existed))
+        elif isinstance(inner, (Request.Scan, Request.Prefix)):
+            pages: list[Page] = []
+            for response, _ in pieces:
+                assert isinstance(response.inner, Response.Keys)
+                pages.append((response.inner.keys, response.inner.cursor))
+            keys, cursor = KeyIndex.merge(pages, inner.limit)
+            return Response(Response.Keys(keys=keys, cursor=cursor))
+        else:
+            assert False, f"Unknown request: '{inner}'"
+
+    def request(self, inner: RequestInner) -> Optional[Response]:
+        return self.pipeline([inner])[0]
+
+@dataclass(eq=False, slots=True)
+class ReplicatedClient:
+    """
+    Escritas vão para o primário, e leituras para as réplicas,
+    uma de cada vez (rodízio).
+    Como as réplicas podem estar atrasadas, uma leitura pode ainda não
+    ver uma escrita recente, mesmo deste cliente.
+    """
+    primary: Connection
+    replicas: list[Connection]
+    turn: int = 0
+
+    @staticmethod
+    def connect(
+            primary: str,
+            replicas: list[str],
+            compression: Sequence[Compression] = (),
+            ) -> ReplicatedClient:
+        """
+        Endereços no formato `host:port`.
+        """
+        conns: list[Connection] = []
+        for addr in [primary] + replicas:
+            host, port = addr.rsplit(':', 1)
+            conns.append(Connection.connect(host, int(port), compression))
+        return ReplicatedClient(conns[0], conns[1:])
+
+    def __enter__(self) -> ReplicatedClient:
+        return self
+
+    def __exit__(self, *args: Any) -> None:
+        self.close()
+
+    def close(self) -> None:
+        self.primary.close()
+        for conn in self.replicas:
+            conn.close()
+
+    def pipeline(self, requests: list[RequestInner]) -> list[Response]:
+        reads: list[int] = [
+            i for i, inner in enumerate(requests)
+            if isinstance(inner, (
+                Request.Read, Request.MultiRead, Request.Scan, Request.Prefix,
+                Request.ReadRange, Request.Length,
+            ))
+        ]
+        if len(reads) == 0 or len(self.replicas) == 0:
+            return self.primary.pipeline(requests)
+        replica: Connection = self.replicas[self.turn % len(self.replicas)]
+        self.turn += 1
+        if len(reads) == len(requests):
+            return replica.pipeline(requests)
+        is_read: set[int] = set(reads)
+        writes: list[int] = [
+            i for i in range(len(requests)) if i not in is_read
+        ]
+        responses: list[Optional[Response]] = [None] * len(requests)
+
+        def run(conn: Connection, idxs: list[int]) -> None:
+            for i, response in zip(idxs,
+                    conn.pipeline([ requests[i] for i in idxs ])):
+                responses[i] = Response(response.inner)
+
+        writer: threading.Thread = \
+            threading.Thread(target=run, args=(self.primary, writes))
+        writer.start()
+        run(replica, reads)
+        writer.join()
+        return [ r for r in responses if r is not None ]
+
+    def request(self, inner: RequestInner) -> Optional[Response]:
+        return self.pipeline([inner])[0]
+
+Client: TypeAlias = Union[Connection, ShardedClient, ReplicatedClient]
+
 def handle_command(
         parsed: ParsedCommand,
-        sock: socket.socket,
+        client: Client,
         output: TextIO,
         ) -> bool:
     if parsed.cmd_name == 'append':
         assert len(parsed.args) == 2
-        request = Request(Request.Append(
+        response = client.request(Request.Append(
             key = parsed.args[0],
             val = parsed.args[1]
         ))
-        request.write(sock)
-        log(f"Request sent")
-        response = Response.read(sock)
         log(f"Response received")
         if response is None:
             return True
+        if isinstance(response.inner, Response.Busy):
+            print('=> Server busy, try again later',
+                file=output)
+            return True
+        if isinstance(response.inner, Response.ReadOnly):
+            print('=> Read-only replica, append on the primary',
+                file=output)
+            return False
         assert not isinstance(response.inner, Response.Read)
         if isinstance(response.inner, Response.AppendNotExists):
             print('=> Just created!',
@@ -62,15 +447,16 @@ def handle_command(
             assert False, f"Unhandled Response: '{response}'"
     elif parsed.cmd_name == 'read':
         assert len(parsed.args) == 1
-        request = Request(Request.Read(
+        response = client.request(Request.Read(
             key = parsed.args[0]
         ))
-        request.write(sock)
-        log(f"Request sent")
-        response = Response.read(sock)
         log(f"Response received")
         if response is None:
             return True
+        if isinstance(response.inner, Response.Busy):
+            print('=> Server busy, try again later',
+                file=output)
+            return True
         assert isinstance(response.inner, Response.Read)
         print(f"=> Read '{response.inner.key}' values (len: {len(response.inner.val_list)}): {response.inner.val_list}",
             file=output)
@@ -85,22 +471,62 @@ def handle_command(
         assert False, f"Unhandled command: '{parsed.cmd_name}'"
     return False
 
-def main() -> int:
+def run_cli(client: Client) -> None:
     infile = sys.stdin
     outfile = sys.stdout
-    with create_sock(HOST, PORT) as sock:
-        should_stop: bool = False
-        UserCli.help(outfile)
-        while not should_stop:
-            parsed: Optional[ParsedCommand] = \
-                UserCli.command(infile, outfile)
-            if parsed is None:
-                # Nothing to do
-                pass
-            else:
-                should_stop = handle_command(parsed, sock, outfile)
+    should_stop: bool = False
+    UserCli.help(outfile)
+    while not should_stop:
+        parsed: Optional[ParsedCommand] = \
+            UserCli.command(infile, outfile)
+        if parsed is None:
+            # Nothing to do
+            pass
+        else:
+            should_stop = handle_command(parsed, client, outfile)
+
+def main(
+        servers: Optional[list[str]] = None,
+        replicas: Optional[list[str]] = None,
+        compression: Sequence[Compression] = (),
+        ) -> int:
+    try:
+        if servers is not None:
+            with ShardedClient.connect(
+                    servers, compression=compression) as sharded:
+                run_cli(sharded)
+        elif replicas is not None:
+            with ReplicatedClient.connect(
+                    f'{HOST}:{PORT}', replicas, compression) as replicated:
+                run_cli(replicated)
+        else:
+            with create_sock(HOST, PORT) as sock:
+                run_cli(Connection.of(sock).negotiate(compression))
+    except ServerBusy:
+        print('=> Server busy, try again later', file=sys.stderr)
+        return 1
     return 0
 
 if __name__ == '__main__':
-    retcode: int = main()
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--servers', default=None,
+        help='host:port,host:port,... of a sharded cluster '
+            f'(default: a single server at {HOST}:{PORT})')
+    parser.add_argument('--replicas', default=None,
+        help='host:port,host:port,... of replicas to send the reads to '
+            f'(the writes still go to {HOST}:{PORT})')
+    parser.add_argument('--compression', default=None,
+        help='ask the servers to compress big frames, with the first '
+            'of these methods they accept (zlib,lzma)')
+    args = parser.parse_args()
+    if args.servers is not None and args.replicas is not None:
+        parser.error('--servers and --replicas do not go together')
+    retcode: int = main(
+        None if args.servers is None else args.servers.split(','),
+        None if args.replicas is None else args.replicas.split(','),
+        [] if args.compression is None else [
+            Compression.from_name(name)
+            for name in args.compression.split(',')
+        ],
+    )
     sys.exit(retcode)
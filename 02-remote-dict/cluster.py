@@ -0,0 +1,52 @@
+from typing import IO, Optional
+
+import subprocess
+import argparse
+import sys
+
+from server import PORT
+
+def main() -> int:
+    parser = argparse.ArgumentParser(
+        description='Run several servers on local ports, one shard each. '
+            'Extra arguments go to every server.',
+    )
+    parser.add_argument('--shards', type=int, default=3)
+    parser.add_argument('--base-port', type=int, default=PORT)
+    args, server_args = parser.parse_known_args()
+
+    addrs: list[str] = []
+    procs: list[subprocess.Popen[bytes]] = []
+    for i in range(args.shards):
+        port: int = args.base_port + i
+        addrs.append(f'localhost:{port}')
+        procs.append(subprocess.Popen(
+            [
+                sys.executable, 'server.py',
+                '--port', str(port),
+                '--dict-file', f'shard-{port}.json',
+                *server_args,
+            ],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.DEVNULL,
+        ))
+    print(f"Running {args.shards} shards, connect with:")
+    print(f"    python client.py --servers {','.join(addrs)}")
+    print("Press Enter (or end the input) to stop them")
+    try:
+        sys.stdin.readline()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        # End of input is the same as the 'exit' command
+        for proc in procs:
+            stdin: Optional[IO[bytes]] = proc.stdin
+            if stdin is not None:
+                stdin.close()
+        for proc in procs:
+            proc.wait()
+    return 0
+
+if __name__ == '__main__':
+    retcode: int = main()
+    sys.exit(retcode)
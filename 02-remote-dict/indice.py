@@ -0,0 +1,157 @@
+from __future__ import annotations
+
+from typing import ClassVar, Iterable, Optional, Tuple
+from bisect import bisect_left, bisect_right, insort
+from heapq import merge
+
+import threading
+
+# A page of keys and the cursor for the next one (`None` at the end)
+Page = Tuple[list[str], Optional[str]]
+
+class KeyIndex:
+    """
+    As chaves do dicionário em ordem, para percorrer intervalos
+    (`scan`) sem olhar as outras chaves.
+
+    Fica em blocos ordenados de até `2 * LOAD` chaves, com a última
+    chave de cada bloco em `maxes` (uma árvore B de dois níveis):
+    achar uma chave é uma busca binária em `maxes` e outra no bloco,
+    e inserir ou remover só mexe num bloco. Uma página de `k` chaves
+    custa O(log n + k).
+
+    Tem trava própria: o dicionário altera chaves diferentes ao mesmo
+    tempo, mas todas mexem nos mesmos blocos.
+    """
+    LOAD: ClassVar[int] = 512
+
+    lock: threading.Lock
+    blocks: list[list[str]]
+    maxes: list[str]
+    size: int
+
+    def __init__(self, keys: Iterable[str] = ()) -> None:
+        self.lock = threading.Lock()
+        ordered: list[str] = sorted(keys)
+        self.blocks = [
+            ordered[i : i + KeyIndex.LOAD]
+            for i in range(0, len(ordered), KeyIndex.LOAD)
+        ]
+        self.maxes = [ block[-1] for block in self.blocks ]
+        self.size = len(ordered)
+
+    def __len__(self) -> int:
+        return self.size
+
+    def add(self, key: str) -> None:
+        """
+        `key` não pode já estar no índice.
+        """
+        with self.lock:
+            self.size += 1
+            if len(self.blocks) == 0:
+                self.blocks.append([key])
+                self.maxes.append(key)
+                return
+            i: int = min(bisect_left(self.maxes, key), len(self.blocks) - 1)
+            block: list[str] = self.blocks[i]
+            insort(block, key)
+            self.maxes[i] = block[-1]
+            if len(block) > 2 * KeyIndex.LOAD:
+                half: list[str] = block[KeyIndex.LOAD:]
+                del block[KeyIndex.LOAD:]
+                self.blocks.insert(i + 1, half)
+                self.maxes[i] = block[-1]
+                self.maxes.insert(i + 1, half[-1])
+
+    def discard(self, key: str) -> None:
+        with self.lock:
+            i: int = bisect_left(self.maxes, key)
+            if i == len(self.blocks):
+                return
+            block: list[str] = self.blocks[i]
+            j: int = bisect_left(block, key)
+            if j == len(block) or block[j] != key:
+                return
+            del block[j]
+            self.size -= 1
+            if len(block) == 0:
+                del self.blocks[i]
+                del self.maxes[i]
+            else:
+                self.maxes[i] = block[-1]
+
+    def scan(
+            self,
+            start: Optional[str] = None,
+            stop: Optional[str] = None,
+            cursor: Optional[str] = None,
+            limit: int = 100,
+            ) -> Page:
+        """
+        Até `limit` chaves de `start` (inclusive) até `stop` (exclusive),
+        depois de `cursor` (o da página anterior).
+        Sem `start` ou `stop`, do começo ou até o fim.
+        """
+        assert limit > 0
+        keys: list[str] = []
+        with self.lock:
+            i: int
+            j: int
+            if cursor is not None and (start is None or cursor >= start):
+                i = bisect_right(self.maxes, cursor)
+                if i < len(self.blocks):
+                    j = bisect_right(self.blocks[i], cursor)
+            else:
+                i = 0 if start is None else bisect_left(self.maxes, start)
+                if i < len(self.blocks):
+                    j = 0 if start is None else bisect_left(self.blocks[i], start)
+            # One more than asked, to know if there is a next page
+            while i < len(self.blocks) and len(keys) <= limit:
+                block: list[str] = self.blocks[i]
+                keys.extend(block[j : j + limit + 1 - len(keys)])
+                i += 1
+                j = 0
+        if stop is not None:
+            keys = keys[:bisect_left(keys, stop)]
+        if len(keys) <= limit:
+            return (keys, None)
+        del keys[limit:]
+        return (keys, keys[-1])
+
+    def prefix(
+            self,
+            prefix: str,
+            cursor: Optional[str] = None,
+            limit: int = 100,
+            ) -> Page:
+        """
+        Como `scan`, com as chaves que começam com `prefix`.
+        """
+        return self.scan(prefix, KeyIndex.prefix_end(prefix), cursor, limit)
+
+    @staticmethod
+    def prefix_end(prefix: str) -> Optional[str]:
+        """
+        A menor string depois de todas as que começam com `prefix`.
+        """
+        while len(prefix) > 0 and ord(prefix[-1]) == 0x10FFFF:
+            prefix = prefix[:-1]
+        if len(prefix) == 0:
+            return None
+        return prefix[:-1] + chr(ord(prefix[-1]) + 1)
+
+    @staticmethod
+    def merge(pages: list[Page], limit: int) -> Page:
+        """
+        Junta as páginas de vários índices (cada servidor de um
+        cluster) numa só, pedidas com o mesmo `cursor` e `limit`.
+        """
+        keys: list[str] = list(merge(*( page_keys for page_keys, _ in pages )))
+        more: bool = any( cursor is not None for _, cursor in pages )
+        if len(keys) > limit:
+            del keys[limit:]
+            more = True
+        if not more or len(keys) == 0:
+            return (keys, None)
+        return (keys, keys[-1])
@@ -0,0 +1,185 @@
+from __future__ import annotations
+
+from typing import Callable, Optional
+from collections import deque
+
+import threading
+
+from protocol import Response
+
+class Tracker:
+    """
+    Uma conexão que pode pedir o `Request.Track`.
+
+    As chaves a avisar esperam em `pending` (ou `everything`, depois
+    de um `load`) e saem juntas, num só `Response.Invalidate`, por uma
+    thread só desta conexão (`sender`), pois `send` bloqueia até o
+    cliente receber os bytes. Um cliente que para de ler só atrasa os
+    próprios avisos, até `MAX_PENDING` chaves. `close` derruba a
+    conexão; as duas são chamadas de outra thread enquanto a conexão
+    atende suas requisições.
+    """
+    MAX_PENDING = 16 * 1024
+
+    send: Callable[[bytes], None]
+    close: Callable[[], None]
+    enabled: bool
+    # Of the `Request.Track`, used for the notices too
+    version: int
+    # Keys registered in `Tracking.readers`, some maybe already gone
+    keys: set[str]
+    pending: set[str]
+    everything: bool
+    wakeup: threading.Condition
+    sender: Optional[threading.Thread]
+
+    def __init__(
+            self,
+            send: Callable[[bytes], None],
+            close: Callable[[], None],
+            ) -> None:
+        self.send = send
+        self.close = close
+        self.enabled = False
+        self.version = 1
+        self.keys = set()
+        self.pending = set()
+        self.everything = False
+        self.wakeup = threading.Condition()
+        self.sender = None
+
+    def push(self, keys: Optional[list[str]]) -> bool:
+        """
+        Retorna `False`, sem enfileirar, se passaria de `MAX_PENDING`
+        chaves. `None` é tudo.
+        """
+        with self.wakeup:
+            if keys is None:
+                self.everything = True
+                self.pending.clear()
+            elif not self.everything:
+                if len(self.pending) + len(keys) > Tracker.MAX_PENDING:
+                    return False
+                self.pending.update(keys)
+            self.wakeup.notify()
+            return True
+
+    def start(self) -> None:
+        with self.wakeup:
+            if self.sender is None:
+                self.sender = threading.Thread(target=self.send_loop, daemon=True)
+                self.sender.start()
+
+    def stop(self) -> None:
+        """
+        Descarta os avisos pendentes e encerra `sender`.
+        """
+        with self.wakeup:
+            self.pending.clear()
+            self.everything = False
+            self.sender = None
+            self.wakeup.notify()
+
+    def send_loop(self) -> None:
+        me: threading.Thread = threading.current_thread()
+        while True:
+            with self.wakeup:
+                while len(self.pending) == 0 and not self.everything \
+                        and self.sender is me:
+                    self.wakeup.wait()
+                if self.sender is not me:
+                    return
+                invalidate: Response.Invalidate = Response.Invalidate(
+                    keys = None if self.everything else list(self.pending),
+                )
+                self.pending = set()
+                self.everything = False
+                version: int = self.version
+            try:
+                self.send(bytes(Response(invalidate, version=version).encode()))
+            except (OSError, RuntimeError):
+                # The connection is going away (or its event loop is
+                # closed), and disables itself
+                return
+
+class Tracking:
+    """
+    Quem leu cada chave, entre as conexões com `Request.Track`.
+
+    Recebe as mutações do `Process` (é uma das `feeds`) e avisa cada
+    conexão que leu a chave, com um `Response.Invalidate`, uma única
+    vez: depois do aviso, a conexão precisa ler de novo para voltar a
+    ser avisada.
+
+    Os avisos saem pela thread de cada `Tracker` (os pendentes vão
+    juntos), então quem altera o dicionário nunca espera um cliente
+    lento. Por isso um aviso pode
+    chegar antes da resposta de uma leitura em andamento, e o cliente
+    não deve guardar em cache uma leitura invalidada enquanto esperava
+    por ela. Quando as chaves pendentes de uma conexão passariam de
+    `Tracker.MAX_PENDING`, ela deixa de ser acompanhada e é fechada:
+    sem a conexão, o cliente descarta o cache.
+    """
+    lock: threading.Lock
+    readers: dict[str, set[Tracker]]
+    trackers: set[Tracker]
+
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.readers = dict()
+        self.trackers = set()
+
+    def enable(self, tracker: Tracker, version: int = 1) -> None:
+        with self.lock:
+            tracker.enabled = True
+            tracker.version = version
+            self.trackers.add(tracker)
+        tracker.start()
+
+    def disable(self, tracker: Tracker) -> None:
+        with self.lock:
+            if not tracker.enabled:
+                return
+            tracker.enabled = False
+            self.trackers.discard(tracker)
+            for key in tracker.keys:
+                readers: Optional[set[Tracker]] = self.readers.get(key)
+                if readers is not None:
+                    readers.discard(tracker)
+                    if len(readers) == 0:
+                        del self.readers[key]
+            tracker.keys.clear()
+        tracker.stop()
+
+    def track(self, tracker: Tracker, key: str) -> None:
+        """
+        Precisa da trava de leitura de `key`, e antes de ler o valor:
+        uma mutação depois disso sempre gera o aviso.
+        """
+        with self.lock:
+            if tracker.enabled:
+                self.readers.setdefault(key, set()).add(tracker)
+                tracker.keys.add(key)
+
+    def record(self, record: list[str]) -> None:
+        if len(self.trackers) == 0:
+            return
+        targets: list[Tracker]
+        keys: Optional[list[str]]
+        with self.lock:
+            if record[0] == 'l':
+                targets = list(self.trackers)
+                self.readers.clear()
+                for tracker in targets:
+                    tracker.keys.clear()
+                keys = None
+            else:
+                targets = list(self.readers.pop(record[1], ()))
+                for tracker in targets:
+                    tracker.keys.discard(record[1])
+                keys = [record[1]]
+        for tracker in targets:
+            if not tracker.push(keys):
+                # Too far behind to be told what changed
+                self.disable(tracker)
+                tracker.close()
@@ -0,0 +1,459 @@
+from __future__ import annotations
+
+from typing import Callable, Optional, Tuple, Union
+from dataclasses import dataclass, field
+
+import multiprocessing
+import multiprocessing.connection
+import tempfile
+import threading
+import socket
+import select
+import shutil
+import sys
+import os
+
+from cli import AdminCli, ParsedCommand
+from client import Connection, Shard, ShardedClient
+from hashring import HashRing
+from persistencia import Dic, Persistencia, SnapshotFormat
+from protocol import VERSION, Compression, Compressor, FrameReader, ProtocolError
+from protocol import Request, RequestInner
+from protocol import Response
+from indice import Page
+from server import HOST, Options, SharedDict
+from server import close_shared, handle_request, is_mutation, run_admin, run_thread
+from server import print_pages, scan_bound
+
+# Pipelined requests routed together, at most
+MAX_BATCH = 256
+
+def log(s: str) -> None:
+    print(s, file=sys.stderr)
+
+def partition_file(dict_file: str, name: str, count: int) -> str:
+    return f'{dict_file}.{name}-of-{count}'
+
+def split_partitions(dict_file: str, ring: HashRing, options: Options) -> None:
+    """
+    Na primeira vez com `len(ring.nodes)` processos, divide o
+    `dict_file` entre os arquivos das partições.
+    Depois disso, cada processo só carrega e salva a sua partição.
+    """
+    count: int = len(ring.nodes)
+    missing: list[str] = [
+        name for name in ring.nodes
+        if not os.path.exists(partition_file(dict_file, name, count))
+    ]
+    if len(missing) == 0 or not os.path.exists(dict_file):
+        return
+    log(f"Splitting '{dict_file}' into {count} partitions...")
+    loaded: Dic
+    if options.durability is None:
+        loaded = Persistencia.load(dict_file)
+    else:
+        loaded = Persistencia.load_logged(dict_file)
+    parts: dict[str, dict[str, list[str]]] = \
+        { name: dict() for name in missing }
+    for key, vals in loaded.items():
+        part: Optional[dict[str, list[str]]] = parts.get(ring.node_of(key))
+        if part is not None:
+            part[key] = vals
+    format: SnapshotFormat = options.snapshot_format \
+        or SnapshotFormat.of_file(dict_file) or SnapshotFormat.JSON
+    for name, part in parts.items():
+        Persistencia.store(
+            partition_file(dict_file, name, count), part, format=format,
+        )
+
+@dataclass(eq=False, slots=True)
+class LocalShard:
+    """
+    A partição do próprio processo, atendida sem passar por socket.
+    """
+    shared_mut: SharedDict
+
+    def pipeline(self, requests: list[RequestInner]) -> list[Response]:
+        responses: list[Response] = []
+        durable_point: int = 0
+        for inner in requests:
+            request: Request = Request(inner)
+            responses.append(handle_request(self.shared_mut, request))
+            if is_mutation(request):
+                durable_point = self.shared_mut.process.durable_point()
+        self.shared_mut.process.wait_durable(durable_point)
+        return responses
+
+    def close(self) -> None:
+        pass
+
+@dataclass(eq=False, slots=True)
+class PeerPool:
+    """
+    Conexões com a partição de outro processo, pelo socket Unix em
+    `path`, compartilhadas pelas conexões dos clientes.
+    Cada `pipeline` usa uma conexão livre, ou abre mais uma,
+    e a devolve no fim: são só tantas quantas usadas ao mesmo tempo.
+    """
+    path: str
+    lock: threading.Lock = field(default_factory=threading.Lock)
+    idle: list[Connection] = field(default_factory=list)
+    closed: bool = False
+
+    def acquire(self) -> Connection:
+        with self.lock:
+            if self.closed:
+                raise ConnectionAbortedError('Peer pool closed')
+            if len(self.idle) > 0:
+                return self.idle.pop()
+        sock: socket.socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        conn: Connection = Connection.of(sock)
+        try:
+            sock.connect(self.path)
+            return conn.negotiate()
+        except BaseException:
+            conn.close()
+            raise
+
+    def release(self, conn: Connection) -> None:
+        with self.lock:
+            if not self.closed:
+                self.idle.append(conn)
+                return
+        conn.close()
+
+    def pipeline(self, requests: list[RequestInner]) -> list[Response]:
+        conn: Connection = self.acquire()
+        try:
+            responses: list[Response] = conn.pipeline(requests)
+        except BaseException:
+            # It may be in the middle of a frame
+            conn.close()
+            raise
+        self.release(conn)
+        return responses
+
+    def close(self) -> None:
+        with self.lock:
+            self.closed = True
+            idle: list[Connection] = self.idle
+            self.idle = []
+        for conn in idle:
+            conn.close()
+
+@dataclass(eq=False)
+class Worker:
+    """
+    Um dos processos do servidor.
+    Todos escutam na mesma porta (`SO_REUSEPORT`), e o kernel distribui
+    as conexões entre eles; mas cada um só guarda as chaves da sua
+    partição no `ring`.
+    O que é de outra partição vai para o dono por um socket Unix
+    (`peer_path`), no mesmo protocolo dos clientes, como faz o
+    `ShardedClient` com vários servidores; o `router` e as suas
+    conexões são os mesmos para todos os clientes do processo.
+    """
+    name: str
+    ring: HashRing
+    sock_dir: str
+    tcp: socket.socket
+    unix: socket.socket
+    control: multiprocessing.connection.Connection
+    idle_timeout: Optional[float]
+    # What the fork copied from the parent but belongs to the others
+    inherited: list[Union[socket.socket, multiprocessing.connection.Connection]]
+    all_threads: list[threading.Thread] = field(default_factory=list)
+    router: Optional[ShardedClient] = None
+
+    @staticmethod
+    def peer_path(sock_dir: str, name: str) -> str:
+        return os.path.join(sock_dir, f'{name}.sock')
+
+    def make_router(self, shared_mut: SharedDict) -> ShardedClient:
+        """
+        Sem conectar ainda: cada `PeerPool` abre as conexões
+        conforme precisar.
+        """
+        conns: dict[str, Shard] = dict()
+        for name in self.ring.nodes:
+            if name == self.name:
+                conns[name] = LocalShard(shared_mut)
+            else:
+                conns[name] = PeerPool(Worker.peer_path(self.sock_dir, name))
+        return ShardedClient(self.ring, conns)
+
+    @staticmethod
+    def answer_locally(shared_mut: SharedDict, request: Request) -> Response:
+        """
+        Requisições da conexão, e não de uma partição.
+        """
+        if isinstance(request.inner, Request.Hello):
+            return Response(Response.Hello(
+                version = min(request.inner.version, VERSION),
+            ))
+        if isinstance(request.inner, Request.Compress):
+            return handle_request(shared_mut, request)
+        # Mutations of other partitions are not seen here,
+        # so there is no tracking for client caches
+        assert isinstance(request.inner, Request.Track)
+        return Response(Response.Tracking(enabled=False))
+
+    def run_conn(
+            self,
+            shared_mut: SharedDict,
+            sock_addr: Tuple[socket.socket, str],
+            ) -> None:
+        sock: socket.socket = sock_addr[0]
+        addr: str = sock_addr[1][0] + ' : ' + str(sock_addr[1][1])
+        log(f"Client connected to {self.name}: {addr} ...")
+        reader: FrameReader = FrameReader(sock)
+        assert self.router is not None
+        router: ShardedClient = self.router
+        # Set by a `Request.Compress`
+        compressor: Optional[Compressor] = None
+        try:
+            while True:
+                # Compressed frames only with the method negotiated here
+                accept: Optional[Compression] = \
+                    None if compressor is None else compressor.method
+                request: Optional[Request] = Request.read(reader, accept)
+                if request is None:
+                    break
+                batch: list[Request] = [request]
+                # Pipelined requests already in the buffer are routed
+                # together: one round trip to each partition
+                while len(batch) < MAX_BATCH:
+                    request = reader.read_buffered(Request.parser(accept))
+                    if request is None:
+                        break
+                    batch.append(request)
+                    if isinstance(request.inner, Request.Compress):
+                        # The frames after it may use the new method
+                        break
+                log(f"Received {len(batch)} requests from {addr}")
+                routed: list[Request] = [
+                    r for r in batch
+                    if not isinstance(
+                        r.inner, (Request.Track, Request.Hello, Request.Compress),
+                    )
+                ]
+                responses: list[Response] = \
+                    router.pipeline([ r.inner for r in routed ])
+                answers: dict[int, Response] = {
+                    id(request): response
+                    for request, response in zip(routed, responses)
+                }
+                out: bytearray = bytearray()
+                for request in batch:
+                    if request.packed is not None:
+                        shared_mut.wire.received(*request.packed)
+                    response = answers.get(id(request)) \
+                        or Worker.answer_locally(shared_mut, request)
+                    Response(
+                        response.inner, request.req_id, request.version,
+                    ).encode(out, compressor)
+                    if isinstance(request.inner, Request.Compress):
+                        compressor = shared_mut.compressor(request.inner.methods)
+                sock.sendall(out)
+                log(f"Response sent to {addr}")
+        except TimeoutError:
+            log(f"Client idle for too long: {addr} ...")
+        except ConnectionError:
+            pass
+        except ProtocolError as e:
+            log(f"Protocol error from {addr}: {e}")
+        except OSError as e:
+            log(f"Partitions unreachable, dropping: {addr} ({e})")
+        finally:
+            sock.close()
+        log(f"Client disconnected: {addr} ...")
+
+    def spawn(self, target: Callable[..., None], *args: object) -> None:
+        self.all_threads = [ t for t in self.all_threads if t.is_alive() ]
+        thread: threading.Thread = \
+            threading.Thread(target=target, args=args)
+        thread.start()
+        self.all_threads.append(thread)
+
+    def run(self, dict_file: str, options: Options) -> None:
+        """
+        Corpo do processo filho.
+        Os comandos do admin chegam pelo `control`, já lidos pelo pai,
+        que espera a resposta antes de mostrar o próximo prompt.
+        """
+        for other in self.inherited:
+            other.close()
+        count: int = len(self.ring.nodes)
+        shared_mut: SharedDict = SharedDict.from_file(
+            partition_file(dict_file, self.name, count), options,
+        )
+        self.router = self.make_router(shared_mut)
+        log(f"Partition {self.name} ready ({len(shared_mut.process.dic.dic)} keys)")
+        stop: bool = False
+        ins: list[Union[socket.socket, multiprocessing.connection.Connection]] = \
+            [self.control, self.tcp, self.unix]
+        try:
+            while not stop:
+                read, _write, _exeption = select.select(ins, [], [])
+                for inp in read:
+                    if inp == self.control:
+                        try:
+                            parsed: Optional[ParsedCommand] = \
+                                self.control.recv()
+                        except EOFError:
+                            parsed = ParsedCommand('exit', [])
+                        stop = run_admin(shared_mut, parsed, sys.stdout)
+                        sys.stdout.flush()
+                        if not stop:
+                            self.control.send(None)
+                    elif inp == self.tcp:
+                        sock_addr: Tuple[socket.socket, str] = \
+                            self.tcp.accept()
+                        sock_addr[0].settimeout(self.idle_timeout)
+                        self.spawn(self.run_conn, shared_mut, sock_addr)
+                    elif inp == self.unix:
+                        peer, _ = self.unix.accept()
+                        self.spawn(
+                            run_thread, shared_mut, (peer, ('peer', self.name)),
+                        )
+                    else:
+                        assert False, 'unreachable'
+        finally:
+            self.tcp.close()
+            self.unix.close()
+            # The other workers only stop serving our links once closed
+            self.router.close()
+            for t in self.all_threads:
+                t.join()
+            close_shared(shared_mut)
+            self.control.close()
+
+def listen_tcp(port: int) -> socket.socket:
+    sock: socket.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    # Each worker has its own socket on the same port; the kernel
+    # spreads the new connections among them
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind((HOST, port))
+    sock.listen(64)
+    return sock
+
+def listen_unix(path: str) -> socket.socket:
+    sock: socket.socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.bind(path)
+    sock.listen(64)
+    return sock
+
+def run_processes(dict_file: str, options: Options) -> int:
+    """
+    O pai só lê os comandos do admin e os manda para o processo dono
+    da chave (ou para todos, em `load` e `store`).
+    `scan` e `prefix` o pai faz como um cliente, pelos sockets Unix,
+    para juntar as chaves de todas as partições em ordem.
+    """
+    count: int = options.processes or os.cpu_count() or 1
+    assert count > 0
+    ring: HashRing = HashRing([ str(i) for i in range(count) ])
+    split_partitions(dict_file, ring, options)
+    sock_dir: str = tempfile.mkdtemp(prefix='hdd-')
+    # Every socket exists before any worker starts, so a worker never
+    # forwards to a partition that is not listening yet
+    listeners: list[Tuple[socket.socket, socket.socket]] = [
+        (listen_tcp(options.port), listen_unix(Worker.peer_path(sock_dir, name)))
+        for name in ring.nodes
+    ]
+    context = multiprocessing.get_context('fork')
+    controls: dict[str, multiprocessing.connection.Connection] = dict()
+    processes: list[multiprocessing.process.BaseProcess] = []
+    for name, (tcp, unix) in zip(ring.nodes, listeners):
+        parent_end, child_end = context.Pipe()
+        worker: Worker = Worker(
+            name, ring, sock_dir, tcp, unix, child_end, options.idle_timeout,
+            [ s for pair in listeners for s in pair if s not in (tcp, unix) ]
+                + list(controls.values()),
+        )
+        process: multiprocessing.process.BaseProcess = context.Process(
+            target=worker.run, args=(dict_file, options), name=f'worker-{name}',
+        )
+        process.start()
+        child_end.close()
+        controls[name] = parent_end
+        processes.append(process)
+    for tcp, unix in listeners:
+        tcp.close()
+        unix.close()
+
+    def send(name: str, parsed: ParsedCommand) -> None:
+        controls[name].send(parsed)
+        if parsed.cmd_name != 'exit':
+            # Its output is printed before the next prompt
+            controls[name].recv()
+
+    def print_keys(parsed: ParsedCommand) -> None:
+        conns: dict[str, Shard] = dict()
+        try:
+            for name in ring.nodes:
+                sock: socket.socket = \
+                    socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                conn: Connection = Connection.of(sock)
+                conns[name] = conn
+                sock.connect(Worker.peer_path(sock_dir, name))
+                conn.negotiate()
+            router: ShardedClient = ShardedClient(ring, conns)
+
+            def next_page(cursor: Optional[str]) -> Page:
+                inner: RequestInner
+                if parsed.cmd_name == 'scan':
+                    inner = Request.Scan(
+                        start = scan_bound(parsed.args[0]),
+                        stop = scan_bound(parsed.args[1]),
+                        cursor = cursor,
+                    )
+                else:
+                    inner = Request.Prefix(prefix=parsed.args[0], cursor=cursor)
+                response: Optional[Response] = router.request(inner)
+                assert response is not None
+                assert isinstance(response.inner, Response.Keys)
+                return (response.inner.keys, response.inner.cursor)
+
+            print_pages(next_page, sys.stdout)
+        except OSError as e:
+            print(f"=> Partitions unreachable: {e}")
+        finally:
+            for shard in conns.values():
+                shard.close()
+
+    log(f"Running on port {options.port} ({count} processes)...")
+    AdminCli.help(sys.stdout)
+    try:
+        while True:
+            parsed: Optional[ParsedCommand] = \
+                AdminCli.command(sys.stdin, sys.stdout)
+            if parsed is None:
+                pass
+            elif parsed.cmd_name in ('append', 'read', 'remove'):
+                send(ring.node_of(parsed.args[0]), parsed)
+            elif parsed.cmd_name in (
+                    'load', 'store', 'replication', 'cache', 'compression'):
+                for name in ring.nodes:
+                    send(name, parsed)
+            elif parsed.cmd_name in ('scan', 'prefix'):
+                print_keys(parsed)
+            elif parsed.cmd_name == 'help':
+                AdminCli.help(sys.stdout)
+            elif parsed.cmd_name == 'exit':
+                break
+            else:
+                assert False, f"Unhandled command: '{parsed.cmd_name}'"
+    finally:
+        log(f"Stopping workers...")
+        for name in ring.nodes:
+            try:
+                send(name, ParsedCommand('exit', []))
+            except OSError:
+                pass
+        for process in processes:
+            process.join()
+        shutil.rmtree(sock_dir, ignore_errors=True)
+        log(f"Exiting...")
+    return 0
@@ -1,10 +1,44 @@
+from __future__ import annotations
+
+from typing import Callable, MutableMapping, NoReturn, Optional, TextIO
+from enum import Enum
+
+import threading
 import json
+import time
 import os
 
+from binario import Binario, BinSnapshot
+from dicionario import LazyDict
+
+Dic = MutableMapping[str, list[str]]
+
+class SnapshotFormat(Enum):
+    """
+    Formato do arquivo do snapshot:
+      * `JSON`: um objeto JSON, lido inteiro na carga
+      * `BINARY`: ver `Binario`; mapeado em memória na carga e
+        decodificado aos poucos (`LazyDict`)
+    `load` reconhece os dois.
+    """
+    JSON   = 'json'
+    BINARY = 'binary'
+
+    @staticmethod
+    def of_file(filename: str) -> Optional[SnapshotFormat]:
+        if not os.path.exists(filename):
+            return None
+        elif Binario.is_binary(filename):
+            return SnapshotFormat.BINARY
+        else:
+            return SnapshotFormat.JSON
+
 class Persistencia:
     @staticmethod
-    def load(filename: str) -> dict[str, list[str]]:
-        if os.path.exists(filename):
+    def load(filename: str) -> Dic:
+        if SnapshotFormat.of_file(filename) == SnapshotFormat.BINARY:
+            return LazyDict(BinSnapshot(filename))
+        elif os.path.exists(filename):
             with open(filename, 'r') as file:
                 dic: dict[str, list[str]] = json.loads(file.read())
                 assert type(dic) is dict
@@ -13,6 +47,474 @@ class Persistencia:
             return dict()
 
     @staticmethod
-    def store(filename: str, dic: dict[str, list[str]]) -> None:
-        with open(filename, 'w') as file:
-            file.write(json.dumps(dic))
+    def store(
+            filename: str,
+            dic: Dic,
+            progress: Optional[Callable[[int], None]] = None,
+            format: SnapshotFormat = SnapshotFormat.JSON,
+            ) -> None:
+        """
+        Com `progress`, escreve uma chave por vez e avisa quantas
+        já foram escritas (a cada 1% do dicionário).
+        Em JSON, o arquivo é o mesmo de `json.dumps(dic)`.
+        """
+        tmp: str = filename + '.tmp'
+        if format == SnapshotFormat.BINARY:
+            with open(tmp, 'wb') as bin_file:
+                Binario.write(bin_file, dic, progress)
+                bin_file.flush()
+                os.fsync(bin_file.fileno())
+            os.replace(tmp, filename)
+            return
+        with open(tmp, 'w') as file:
+            if progress is None and type(dic) is dict:
+                file.write(json.dumps(dic))
+            else:
+                step: int = max(1, len(dic) // 100)
+                file.write('{')
+                for i, (key, vals) in enumerate(dic.items()):
+                    if i > 0:
+                        file.write(', ')
+                    file.write(json.dumps(key))
+                    file.write(': ')
+                    file.write(json.dumps(vals))
+                    if progress is not None and (i + 1) % step == 0:
+                        progress(i + 1)
+                file.write('}')
+                if progress is not None:
+                    progress(len(dic))
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(tmp, filename)
+
+    @staticmethod
+    def load_logged(filename: str) -> Dic:
+        """
+        Carrega o snapshot e reaplica o log por cima.
+        Termina um `checkpoint` interrompido, se for o caso.
+        """
+        paths: LogPaths = LogPaths(filename)
+        if os.path.exists(paths.next):
+            if os.path.exists(paths.old):
+                # Crashed before the new snapshot was committed
+                os.remove(paths.next)
+            else:
+                os.replace(paths.next, paths.snapshot)
+        dic: Dic = Persistencia.load(paths.snapshot)
+        Log.replay(paths.old, dic)
+        Log.replay(paths.log, dic)
+        return dic
+
+    @staticmethod
+    def checkpoint(
+            filename: str,
+            dic: Dic,
+            log: Log,
+            format: SnapshotFormat = SnapshotFormat.JSON,
+            ) -> None:
+        """
+        Escreve um snapshot novo e descarta o log que ele já contém.
+        Ninguém pode alterar `dic` durante a chamada.
+
+        O ponto de commit é a remoção do log antigo:
+        antes disso, o snapshot antigo com os logs ainda valem.
+        """
+        paths: LogPaths = LogPaths(filename)
+        log.rotate()
+        Persistencia.store(paths.next, dic, format=format)
+        Persistencia.commit_checkpoint(filename)
+
+    @staticmethod
+    def commit_checkpoint(filename: str) -> None:
+        paths: LogPaths = LogPaths(filename)
+        os.remove(paths.old)
+        os.replace(paths.next, paths.snapshot)
+
+class LogPaths:
+    snapshot: str
+    next: str
+    log: str
+    old: str
+
+    def __init__(self, filename: str) -> None:
+        self.snapshot = filename
+        self.next = filename + '.next'
+        self.log = filename + '.log'
+        self.old = filename + '.log.old'
+
+class Durability(Enum):
+    """
+    Quando um registro do log é considerado durável:
+      * `NONE`: escrito para o sistema operacional, sem `fsync`
+      * `BATCHED`: `fsync` de vários registros de uma vez (group commit),
+        a cada `batch_window` segundos ou `batch_bytes` bytes
+      * `PER_WRITE`: `fsync` a cada registro
+    """
+    NONE      = 'none'
+    BATCHED   = 'batched'
+    PER_WRITE = 'per-write'
+
+class Log:
+    """
+    Log append-only das mutações, um registro JSON por linha:
+      * `["a", key, val]` para `append`
+      * `["r", key]` para `remove`
+    O custo de cada escrita não depende do tamanho do dicionário.
+
+    Cada registro recebe um número de sequência (`lsn`);
+    `wait_durable(lsn)` espera até ele estar no disco.
+    """
+    paths: LogPaths
+    durability: Durability
+    batch_window: float
+    batch_bytes: int
+    # Held while touching the file; always taken before `lock`
+    io_lock: threading.Lock
+    lock: threading.Lock
+    cond: threading.Condition
+    file: TextIO
+    pending: list[str]
+    pending_bytes: int
+    last_lsn: int
+    durable_lsn: int
+    closed: bool
+    flusher: Optional[threading.Thread]
+
+    def __init__(
+            self,
+            filename: str,
+            durability: Durability = Durability.NONE,
+            batch_window: float = 0.002,
+            batch_bytes: int = 1024 * 1024,
+            ) -> None:
+        self.paths = LogPaths(filename)
+        self.durability = durability
+        self.batch_window = batch_window
+        self.batch_bytes = batch_bytes
+        self.io_lock = threading.Lock()
+        self.lock = threading.Lock()
+        self.cond = threading.Condition(self.lock)
+        Log.drop_torn_tail(self.paths.log)
+        self.file = open(self.paths.log, 'a', encoding='utf-8')
+        self.pending = []
+        self.pending_bytes = 0
+        self.last_lsn = 0
+        self.durable_lsn = 0
+        self.closed = False
+        self.flusher = None
+        if durability == Durability.BATCHED:
+            self.flusher = threading.Thread(target=self.flush_loop, daemon=True)
+            self.flusher.start()
+
+    def write(self, record: list[str]) -> int:
+        line: str = json.dumps(record) + '\n'
+        if self.durability == Durability.BATCHED:
+            with self.lock:
+                assert not self.closed
+                self.last_lsn += 1
+                self.pending.append(line)
+                self.pending_bytes += len(line)
+                if len(self.pending) == 1 \
+                        or self.pending_bytes >= self.batch_bytes:
+                    self.cond.notify_all()
+                return self.last_lsn
+        with self.io_lock:
+            self.file.write(line)
+            self.file.flush()
+            if self.durability == Durability.PER_WRITE:
+                os.fsync(self.file.fileno())
+            with self.lock:
+                self.last_lsn += 1
+                self.durable_lsn = self.last_lsn
+                return self.last_lsn
+
+    def append(self, key: str, val: str) -> int:
+        return self.write(['a', key, val])
+
+    def remove(self, key: str) -> int:
+        return self.write(['r', key])
+
+    def point(self) -> int:
+        """
+        O `lsn` do último registro escrito.
+        """
+        with self.lock:
+            return self.last_lsn
+
+    def is_durable(self, lsn: int) -> bool:
+        with self.lock:
+            return self.durable_lsn >= lsn
+
+    def wait_durable(self, lsn: int) -> None:
+        with self.lock:
+            while self.durable_lsn < lsn:
+                self.cond.wait()
+
+    def flush_pending(self) -> None:
+        """
+        Escreve os registros pendentes com um único `write` e `fsync`.
+        Precisa de `io_lock`.
+        """
+        with self.lock:
+            batch: list[str] = self.pending
+            upto: int = self.last_lsn
+            self.pending = []
+            self.pending_bytes = 0
+        if len(batch) > 0:
+            self.file.write(''.join(batch))
+            self.file.flush()
+            os.fsync(self.file.fileno())
+        with self.lock:
+            self.durable_lsn = max(self.durable_lsn, upto)
+            self.cond.notify_all()
+
+    def flush_loop(self) -> None:
+        while True:
+            with self.lock:
+                while len(self.pending) == 0 and not self.closed:
+                    self.cond.wait()
+                if len(self.pending) == 0:
+                    return
+                # Wait a little for more records to join the batch
+                self.cond.wait_for(
+                    lambda: self.closed
+                        or self.pending_bytes >= self.batch_bytes,
+                    timeout = self.batch_window,
+                )
+            with self.io_lock:
+                self.flush_pending()
+
+    def rotate(self) -> None:
+        """
+        Move o log atual para `.log.old` e começa um log vazio.
+        """
+        with self.io_lock:
+            self.flush_pending()
+            if os.path.exists(self.paths.old):
+                # The previous checkpoint failed: keep both logs
+                with open(self.paths.old, 'a', encoding='utf-8') as old, \
+                        open(self.paths.log, 'r', encoding='utf-8') as cur:
+                    old.write(cur.read())
+                self.file.close()
+                os.remove(self.paths.log)
+            else:
+                self.file.close()
+                os.replace(self.paths.log, self.paths.old)
+            self.file = open(self.paths.log, 'a', encoding='utf-8')
+
+    def close(self) -> None:
+        with self.lock:
+            self.closed = True
+            self.cond.notify_all()
+        if self.flusher is not None:
+            self.flusher.join()
+        with self.io_lock:
+            self.flush_pending()
+            self.file.close()
+
+    @staticmethod
+    def drop_torn_tail(path: str) -> None:
+        """
+        Corta um registro incompleto no fim do log (escrita interrompida),
+        para que o próximo registro não seja grudado nele.
+        """
+        if not os.path.exists(path):
+            return
+        with open(path, 'rb+') as file:
+            size: int = file.seek(0, os.SEEK_END)
+            end: int = size
+            while end > 0:
+                start: int = max(0, end - 4096)
+                file.seek(start)
+                chunk: bytes = file.read(end - start)
+                idx: int = chunk.rfind(b'\n')
+                if idx >= 0:
+                    end = start + idx + 1
+                    break
+                end = start
+            if end < size:
+                file.truncate(end)
+
+    @staticmethod
+    def replay(path: str, dic: Dic) -> None:
+        if not os.path.exists(path):
+            return
+        with open(path, 'r', encoding='utf-8') as file:
+            for line in file:
+                if not line.endswith('\n'):
+                    # Torn write at the end of the log
+                    break
+                record: list[str] = json.loads(line)
+                if record[0] == 'a':
+                    dic.setdefault(record[1], []).append(record[2])
+                elif record[0] == 'r':
+                    dic.pop(record[1], None)
+                else:
+                    assert False, f"Unknown log record: '{record}'"
+
+class Snapshot:
+    """
+    Snapshot escrito em segundo plano (como o `BGSAVE` do Redis).
+
+    `start` só tira a foto do dicionário: com `fork`, o processo filho
+    fica com uma cópia (copy-on-write) e escreve o arquivo; sem `fork`,
+    o dicionário é copiado e uma thread escreve a cópia.
+    Ninguém pode alterar `dic` durante `start`, mas logo depois
+    o dicionário já pode voltar a ser usado.
+
+    O arquivo só aparece no fim, com `os.replace`.
+    Com `log`, termina como um `checkpoint`.
+    """
+    filename: str
+    log: Optional[Log]
+    format: SnapshotFormat
+    total: int
+    done: int
+    # `None` while running
+    ok: Optional[bool]
+    started: float
+    finished: float
+    report: Optional[Callable[[Snapshot], None]]
+    report_interval: float
+    last_report: float
+    lock: threading.Lock
+    thread: threading.Thread
+
+    def __init__(
+            self,
+            filename: str,
+            log: Optional[Log],
+            format: SnapshotFormat,
+            total: int,
+            report: Optional[Callable[[Snapshot], None]],
+            report_interval: float,
+            ) -> None:
+        self.filename = filename
+        self.log = log
+        self.format = format
+        self.total = total
+        self.done = 0
+        self.ok = None
+        self.started = time.monotonic()
+        self.finished = self.started
+        self.report = report
+        self.report_interval = report_interval
+        self.last_report = self.started
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def start(
+            filename: str,
+            dic: Dic,
+            log: Optional[Log] = None,
+            report: Optional[Callable[[Snapshot], None]] = None,
+            report_interval: float = 1.0,
+            format: SnapshotFormat = SnapshotFormat.JSON,
+            ) -> Snapshot:
+        """
+        `report` é chamada (de outra thread) a cada `report_interval`
+        segundos enquanto o snapshot é escrito, e uma vez no fim.
+        """
+        snap: Snapshot = Snapshot(
+            filename, log, format, len(dic), report, report_interval,
+        )
+        if log is not None:
+            log.rotate()
+        if hasattr(os, 'fork'):
+            r, w = os.pipe()
+            pid: int = os.fork()
+            if pid == 0:
+                os.close(r)
+                Snapshot.run_child(snap.target(), dic, w, format)
+            os.close(w)
+            snap.thread = threading.Thread(
+                target=snap.wait_child, args=(pid, r),
+            )
+        else:
+            copy: dict[str, list[str]] = {
+                key: list(vals) for key, vals in dic.items()
+            }
+            snap.thread = threading.Thread(
+                target=snap.write_copy, args=(copy,),
+            )
+        snap.thread.start()
+        return snap
+
+    def target(self) -> str:
+        if self.log is None:
+            return self.filename
+        return LogPaths(self.filename).next
+
+    @staticmethod
+    def run_child(
+            target: str,
+            dic: Dic,
+            fd: int,
+            format: SnapshotFormat,
+            ) -> NoReturn:
+        # Only this thread exists in the child: no printing
+        # (another thread may have held the lock of `sys.stderr`)
+        def progress(done: int) -> None:
+            os.write(fd, f'{done}\n'.encode())
+
+        code: int = 1
+        try:
+            Persistencia.store(target, dic, progress, format)
+            code = 0
+        finally:
+            os._exit(code)
+
+    def wait_child(self, pid: int, fd: int) -> None:
+        with os.fdopen(fd, 'r') as pipe:
+            for line in pipe:
+                self.progress(int(line))
+        _, status = os.waitpid(pid, 0)
+        self.finish(os.waitstatus_to_exitcode(status) == 0)
+
+    def write_copy(self, copy: dict[str, list[str]]) -> None:
+        ok: bool = False
+        try:
+            Persistencia.store(self.target(), copy, self.progress, self.format)
+            ok = True
+        finally:
+            self.finish(ok)
+
+    def progress(self, done: int) -> None:
+        now: float = time.monotonic()
+        with self.lock:
+            self.done = done
+            if now - self.last_report < self.report_interval:
+                return
+            self.last_report = now
+        if self.report is not None:
+            self.report(self)
+
+    def finish(self, ok: bool) -> None:
+        if ok and self.log is not None:
+            try:
+                Persistencia.commit_checkpoint(self.filename)
+            except OSError:
+                ok = False
+        with self.lock:
+            self.ok = ok
+            self.finished = time.monotonic()
+        if self.report is not None:
+            self.report(self)
+
+    def running(self) -> bool:
+        with self.lock:
+            return self.ok is None
+
+    def wait(self) -> None:
+        self.thread.join()
+
+    def status(self) -> str:
+        with self.lock:
+            if self.ok is None:
+                ratio: float = self.done / self.total if self.total > 0 else 1.0
+                return f"in progress: {self.done}/{self.total} keys ({ratio:.0%})"
+            elif self.ok:
+                return f"done: {self.total} keys " \
+                    f"in {self.finished - self.started:.2f}s"
+            else:
+                return f"failed after {self.done}/{self.total} keys"
@@ -1,36 +1,198 @@
 from __future__ import annotations
 
-from dataclasses import dataclass, fields
+from typing import Callable, Optional, Tuple
+from dataclasses import dataclass, field, fields
 
-from persistencia import Persistencia
+from persistencia import Dic, Durability, Log, Persistencia, Snapshot, SnapshotFormat
 from dicionario import Dicionario
+from disco import Backend
+from indice import Page
 
 @dataclass(eq=False, kw_only=True, slots=True)
 class Process:
+    """
+    Sem `log`, o dicionário só vai para o disco com `store`.
+    Com `log`, cada mutação também é registrada nele, conforme a
+    sua `Durability`, e `store` vira um checkpoint.
+    Com `Backend.DISK`, os valores ficam num arquivo de trabalho,
+    com `cache_pages` páginas dele na memória.
+    Com `Backend.COMPACT`, os valores de cada chave ficam juntos
+    (`CompactDict`).
+    Cada mutação também é passada para as `feeds` (replicação,
+    invalidação de caches), no formato dos registros do `Log`;
+    depois de `load`, recebem `["l"]`: tudo pode ter mudado.
+    """
     dic: Dicionario
     filename: str
+    log: Optional[Log] = None
+    format: SnapshotFormat = SnapshotFormat.JSON
+    backend: Backend = Backend.MEMORY
+    cache_pages: int = 4096
+    snapshot: Optional[Snapshot] = None
+    feeds: list[Callable[[list[str]], None]] = field(default_factory=list)
 
     @staticmethod
-    def from_file(filename: str) -> Process:
-        dic = Dicionario(Persistencia.load(filename))
-        return Process(
-            dic = dic,
-            filename = filename
-        )
+    def from_file(
+            filename: str,
+            durability: Optional[Durability] = None,
+            batch_window: float = 0.002,
+            format: Optional[SnapshotFormat] = None,
+            backend: Backend = Backend.MEMORY,
+            cache_pages: int = 4096,
+            ) -> Process:
+        """
+        Sem `format`, os snapshots seguem o formato do arquivo existente
+        (sem arquivo, JSON; binário com `Backend.DISK`).
+        `Backend.DISK` não aceita um snapshot em JSON, que seria lido
+        inteiro na memória: tem que ser convertido antes (`binario.py`).
+        """
+        if backend == Backend.DISK:
+            assert SnapshotFormat.of_file(filename) != SnapshotFormat.JSON, \
+                f"JSON snapshot with the disk backend: '{filename}'"
+        if format is None:
+            format = SnapshotFormat.of_file(filename) or (
+                SnapshotFormat.BINARY if backend == Backend.DISK
+                else SnapshotFormat.JSON
+            )
+        if durability is None:
+            return Process(
+                dic = Dicionario(backend.open(
+                    filename, Persistencia.load(filename), cache_pages,
+                )),
+                filename = filename,
+                format = format,
+                backend = backend,
+                cache_pages = cache_pages,
+            )
+        else:
+            return Process(
+                dic = Dicionario(backend.open(
+                    filename, Persistencia.load_logged(filename), cache_pages,
+                )),
+                filename = filename,
+                log = Log(filename, durability, batch_window),
+                format = format,
+                backend = backend,
+                cache_pages = cache_pages,
+            )
 
     def load(self) -> None:
+        # A running snapshot still needs the files it started with
+        self.wait_snapshot()
+        Backend.close(self.dic.dic)
+        loaded: Dic
+        if self.log is None:
+            loaded = Persistencia.load(self.filename)
+        else:
+            # Batched records already acknowledged must be in the file
+            with self.log.io_lock:
+                self.log.flush_pending()
+            loaded = Persistencia.load_logged(self.filename)
         self.dic = Dicionario(
-            Persistencia.load(self.filename)
+            self.backend.open(self.filename, loaded, self.cache_pages)
         )
+        for feed in self.feeds:
+            feed(['l'])
 
     def store(self) -> None:
-        Persistencia.store(self.filename, self.dic.dic)
+        self.wait_snapshot()
+        if self.log is None:
+            Persistencia.store(
+                self.filename, self.dic.dic, format=self.format,
+            )
+        else:
+            Persistencia.checkpoint(
+                self.filename, self.dic.dic, self.log, self.format,
+            )
+
+    def store_background(
+            self,
+            report: Optional[Callable[[Snapshot], None]] = None,
+            ) -> Optional[Snapshot]:
+        """
+        Como `store`, mas escreve em segundo plano (ver `Snapshot`):
+        só precisa do dicionário parado durante a chamada.
+        Retorna `None` se já tem um snapshot em andamento.
+        """
+        if self.snapshot is not None and self.snapshot.running():
+            return None
+        self.snapshot = Snapshot.start(
+            self.filename, self.dic.dic, self.log, report,
+            format = self.format,
+        )
+        return self.snapshot
+
+    def wait_snapshot(self) -> None:
+        if self.snapshot is not None:
+            self.snapshot.wait()
 
     def append(self, key: str, val: str) -> bool:
-        return self.dic.append(key, val)
+        ret: bool = self.dic.append(key, val)
+        if self.log is not None:
+            self.log.append(key, val)
+        for feed in self.feeds:
+            feed(['a', key, val])
+        return ret
 
     def read(self, key: str) -> list[str]:
         return self.dic.read(key)
 
+    def read_range(
+            self,
+            key: str,
+            offset: int = 0,
+            limit: int = 100,
+            from_end: bool = False,
+            ) -> Tuple[int, list[str]]:
+        return self.dic.read_range(key, offset, limit, from_end)
+
+    def length(self, key: str) -> int:
+        return self.dic.length(key)
+
+    def scan(
+            self,
+            start: Optional[str] = None,
+            stop: Optional[str] = None,
+            cursor: Optional[str] = None,
+            limit: int = 100,
+            ) -> Page:
+        return self.dic.scan(start, stop, cursor, limit)
+
+    def prefix(
+            self,
+            prefix: str,
+            cursor: Optional[str] = None,
+            limit: int = 100,
+            ) -> Page:
+        return self.dic.prefix(prefix, cursor, limit)
+
     def remove(self, key: str) -> list[str]:
-        return self.dic.remove(key)
+        ret: list[str] = self.dic.remove(key)
+        if len(ret) > 0:
+            if self.log is not None:
+                self.log.remove(key)
+            for feed in self.feeds:
+                feed(['r', key])
+        return ret
+
+    def durable_point(self) -> int:
+        """
+        Depois de `wait_durable(durable_point())`, todas as mutações
+        feitas até aqui estão no disco (conforme a `Durability`).
+        """
+        if self.log is None:
+            return 0
+        return self.log.point()
+
+    def is_durable(self, point: int) -> bool:
+        return self.log is None or self.log.is_durable(point)
+
+    def wait_durable(self, point: int) -> None:
+        if self.log is not None:
+            self.log.wait_durable(point)
+
+    def close(self) -> None:
+        self.wait_snapshot()
+        Backend.close(self.dic.dic)
+        if self.log is not None:
+            self.log.close()
@@ -1,22 +1,64 @@
 from __future__ import annotations
 
-from typing import Optional, Union
+from typing import Callable, ClassVar, Iterator, Optional, Tuple, TypeAlias, TypeVar, Union
 from dataclasses import dataclass
 from enum import IntEnum
 
+import dataclasses
+import threading
+import asyncio
 import socket
+import zlib
+import lzma
 
 MAGIC: bytes = b'HDD'
+# Frames da v2 (tamanhos em varint, leituras em pedaços)
+MAGIC_V2: bytes = b'HD2'
+MAGICS: dict[bytes, int] = { MAGIC: 1, MAGIC_V2: 2 }
+# Última versão conhecida, combinada com o `Request.Hello`
+VERSION: int = 2
+BUF_SIZE: int = 64 * 1024
+# Bytes de valores em cada pedaço de uma `Response.Read` da v2
+CHUNK_SIZE: int = 32 * 1024
+# Ação com esse bit ligado carrega um id de requisição (u32)
+TAGGED: int = 0x80
+# Ação com esse bit ligado tem o corpo comprimido (`Compressor`);
+# os códigos das ações ficam abaixo dele
+COMPRESSED: int = 0x40
+# Bytes de corpo a partir dos quais vale a pena tentar comprimir
+COMPRESS_THRESHOLD: int = 1024
+# Maior corpo aceito depois de descomprimido
+MAX_FRAME_SIZE: int = 64 * 1024 * 1024
+
+T = TypeVar('T')
 
 class ReqAction(IntEnum):
-    READ   = 0x01
-    APPEND = 0x02
+    READ         = 0x01
+    APPEND       = 0x02
+    MULTI_READ   = 0x03
+    MULTI_APPEND = 0x04
+    TRACK        = 0x05
+    HELLO        = 0x06
+    SCAN         = 0x07
+    PREFIX       = 0x08
+    READ_RANGE   = 0x09
+    LENGTH       = 0x0A
+    COMPRESS     = 0x0B
 
     @staticmethod
     def all_actions() -> list[ReqAction]:
         return [
             ReqAction.READ,
             ReqAction.APPEND,
+            ReqAction.MULTI_READ,
+            ReqAction.MULTI_APPEND,
+            ReqAction.TRACK,
+            ReqAction.HELLO,
+            ReqAction.SCAN,
+            ReqAction.PREFIX,
+            ReqAction.READ_RANGE,
+            ReqAction.LENGTH,
+            ReqAction.COMPRESS,
         ]
 
     @staticmethod
@@ -32,6 +74,24 @@ class ReqAction(IntEnum):
             return b'\x01'
         elif self == ReqAction.APPEND:
             return b'\x02'
+        elif self == ReqAction.MULTI_READ:
+            return b'\x03'
+        elif self == ReqAction.MULTI_APPEND:
+            return b'\x04'
+        elif self == ReqAction.TRACK:
+            return b'\x05'
+        elif self == ReqAction.HELLO:
+            return b'\x06'
+        elif self == ReqAction.SCAN:
+            return b'\x07'
+        elif self == ReqAction.PREFIX:
+            return b'\x08'
+        elif self == ReqAction.READ_RANGE:
+            return b'\x09'
+        elif self == ReqAction.LENGTH:
+            return b'\x0A'
+        elif self == ReqAction.COMPRESS:
+            return b'\x0B'
         else:
             assert False, 'unreachable'
 
@@ -39,6 +99,17 @@ class RespAction(IntEnum):
     READ              = 0x01
     APPEND_NOT_EXISTS = 0x02
     APPEND_EXISTS     = 0x03
+    MULTI_READ        = 0x04
+    MULTI_APPEND      = 0x05
+    BUSY              = 0x06
+    READ_ONLY         = 0x07
+    TRACKING          = 0x08
+    INVALIDATE        = 0x09
+    HELLO             = 0x0A
+    KEYS              = 0x0B
+    READ_RANGE        = 0x0C
+    LENGTH            = 0x0D
+    COMPRESS          = 0x0E
 
     @staticmethod
     def all_actions() -> list[RespAction]:
@@ -46,6 +117,17 @@ class RespAction(IntEnum):
             RespAction.READ,
             RespAction.APPEND_NOT_EXISTS,
             RespAction.APPEND_EXISTS,
+            RespAction.MULTI_READ,
+            RespAction.MULTI_APPEND,
+            RespAction.BUSY,
+            RespAction.READ_ONLY,
+            RespAction.TRACKING,
+            RespAction.INVALIDATE,
+            RespAction.HELLO,
+            RespAction.KEYS,
+            RespAction.READ_RANGE,
+            RespAction.LENGTH,
+            RespAction.COMPRESS,
         ]
 
     @staticmethod
@@ -63,208 +145,1322 @@ class RespAction(IntEnum):
             return b'\x02'
         elif self == RespAction.APPEND_EXISTS:
             return b'\x03'
+        elif self == RespAction.MULTI_READ:
+            return b'\x04'
+        elif self == RespAction.MULTI_APPEND:
+            return b'\x05'
+        elif self == RespAction.BUSY:
+            return b'\x06'
+        elif self == RespAction.READ_ONLY:
+            return b'\x07'
+        elif self == RespAction.TRACKING:
+            return b'\x08'
+        elif self == RespAction.INVALIDATE:
+            return b'\x09'
+        elif self == RespAction.HELLO:
+            return b'\x0A'
+        elif self == RespAction.KEYS:
+            return b'\x0B'
+        elif self == RespAction.READ_RANGE:
+            return b'\x0C'
+        elif self == RespAction.LENGTH:
+            return b'\x0D'
+        elif self == RespAction.COMPRESS:
+            return b'\x0E'
         else:
             assert False, 'unreachable'
 
-class Common:
+class Compression(IntEnum):
+    NONE = 0x00
+    ZLIB = 0x01
+    LZMA = 0x02
+
+    @staticmethod
+    def from_name(name: str) -> Compression:
+        return Compression[name.strip().upper()]
+
     @staticmethod
-    def read_magic(sock: socket.socket) -> bool:
-        magic_left: int = 3
-        while magic_left > 0:
-            data: bytes = sock.recv(magic_left)
+    def methods() -> Tuple[Compression, ...]:
+        return (Compression.ZLIB, Compression.LZMA)
+
+    # Fast presets: it runs for every big frame, while the client waits
+    def compress(self, data: memoryview) -> bytes:
+        if self == Compression.ZLIB:
+            return zlib.compress(data, 1)
+        elif self == Compression.LZMA:
+            return lzma.compress(data, check=lzma.CHECK_NONE, preset=0)
+        else:
+            assert False, 'unreachable'
+
+    def decompress(self, data: memoryview, max_length: int) -> bytes:
+        """
+        No máximo `max_length` bytes: um corpo pequeno não pode
+        ocupar mais memória do que o frame diz ter.
+        """
+        if self == Compression.ZLIB:
+            return zlib.decompressobj().decompress(data, max_length)
+        elif self == Compression.LZMA:
+            return lzma.LZMADecompressor().decompress(
+                data, max_length=max_length,
+            )
+        else:
+            assert False, 'unreachable'
+
+class WireStats:
+    """
+    Quantos frames foram comprimidos, e os bytes dos seus corpos antes
+    (`raw`) e depois (`packed`, com o cabeçalho da compressão), em cada
+    sentido. `skipped` são os que passaram do limite mas não
+    encolheram, e foram sem compressão.
+    """
+    lock: threading.Lock
+    sent_frames: int
+    sent_raw: int
+    sent_packed: int
+    received_frames: int
+    received_raw: int
+    received_packed: int
+    skipped: int
+
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.sent_frames = 0
+        self.sent_raw = 0
+        self.sent_packed = 0
+        self.received_frames = 0
+        self.received_raw = 0
+        self.received_packed = 0
+        self.skipped = 0
+
+    def sent(self, raw: int, packed: int) -> None:
+        with self.lock:
+            self.sent_frames += 1
+            self.sent_raw += raw
+            self.sent_packed += packed
+
+    def received(self, raw: int, packed: int) -> None:
+        with self.lock:
+            self.received_frames += 1
+            self.received_raw += raw
+            self.received_packed += packed
+
+    def skip(self) -> None:
+        with self.lock:
+            self.skipped += 1
+
+    def status(self) -> str:
+        with self.lock:
+            lines: list[str] = []
+            for name, frames, raw, packed in (
+                    ('sent', self.sent_frames, self.sent_raw, self.sent_packed),
+                    ('received', self.received_frames,
+                        self.received_raw, self.received_packed),
+                    ):
+                ratio: float = packed / raw if raw > 0 else 1.0
+                lines.append(
+                    f"{name}: {frames} frames, {raw} bytes raw, "
+                    f"{packed} compressed ({ratio:.1%})"
+                )
+            lines.append(f"{self.skipped} frames did not shrink")
+            return '\n'.join(lines)
+
+@dataclass(eq=False, slots=True)
+class Compressor:
+    """
+    Comprime os frames que uma conexão envia, com o método combinado
+    no `Request.Compress`. Só o corpo (depois da ação e do id), de
+    frames com pelo menos `threshold` bytes nele, e só se encolher.
+
+    O frame comprimido tem a flag `COMPRESSED` na ação e, no lugar do
+    corpo, o método, o tamanho original e o corpo comprimido (com o
+    seu tamanho): quem recebe não precisa saber do combinado.
+    """
+    method: Compression
+    threshold: int = COMPRESS_THRESHOLD
+    stats: Optional[WireStats] = None
+
+    def pack(self, buf: bytearray, start: int = 0) -> None:
+        """
+        Comprime o frame que começa em `buf[start]`, já codificado,
+        no lugar. Tem que ser o último frame de `buf`.
+        """
+        if self.method == Compression.NONE:
+            return
+        version: int = MAGICS[bytes(buf[start:start + len(MAGIC)])]
+        action_at: int = start + len(MAGIC)
+        body_at: int = action_at + (5 if buf[action_at] & TAGGED else 1)
+        raw: int = len(buf) - body_at
+        if raw < self.threshold:
+            return
+        with memoryview(buf) as view, view[body_at:] as body:
+            packed: bytes = self.method.compress(body)
+        if len(packed) >= raw:
+            if self.stats is not None:
+                self.stats.skip()
+            return
+        del buf[body_at:]
+        buf[action_at] |= COMPRESSED
+        buf.append(self.method.value)
+        Common.write_count(buf, raw, version)
+        Common.write_count(buf, len(packed), version)
+        buf += packed
+        if self.stats is not None:
+            self.stats.sent(raw, len(buf) - body_at)
+
+class Incomplete(Exception):
+    """
+    O buffer ainda não contém um frame inteiro.
+    """
+    pass
+
+class ProtocolError(Exception):
+    """
+    O frame recebido não pode ser aceito; a conexão deve ser fechada.
+    """
+    pass
+
+@dataclass(eq=False, slots=True)
+class Cursor:
+    buf: memoryview
+    pos: int = 0
+
+    def take(self, n: int) -> memoryview:
+        end: int = self.pos + n
+        if end > len(self.buf):
+            raise Incomplete()
+        data: memoryview = self.buf[self.pos:end]
+        self.pos = end
+        return data
+
+    def take_byte(self) -> int:
+        if self.pos >= len(self.buf):
+            raise Incomplete()
+        b: int = self.buf[self.pos]
+        self.pos += 1
+        return b
+
+class FrameBuffer:
+    """
+    Acumula os bytes recebidos de uma conexão e extrai frames
+    inteiros da memória.
+    Bytes antes do `MAGIC` são descartados.
+    """
+    buf: bytearray
+    start: int
+    end: int
+
+    def __init__(self, size: int = BUF_SIZE) -> None:
+        self.buf = bytearray(size)
+        self.start = 0
+        self.end = 0
+
+    def pending(self) -> int:
+        return self.end - self.start
+
+    def sync_magic(self) -> None:
+        # Every version shares the first bytes of MAGIC
+        prefix: bytes = MAGIC[:-1]
+        while True:
+            idx: int = self.buf.find(prefix, self.start, self.end)
+            if idx < 0:
+                # Keep a possible partial MAGIC at the end
+                self.start = max(self.start, self.end - len(prefix) + 1)
+                return
+            last: int = idx + len(prefix)
+            if last >= self.end or bytes(self.buf[idx:last + 1]) in MAGICS:
+                self.start = idx
+                return
+            self.start = idx + 1
+
+    def parse(self, parse_fn: Callable[[Cursor], T]) -> Optional[T]:
+        self.sync_magic()
+        if self.pending() < len(MAGIC):
+            return None
+        with memoryview(self.buf) as view:
+            cur: Cursor = Cursor(view[self.start:self.end])
+            try:
+                frame: T = parse_fn(cur)
+            except Incomplete:
+                return None
+        self.start += cur.pos
+        return frame
+
+    def writable(self) -> memoryview:
+        if self.start == self.end:
+            self.start = 0
+            self.end = 0
+        elif self.end == len(self.buf):
+            data_len: int = self.pending()
+            if self.start == 0:
+                # A frame bigger than the buffer
+                new_buf: bytearray = bytearray(2 * len(self.buf))
+                new_buf[:data_len] = self.buf
+                self.buf = new_buf
+            else:
+                self.buf[:data_len] = self.buf[self.start:self.end]
+            self.start = 0
+            self.end = data_len
+        return memoryview(self.buf)[self.end:]
+
+    def commit(self, n: int) -> None:
+        assert 0 <= n and self.end + n <= len(self.buf)
+        self.end += n
+
+    def feed(self, data: bytes) -> None:
+        while len(data) > 0:
+            with self.writable() as free:
+                n: int = min(len(free), len(data))
+                free[:n] = data[:n]
+            self.commit(n)
+            data = data[n:]
+
+class FrameReader:
+    """
+    Lê frames de um socket em blocos grandes com `recv_into`,
+    em vez de um `recv` por campo.
+    """
+    sock: socket.socket
+    frames: FrameBuffer
+
+    def __init__(self, sock: socket.socket, size: int = BUF_SIZE) -> None:
+        self.sock = sock
+        self.frames = FrameBuffer(size)
+
+    def pending(self) -> int:
+        return self.frames.pending()
+
+    def read_buffered(self, parse_fn: Callable[[Cursor], T]) -> Optional[T]:
+        """
+        Como `read`, mas só olha o que já foi recebido (não bloqueia).
+        """
+        return self.frames.parse(parse_fn)
+
+    def read(self, parse_fn: Callable[[Cursor], T]) -> Optional[T]:
+        while True:
+            frame: Optional[T] = self.frames.parse(parse_fn)
+            if frame is not None:
+                return frame
+            with self.frames.writable() as free:
+                n: int = self.sock.recv_into(free)
+            if n == 0:
+                return None
+            self.frames.commit(n)
+
+class AsyncFrameReader:
+    """
+    O mesmo que `FrameReader`, mas lendo de um `asyncio.StreamReader`.
+    """
+    stream: asyncio.StreamReader
+    frames: FrameBuffer
+
+    def __init__(self, stream: asyncio.StreamReader, size: int = BUF_SIZE) -> None:
+        self.stream = stream
+        self.frames = FrameBuffer(size)
+
+    def pending(self) -> int:
+        return self.frames.pending()
+
+    def read_buffered(self, parse_fn: Callable[[Cursor], T]) -> Optional[T]:
+        return self.frames.parse(parse_fn)
+
+    async def read(self, parse_fn: Callable[[Cursor], T]) -> Optional[T]:
+        while True:
+            frame: Optional[T] = self.frames.parse(parse_fn)
+            if frame is not None:
+                return frame
+            data: bytes = await self.stream.read(BUF_SIZE)
             if len(data) == 0:
-                return False
-            for d in data:
-                if d == MAGIC[-magic_left]:
-                    magic_left -= 1
-                else:
-                    magic_left = 3
-        return True
+                return None
+            self.frames.feed(data)
 
+class Common:
     @staticmethod
-    def write_magic(sock: socket.socket) -> None:
-        sock.send(MAGIC)
+    def read_magic(cur: Cursor) -> int:
+        """
+        Retorna a versão do frame.
+        """
+        data: bytes = bytes(cur.take(len(MAGIC)))
+        version: Optional[int] = MAGICS.get(data)
+        assert version is not None, f"Unknown magic: {data!r}"
+        return version
 
     @staticmethod
-    def read_req_action(sock: socket.socket) -> ReqAction:
-        data: bytes = sock.recv(1)
-        assert len(data) == 1
-        return ReqAction.from_byte(data)
+    def write_magic(buf: bytearray, version: int = 1) -> None:
+        buf += MAGIC if version == 1 else MAGIC_V2
 
     @staticmethod
-    def write_req_action(sock: socket.socket, action: ReqAction) -> None:
-        data: bytes = action.to_byte()
-        sock.send(data)
+    def read_action_byte(cur: Cursor) -> Tuple[bytes, Optional[int], bool]:
+        """
+        Retorna o byte da ação (sem as flags `TAGGED` e `COMPRESSED`),
+        o id da requisição, se o frame tiver um, e se o corpo está
+        comprimido.
+        """
+        b: int = cur.take_byte()
+        compressed: bool = b & COMPRESSED != 0
+        action: bytes = bytes((b & ~(TAGGED | COMPRESSED),))
+        if b & TAGGED:
+            return (action, Common.read_u32(cur), compressed)
+        else:
+            return (action, None, compressed)
+
+    @staticmethod
+    def write_action_byte(buf: bytearray, b: int, req_id: Optional[int]) -> None:
+        if req_id is None:
+            buf.append(b)
+        else:
+            buf.append(b | TAGGED)
+            Common.write_u32(buf, req_id)
+
+    @staticmethod
+    def read_req_action(cur: Cursor) -> Tuple[ReqAction, Optional[int], bool]:
+        b, req_id, compressed = Common.read_action_byte(cur)
+        return (ReqAction.from_byte(b), req_id, compressed)
+
+    @staticmethod
+    def write_req_action(
+            buf: bytearray,
+            action: ReqAction,
+            req_id: Optional[int] = None,
+            ) -> None:
+        Common.write_action_byte(buf, action.value, req_id)
+
+    @staticmethod
+    def read_resp_action(cur: Cursor) -> Tuple[RespAction, Optional[int], bool]:
+        b, req_id, compressed = Common.read_action_byte(cur)
+        return (RespAction.from_byte(b), req_id, compressed)
+
+    @staticmethod
+    def write_resp_action(
+            buf: bytearray,
+            action: RespAction,
+            req_id: Optional[int] = None,
+            ) -> None:
+        Common.write_action_byte(buf, action.value, req_id)
 
     @staticmethod
-    def read_resp_action(sock: socket.socket) -> RespAction:
-        data: bytes = sock.recv(1)
-        assert len(data) == 1
-        return RespAction.from_byte(data)
+    def read_packed(
+            cur: Cursor,
+            version: int,
+            accept: Tuple[Compression, ...],
+            ) -> Tuple[Cursor, Tuple[int, int]]:
+        """
+        O corpo de um frame com `COMPRESSED`, já descomprimido, e os
+        seus tamanhos antes e depois da compressão (ver `Compressor`).
+        Só com os métodos em `accept`, e até `MAX_FRAME_SIZE` bytes.
+        """
+        start: int = cur.pos
+        b: int = Common.read_zero_number(cur)
+        raw: int = Common.read_count(cur, version)
+        data: memoryview = cur.take(Common.read_count(cur, version))
+        if b not in [ method.value for method in accept ]:
+            raise ProtocolError(f"Compression not negotiated: {b}")
+        if raw > MAX_FRAME_SIZE:
+            raise ProtocolError(f"Compressed body too big: {raw} bytes")
+        try:
+            body: bytes = Compression(b).decompress(data, raw + 1)
+        except (zlib.error, lzma.LZMAError) as e:
+            raise ProtocolError(f"Corrupt compressed body: {e}")
+        if len(body) != raw:
+            raise ProtocolError(f"Expected {raw} bytes, got {len(body)}")
+        return (Cursor(memoryview(body)), (raw, cur.pos - start))
 
     @staticmethod
-    def write_resp_action(sock: socket.socket, action: RespAction) -> None:
-        data: bytes = action.to_byte()
-        sock.send(data)
+    def read_key_values(cur: Cursor, version: int = 1) -> Tuple[str, list[str]]:
+        key: str = Common.read_str(cur, version)
+        val_count: int = Common.read_zero_number(cur) \
+            if version == 1 else Common.read_varint(cur)
+        val_list: list[str] = []
+        for i in range(val_count):
+            val_list.append(Common.read_str(cur, version))
+        return (key, val_list)
 
     @staticmethod
-    def read_zero_number(sock: socket.socket) -> int:
-        data: bytes = sock.recv(1)
-        assert len(data) == 1
-        return int(data.hex(), 16)
+    def write_key_values(
+            buf: bytearray,
+            key: str,
+            val_list: list[str],
+            version: int = 1,
+            ) -> None:
+        Common.write_str(buf, key, version)
+        if version == 1:
+            Common.write_zero_number(buf, len(val_list))
+        else:
+            Common.write_varint(buf, len(val_list))
+        for val in val_list:
+            Common.write_str(buf, val, version)
+
+    @staticmethod
+    def read_count(cur: Cursor, version: int = 1) -> int:
+        if version == 1:
+            return Common.read_u32(cur)
+        return Common.read_varint(cur)
+
+    @staticmethod
+    def write_count(buf: bytearray, num: int, version: int = 1) -> None:
+        if version == 1:
+            Common.write_u32(buf, num)
+        else:
+            Common.write_varint(buf, num)
+
+    @staticmethod
+    def read_str(cur: Cursor, version: int = 1) -> str:
+        """
+        Na v1, `one-encoded` (até 256 bytes); na v2, qualquer tamanho,
+        em bytes, num varint.
+        """
+        if version == 1:
+            return Common.read_one_str_utf8(cur)
+        return str(cur.take(Common.read_varint(cur)), 'utf-8')
+
+    @staticmethod
+    def write_str(buf: bytearray, s: str, version: int = 1) -> None:
+        if version == 1:
+            Common.write_one_str_utf8(buf, s)
+        else:
+            data: bytes = s.encode('utf-8')
+            Common.write_varint(buf, len(data))
+            Common.write_str_utf8(buf, data)
 
     @staticmethod
-    def write_zero_number(sock: socket.socket, num: int) -> None:
+    def read_opt_str(cur: Cursor, version: int = 1) -> Optional[str]:
+        """
+        Um `byte` dizendo se tem a string (0x01) ou não (0x00), e ela.
+        """
+        if Common.read_zero_number(cur) == 0:
+            return None
+        return Common.read_str(cur, version)
+
+    @staticmethod
+    def write_opt_str(buf: bytearray, s: Optional[str], version: int = 1) -> None:
+        if s is None:
+            buf.append(0)
+        else:
+            buf.append(1)
+            Common.write_str(buf, s, version)
+
+    @staticmethod
+    def read_varint(cur: Cursor) -> int:
+        """
+        7 bits por byte, os menos significativos primeiro;
+        o bit 0x80 ligado diz que tem mais um byte.
+        """
+        num: int = 0
+        shift: int = 0
+        while True:
+            b: int = cur.take_byte()
+            num |= (b & 0x7F) << shift
+            if b < 0x80:
+                return num
+            shift += 7
+
+    @staticmethod
+    def write_varint(buf: bytearray, num: int) -> None:
+        assert 0 <= num
+        while num >= 0x80:
+            buf.append((num & 0x7F) | 0x80)
+            num >>= 7
+        buf.append(num)
+
+    @staticmethod
+    def read_u32(cur: Cursor) -> int:
+        return int.from_bytes(cur.take(4), 'big')
+
+    @staticmethod
+    def write_u32(buf: bytearray, num: int) -> None:
+        assert 0 <= num and num <= 0xFFFFFFFF
+        buf += num.to_bytes(4, 'big')
+
+    @staticmethod
+    def read_zero_number(cur: Cursor) -> int:
+        return cur.take_byte()
+
+    @staticmethod
+    def write_zero_number(buf: bytearray, num: int) -> None:
         assert 0 <= num and num <= 0xFF
-        sock.send(num.to_bytes(1, 'big'))
+        buf.append(num)
 
     @staticmethod
-    def read_one_number(sock: socket.socket) -> int:
-        num: int = Common.read_zero_number(sock)
+    def read_one_number(cur: Cursor) -> int:
+        num: int = Common.read_zero_number(cur)
         return num + 1
 
     @staticmethod
-    def write_one_number(sock: socket.socket, num: int) -> None:
+    def write_one_number(buf: bytearray, num: int) -> None:
         assert 1 <= num and num <= 0x100
-        Common.write_zero_number(sock, num - 1)
+        Common.write_zero_number(buf, num - 1)
 
     @staticmethod
-    def read_str_utf8(sock: socket.socket, str_len: int) -> str:
+    def read_str_utf8(cur: Cursor, str_len: int) -> str:
         assert str_len > 0
-        data: bytes = b''
-        while len(data) < str_len:
-            tmp: bytes = sock.recv(str_len - len(data))
-            assert len(tmp) > 0
-            data += tmp
-        return data.decode('utf-8')
+        return str(cur.take(str_len), 'utf-8')
 
     @staticmethod
-    def write_str_utf8(sock: socket.socket, s: str) -> None:
-        sock.send(s.encode('utf-8'))
+    def write_str_utf8(buf: bytearray, data: bytes) -> None:
+        buf += data
 
     @staticmethod
-    def read_zero_str_utf8(sock: socket.socket) -> str:
-        str_len: int = Common.read_zero_number(sock)
-        return Common.read_str_utf8(sock, str_len)
+    def read_zero_str_utf8(cur: Cursor) -> str:
+        str_len: int = Common.read_zero_number(cur)
+        return Common.read_str_utf8(cur, str_len)
 
     @staticmethod
-    def write_zero_str_utf8(sock: socket.socket, s: str) -> None:
-        str_len: int = len(s)
+    def write_zero_str_utf8(buf: bytearray, s: str) -> None:
+        data: bytes = s.encode('utf-8')
+        str_len: int = len(data)
         assert str_len <= 0xFF
-        Common.write_zero_number(sock, str_len)
-        Common.write_str_utf8(sock, s)
+        Common.write_zero_number(buf, str_len)
+        Common.write_str_utf8(buf, data)
 
     @staticmethod
-    def read_one_str_utf8(sock: socket.socket) -> str:
-        str_len: int = Common.read_one_number(sock)
-        return Common.read_str_utf8(sock, str_len)
+    def read_one_str_utf8(cur: Cursor) -> str:
+        str_len: int = Common.read_one_number(cur)
+        return Common.read_str_utf8(cur, str_len)
 
     @staticmethod
-    def write_one_str_utf8(sock: socket.socket, s: str) -> None:
-        str_len: int = len(s)
+    def write_one_str_utf8(buf: bytearray, s: str) -> None:
+        data: bytes = s.encode('utf-8')
+        str_len: int = len(data)
         assert 0 < str_len and str_len <= 0x100
-        Common.write_one_number(sock, str_len)
-        Common.write_str_utf8(sock, s)
+        Common.write_one_number(buf, str_len)
+        Common.write_str_utf8(buf, data)
 
 @dataclass(frozen=True)
 class Request:
-    inner: Union[Request.Read, Request.Append]
+    inner: RequestInner
+    req_id: Optional[int] = None
+    # Of the frame; the response goes in the same version
+    version: int = 1
+    # Body sizes (raw, on the wire), if it came compressed
+    packed: Optional[Tuple[int, int]] = None
 
     @staticmethod
-    def read(sock: socket.socket) -> Optional[Request]:
-        if not Common.read_magic(sock):
-            return None
-        action: ReqAction = Common.read_req_action(sock)
-        key: str = Common.read_one_str_utf8(sock)
+    def read(
+            reader: FrameReader,
+            accept: Optional[Compression] = None,
+            ) -> Optional[Request]:
+        return reader.read(Request.parser(accept))
+
+    @staticmethod
+    async def aread(
+            reader: AsyncFrameReader,
+            accept: Optional[Compression] = None,
+            ) -> Optional[Request]:
+        return await reader.read(Request.parser(accept))
+
+    @staticmethod
+    def parser(accept: Optional[Compression]) -> Callable[[Cursor], Request]:
+        return lambda cur: Request.parse(cur, accept)
+
+    @staticmethod
+    def parse(cur: Cursor, accept: Optional[Compression] = None) -> Request:
+        """
+        Frames comprimidos só com o método `accept`, o combinado
+        na conexão (`ProtocolError` se não).
+        """
+        version: int = Common.read_magic(cur)
+        action, req_id, compressed = Common.read_req_action(cur)
+        if not compressed:
+            return Request.parse_body(cur, action, req_id, version)
+        body, packed = Common.read_packed(
+            cur, version, () if accept is None else (accept,),
+        )
+        return dataclasses.replace(
+            Request.parse_body(body, action, req_id, version),
+            packed = packed,
+        )
+
+    @staticmethod
+    def parse_body(
+            cur: Cursor,
+            action: ReqAction,
+            req_id: Optional[int],
+            version: int,
+            ) -> Request:
         if action == ReqAction.READ:
+            key: str = Common.read_str(cur, version)
             return Request(Request.Read(
                 key = key
-            ))
+            ), req_id, version)
         elif action == ReqAction.APPEND:
-            val: str = Common.read_one_str_utf8(sock)
+            key = Common.read_str(cur, version)
+            val: str = Common.read_str(cur, version)
             return Request(Request.Append(
                 key = key,
                 val = val,
-            ))
+            ), req_id, version)
+        elif action == ReqAction.MULTI_READ:
+            key_count: int = Common.read_count(cur, version)
+            keys: list[str] = []
+            for i in range(key_count):
+                keys.append(Common.read_str(cur, version))
+            return Request(Request.MultiRead(
+                keys = keys,
+            ), req_id, version)
+        elif action == ReqAction.MULTI_APPEND:
+            pair_count: int = Common.read_count(cur, version)
+            pairs: list[Tuple[str, str]] = []
+            for i in range(pair_count):
+                key = Common.read_str(cur, version)
+                val = Common.read_str(cur, version)
+                pairs.append((key, val))
+            return Request(Request.MultiAppend(
+                pairs = pairs,
+            ), req_id, version)
+        elif action == ReqAction.TRACK:
+            return Request(Request.Track(), req_id, version)
+        elif action == ReqAction.HELLO:
+            return Request(Request.Hello(
+                version = Common.read_zero_number(cur),
+            ), req_id, version)
+        elif action == ReqAction.SCAN:
+            start: Optional[str] = Common.read_opt_str(cur, version)
+            stop: Optional[str] = Common.read_opt_str(cur, version)
+            cursor: Optional[str] = Common.read_opt_str(cur, version)
+            return Request(Request.Scan(
+                start = start,
+                stop = stop,
+                cursor = cursor,
+                limit = Common.read_count(cur, version),
+            ), req_id, version)
+        elif action == ReqAction.PREFIX:
+            prefix: str = Common.read_str(cur, version)
+            cursor = Common.read_opt_str(cur, version)
+            return Request(Request.Prefix(
+                prefix = prefix,
+                cursor = cursor,
+                limit = Common.read_count(cur, version),
+            ), req_id, version)
+        elif action == ReqAction.READ_RANGE:
+            key = Common.read_str(cur, version)
+            from_end: bool = Common.read_zero_number(cur) != 0
+            offset: int = Common.read_count(cur, version)
+            return Request(Request.ReadRange(
+                key = key,
+                offset = offset,
+                limit = Common.read_count(cur, version),
+                from_end = from_end,
+            ), req_id, version)
+        elif action == ReqAction.LENGTH:
+            return Request(Request.Length(
+                key = Common.read_str(cur, version),
+            ), req_id, version)
+        elif action == ReqAction.COMPRESS:
+            method_count: int = Common.read_zero_number(cur)
+            methods: list[Compression] = []
+            for i in range(method_count):
+                b: int = Common.read_zero_number(cur)
+                # Methods from newer clients are skipped
+                if b in list(Compression):
+                    methods.append(Compression(b))
+            return Request(Request.Compress(
+                methods = methods,
+            ), req_id, version)
         else:
             assert False, 'unreachable'
 
+    def encode(
+            self,
+            buf: Optional[bytearray] = None,
+            compressor: Optional[Compressor] = None,
+            ) -> bytearray:
+        if buf is None:
+            buf = bytearray()
+        start: int = len(buf)
+        Common.write_magic(buf, self.version)
+        Common.write_req_action(buf, self.inner.ACTION, self.req_id)
+        self.inner.encode(buf, self.version)
+        if compressor is not None:
+            compressor.pack(buf, start)
+        return buf
+
     def write(self, sock: socket.socket) -> None:
-        self.inner.write(sock)
+        sock.sendall(self.encode())
 
     @dataclass(frozen=True, kw_only=True)
     class Read:
+        ACTION: ClassVar[ReqAction] = ReqAction.READ
         key: str
 
-        def write(self, sock: socket.socket) -> None:
-            Common.write_magic(sock)
-            Common.write_req_action(sock, ReqAction.READ)
-            Common.write_one_str_utf8(sock, self.key)
+        def encode(self, buf: bytearray, version: int = 1) -> None:
+            Common.write_str(buf, self.key, version)
 
     @dataclass(frozen=True, kw_only=True)
     class Append:
+        ACTION: ClassVar[ReqAction] = ReqAction.APPEND
         key: str
         val: str
 
-        def write(self, sock: socket.socket) -> None:
-            Common.write_magic(sock)
-            Common.write_req_action(sock, ReqAction.APPEND)
-            Common.write_one_str_utf8(sock, self.key)
-            Common.write_one_str_utf8(sock, self.val)
+        def encode(self, buf: bytearray, version: int = 1) -> None:
+            Common.write_str(buf, self.key, version)
+            Common.write_str(buf, self.val, version)
+
+    @dataclass(frozen=True, kw_only=True)
+    class MultiRead:
+        ACTION: ClassVar[ReqAction] = ReqAction.MULTI_READ
+        keys: list[str]
+
+        def encode(self, buf: bytearray, version: int = 1) -> None:
+            Common.write_count(buf, len(self.keys), version)
+            for key in self.keys:
+                Common.write_str(buf, key, version)
+
+    @dataclass(frozen=True, kw_only=True)
+    class MultiAppend:
+        ACTION: ClassVar[ReqAction] = ReqAction.MULTI_APPEND
+        pairs: list[Tuple[str, str]]
+
+        def encode(self, buf: bytearray, version: int = 1) -> None:
+            Common.write_count(buf, len(self.pairs), version)
+            for key, val in self.pairs:
+                Common.write_str(buf, key, version)
+                Common.write_str(buf, val, version)
+
+    @dataclass(frozen=True, kw_only=True)
+    class Track:
+        """
+        Pede que o servidor avise (`Response.Invalidate`) quando uma
+        chave lida por esta conexão mudar, para o cliente guardar
+        as leituras em cache.
+        """
+        ACTION: ClassVar[ReqAction] = ReqAction.TRACK
+
+        def encode(self, buf: bytearray, version: int = 1) -> None:
+            pass
+
+    @dataclass(frozen=True, kw_only=True)
+    class Hello:
+        """
+        A maior versão do protocolo que o cliente conhece; enviada num
+        frame da v1, logo depois de conectar.
+        """
+        ACTION: ClassVar[ReqAction] = ReqAction.HELLO
+        version: int
+
+        def encode(self, buf: bytearray, version: int = 1) -> None:
+            Common.write_zero_number(buf, self.version)
+
+    @dataclass(frozen=True, kw_only=True)
+    class Scan:
+        """
+        Até `limit` chaves, em ordem, de `start` (inclusive) até `stop`
+        (exclusive), depois de `cursor` (o da página anterior).
+        Sem `start` ou `stop`, do começo ou até o fim.
+        """
+        ACTION: ClassVar[ReqAction] = ReqAction.SCAN
+        start: Optional[str] = None
+        stop: Optional[str] = None
+        cursor: Optional[str] = None
+        limit: int = 100
+
+        def encode(self, buf: bytearray, version: int = 1) -> None:
+            Common.write_opt_str(buf, self.start, version)
+            Common.write_opt_str(buf, self.stop, version)
+            Common.write_opt_str(buf, self.cursor, version)
+            Common.write_count(buf, self.limit, version)
+
+    @dataclass(frozen=True, kw_only=True)
+    class Prefix:
+        """
+        Como `Scan`, com as chaves que começam com `prefix`.
+        """
+        ACTION: ClassVar[ReqAction] = ReqAction.PREFIX
+        prefix: str
+        cursor: Optional[str] = None
+        limit: int = 100
+
+        def encode(self, buf: bytearray, version: int = 1) -> None:
+            Common.write_str(buf, self.prefix, version)
+            Common.write_opt_str(buf, self.cursor, version)
+            Common.write_count(buf, self.limit, version)
+
+    @dataclass(frozen=True, kw_only=True)
+    class ReadRange:
+        """
+        Até `limit` valores de `key`, a partir de `offset`.
+        Com `from_end`, `offset` conta do fim: `offset=0` são os
+        últimos `limit` valores.
+        """
+        ACTION: ClassVar[ReqAction] = ReqAction.READ_RANGE
+        key: str
+        offset: int = 0
+        limit: int = 100
+        from_end: bool = False
+
+        def encode(self, buf: bytearray, version: int = 1) -> None:
+            Common.write_str(buf, self.key, version)
+            buf.append(int(self.from_end))
+            Common.write_count(buf, self.offset, version)
+            Common.write_count(buf, self.limit, version)
+
+    @dataclass(frozen=True, kw_only=True)
+    class Length:
+        ACTION: ClassVar[ReqAction] = ReqAction.LENGTH
+        key: str
+
+        def encode(self, buf: bytearray, version: int = 1) -> None:
+            Common.write_str(buf, self.key, version)
+
+    @dataclass(frozen=True, kw_only=True)
+    class Compress:
+        """
+        Os métodos de compressão que o cliente aceita, do preferido ao
+        menos; enviada logo depois do `Request.Hello`.
+        """
+        ACTION: ClassVar[ReqAction] = ReqAction.COMPRESS
+        methods: list[Compression]
+
+        def encode(self, buf: bytearray, version: int = 1) -> None:
+            Common.write_zero_number(buf, len(self.methods))
+            buf += bytes(self.methods)
+
+RequestInner: TypeAlias = Union[
+    Request.Read,
+    Request.Append,
+    Request.MultiRead,
+    Request.MultiAppend,
+    Request.Track,
+    Request.Hello,
+    Request.Scan,
+    Request.Prefix,
+    Request.ReadRange,
+    Request.Length,
+    Request.Compress,
+]
 
 @dataclass(frozen=True)
 class Response:
-    inner: Union[Response.Read, Response.AppendNotExists, Response.AppendExists]
+    inner: ResponseInner
+    req_id: Optional[int] = None
+    version: int = 1
+    # Body sizes (raw, on the wire), if it came compressed
+    packed: Optional[Tuple[int, int]] = None
 
     @staticmethod
-    def read(sock: socket.socket) -> Optional[Response]:
-        if not Common.read_magic(sock):
-            return None
-        action: RespAction = Common.read_resp_action(sock)
+    def read(reader: FrameReader) -> Optional[Response]:
+        return reader.read(Response.parse)
+
+    @staticmethod
+    async def aread(reader: AsyncFrameReader) -> Optional[Response]:
+        return await reader.read(Response.parse)
+
+    @staticmethod
+    def parse(cur: Cursor) -> Response:
+        version: int = Common.read_magic(cur)
+        action, req_id, compressed = Common.read_resp_action(cur)
+        if not compressed:
+            return Response.parse_body(cur, action, req_id, version)
+        body, packed = Common.read_packed(cur, version, Compression.methods())
+        return dataclasses.replace(
+            Response.parse_body(body, action, req_id, version),
+            packed = packed,
+        )
+
+    @staticmethod
+    def parse_body(
+            cur: Cursor,
+            action: RespAction,
+            req_id: Optional[int],
+            version: int,
+            ) -> Response:
         if action == RespAction.READ:
-            key: str = Common.read_one_str_utf8(sock)
-            val_count: int = Common.read_zero_number(sock)
-            val_list: list[str] = []
-            for i in range(val_count):
-                val_list.append(Common.read_one_str_utf8(sock))
+            more: bool = False
+            if version == 1:
+                key, val_list = Common.read_key_values(cur)
+            else:
+                key = Common.read_str(cur, version)
+                more = Common.read_zero_number(cur) != 0
+                val_count: int = Common.read_varint(cur)
+                val_list = []
+                for i in range(val_count):
+                    val_list.append(Common.read_str(cur, version))
             return Response(Response.Read(
                 key = key,
                 val_list = val_list,
-            ))
+                more = more,
+            ), req_id, version)
         elif action == RespAction.APPEND_NOT_EXISTS:
-            return Response(Response.AppendNotExists())
+            return Response(Response.AppendNotExists(), req_id, version)
         elif action == RespAction.APPEND_EXISTS:
-            return Response(Response.AppendExists())
+            return Response(Response.AppendExists(), req_id, version)
+        elif action == RespAction.MULTI_READ:
+            entry_count: int = Common.read_count(cur, version)
+            entries: list[Tuple[str, list[str]]] = []
+            for i in range(entry_count):
+                entries.append(Common.read_key_values(cur, version))
+            return Response(Response.MultiRead(
+                entries = entries,
+            ), req_id, version)
+        elif action == RespAction.MULTI_APPEND:
+            existed_count: int = Common.read_count(cur, version)
+            existed: list[bool] = []
+            for i in range(existed_count):
+                existed.append(Common.read_zero_number(cur) != 0)
+            return Response(Response.MultiAppend(
+                existed_before = existed,
+            ), req_id, version)
+        elif action == RespAction.BUSY:
+            return Response(Response.Busy(), req_id, version)
+        elif action == RespAction.READ_ONLY:
+            return Response(Response.ReadOnly(), req_id, version)
+        elif action == RespAction.TRACKING:
+            return Response(Response.Tracking(
+                enabled = Common.read_zero_number(cur) != 0,
+            ), req_id, version)
+        elif action == RespAction.INVALIDATE:
+            everything: bool = Common.read_zero_number(cur) != 0
+            key_count: int = Common.read_count(cur, version)
+            keys: list[str] = []
+            for i in range(key_count):
+                keys.append(Common.read_str(cur, version))
+            return Response(Response.Invalidate(
+                keys = None if everything else keys,
+            ), req_id, version)
+        elif action == RespAction.HELLO:
+            return Response(Response.Hello(
+                version = Common.read_zero_number(cur),
+            ), req_id, version)
+        elif action == RespAction.KEYS:
+            key_count = Common.read_count(cur, version)
+            keys = []
+            for i in range(key_count):
+                keys.append(Common.read_str(cur, version))
+            return Response(Response.Keys(
+                keys = keys,
+                cursor = Common.read_opt_str(cur, version),
+            ), req_id, version)
+        elif action == RespAction.READ_RANGE:
+            key = Common.read_str(cur, version)
+            offset: int = Common.read_count(cur, version)
+            length: int = Common.read_count(cur, version)
+            val_count = Common.read_count(cur, version)
+            val_list = []
+            for i in range(val_count):
+                val_list.append(Common.read_str(cur, version))
+            return Response(Response.ReadRange(
+                key = key,
+                offset = offset,
+                length = length,
+                val_list = val_list,
+            ), req_id, version)
+        elif action == RespAction.LENGTH:
+            return Response(Response.Length(
+                length = Common.read_count(cur, version),
+            ), req_id, version)
+        elif action == RespAction.COMPRESS:
+            return Response(Response.Compress(
+                method = Compression(Common.read_zero_number(cur)),
+            ), req_id, version)
         else:
             assert False, 'unreachable'
 
+    def encode(
+            self,
+            buf: Optional[bytearray] = None,
+            compressor: Optional[Compressor] = None,
+            ) -> bytearray:
+        """
+        Na v2, uma `Response.Read` grande vira vários frames
+        (comprimidos um a um).
+        """
+        if buf is None:
+            buf = bytearray()
+        if isinstance(self.inner, Response.Read) \
+                and self.version != 1 and not self.inner.more:
+            for body, _ in Response.Read.bodies(
+                    self.inner.key, self.inner.val_list, self.version):
+                Response.encode_read(
+                    buf, body, self.req_id, self.version, compressor,
+                )
+            return buf
+        start: int = len(buf)
+        Common.write_magic(buf, self.version)
+        Common.write_resp_action(buf, self.inner.ACTION, self.req_id)
+        self.inner.encode(buf, self.version)
+        if compressor is not None:
+            compressor.pack(buf, start)
+        return buf
+
+    @staticmethod
+    def encode_read(
+            buf: bytearray,
+            body: bytes | bytearray,
+            req_id: Optional[int] = None,
+            version: int = 1,
+            compressor: Optional[Compressor] = None,
+            ) -> None:
+        """
+        Uma `Response.Read` com o corpo já codificado
+        (por `Response.Read.bodies`).
+        """
+        start: int = len(buf)
+        Common.write_magic(buf, version)
+        Common.write_resp_action(buf, RespAction.READ, req_id)
+        buf += body
+        if compressor is not None:
+            compressor.pack(buf, start)
+
     def write(self, sock: socket.socket) -> None:
-        self.inner.write(sock)
+        sock.sendall(self.encode())
 
     @dataclass(frozen=True, kw_only=True)
     class Read:
+        """
+        Na v2, os valores podem vir em pedaços, em frames seguidos com
+        o mesmo id: todos menos o último com `more`.
+        """
+        ACTION: ClassVar[RespAction] = RespAction.READ
         key: str
         val_list: list[str]
+        more: bool = False
 
-        def write(self, sock: socket.socket) -> None:
-            Common.write_magic(sock)
-            Common.write_resp_action(sock, RespAction.READ)
-            Common.write_one_str_utf8(sock, self.key)
-            Common.write_zero_number(sock, len(self.val_list))
+        def encode(self, buf: bytearray, version: int = 1) -> None:
+            if version == 1:
+                assert not self.more
+                Common.write_key_values(buf, self.key, self.val_list)
+                return
+            Common.write_str(buf, self.key, version)
+            buf.append(int(self.more))
+            Common.write_varint(buf, len(self.val_list))
             for val in self.val_list:
-                Common.write_one_str_utf8(sock, val)
+                Common.write_str(buf, val, version)
+
+        @staticmethod
+        def bodies(
+                key: str,
+                val_list: list[str],
+                version: int = 1,
+                ) -> Iterator[Tuple[bytearray, bool]]:
+            """
+            Os corpos dos frames da resposta, codificados um de cada
+            vez, e se vem mais algum depois.
+            Na v2, cada pedaço leva uns `CHUNK_SIZE` bytes de valores.
+            """
+            if version == 1:
+                body: bytearray = bytearray()
+                Common.write_key_values(body, key, val_list)
+                yield (body, False)
+                return
+            start: int = 0
+            while True:
+                vals: bytearray = bytearray()
+                end: int = start
+                while end < len(val_list) and len(vals) < CHUNK_SIZE:
+                    Common.write_str(vals, val_list[end], version)
+                    end += 1
+                more: bool = end < len(val_list)
+                body = bytearray()
+                Common.write_str(body, key, version)
+                body.append(int(more))
+                Common.write_varint(body, end - start)
+                body += vals
+                yield (body, more)
+                if not more:
+                    return
+                start = end
 
     @dataclass(frozen=True, kw_only=True)
     class AppendNotExists:
+        ACTION: ClassVar[RespAction] = RespAction.APPEND_NOT_EXISTS
 
-        def write(self, sock: socket.socket) -> None:
-            Common.write_magic(sock)
-            Common.write_resp_action(sock, RespAction.APPEND_NOT_EXISTS)
+        def encode(self, buf: bytearray, version: int = 1) -> None:
+            pass
 
     @dataclass(frozen=True, kw_only=True)
     class AppendExists:
+        ACTION: ClassVar[RespAction] = RespAction.APPEND_EXISTS
+
+        def encode(self, buf: bytearray, version: int = 1) -> None:
+            pass
+
+    @dataclass(frozen=True, kw_only=True)
+    class MultiRead:
+        """
+        Uma entrada `(key, val_list)` por chave pedida, na mesma ordem.
+        """
+        ACTION: ClassVar[RespAction] = RespAction.MULTI_READ
+        entries: list[Tuple[str, list[str]]]
+
+        def encode(self, buf: bytearray, version: int = 1) -> None:
+            Common.write_count(buf, len(self.entries), version)
+            for key, val_list in self.entries:
+                Common.write_key_values(buf, key, val_list, version)
+
+    @dataclass(frozen=True, kw_only=True)
+    class MultiAppend:
+        """
+        Se cada chave existia antes, na ordem dos pares pedidos.
+        """
+        ACTION: ClassVar[RespAction] = RespAction.MULTI_APPEND
+        existed_before: list[bool]
+
+        def encode(self, buf: bytearray, version: int = 1) -> None:
+            Common.write_count(buf, len(self.existed_before), version)
+            buf += bytes(self.existed_before)
+
+    @dataclass(frozen=True, kw_only=True)
+    class Busy:
+        """
+        Enviada no lugar de qualquer resposta quando o servidor
+        recusa a conexão por estar sobrecarregado.
+        """
+        ACTION: ClassVar[RespAction] = RespAction.BUSY
+
+        def encode(self, buf: bytearray, version: int = 1) -> None:
+            pass
+
+    @dataclass(frozen=True, kw_only=True)
+    class ReadOnly:
+        """
+        Resposta de uma réplica a uma escrita: só o primário as aceita.
+        """
+        ACTION: ClassVar[RespAction] = RespAction.READ_ONLY
+
+        def encode(self, buf: bytearray, version: int = 1) -> None:
+            pass
+
+    @dataclass(frozen=True, kw_only=True)
+    class Tracking:
+        """
+        Resposta ao `Request.Track`: se o servidor vai mandar as
+        invalidações.
+        """
+        ACTION: ClassVar[RespAction] = RespAction.TRACKING
+        enabled: bool
+
+        def encode(self, buf: bytearray, version: int = 1) -> None:
+            buf.append(int(self.enabled))
+
+    @dataclass(frozen=True, kw_only=True)
+    class Invalidate:
+        """
+        Enviada pelo servidor, fora de ordem e sem id, quando muda uma
+        chave que a conexão leu depois do `Request.Track`.
+        `keys` é `None` quando tudo pode ter mudado (`load`).
+        """
+        ACTION: ClassVar[RespAction] = RespAction.INVALIDATE
+        keys: Optional[list[str]]
 
-        def write(self, sock: socket.socket) -> None:
-            Common.write_magic(sock)
-            Common.write_resp_action(sock, RespAction.APPEND_EXISTS)
+        def encode(self, buf: bytearray, version: int = 1) -> None:
+            buf.append(int(self.keys is None))
+            keys: list[str] = [] if self.keys is None else self.keys
+            Common.write_count(buf, len(keys), version)
+            for key in keys:
+                Common.write_str(buf, key, version)
 
+    @dataclass(frozen=True, kw_only=True)
+    class Hello:
+        """
+        Resposta ao `Request.Hello`: a versão que os dois vão usar
+        dali em diante.
+        """
+        ACTION: ClassVar[RespAction] = RespAction.HELLO
+        version: int
+
+        def encode(self, buf: bytearray, version: int = 1) -> None:
+            Common.write_zero_number(buf, self.version)
+
+    @dataclass(frozen=True, kw_only=True)
+    class Keys:
+        """
+        Resposta a `Request.Scan` e `Request.Prefix`: uma página de
+        chaves, em ordem, e o `cursor` para pedir a próxima
+        (`None` se acabou).
+        """
+        ACTION: ClassVar[RespAction] = RespAction.KEYS
+        keys: list[str]
+        cursor: Optional[str]
+
+        def encode(self, buf: bytearray, version: int = 1) -> None:
+            Common.write_count(buf, len(self.keys), version)
+            for key in self.keys:
+                Common.write_str(buf, key, version)
+            Common.write_opt_str(buf, self.cursor, version)
+
+    @dataclass(frozen=True, kw_only=True)
+    class ReadRange:
+        """
+        Os valores de `key` a partir da posição `offset`, de `length`
+        no total (0 se a chave não existe).
+        A quantidade de valores não tem o limite de 255 do `Read` na v1.
+        """
+        ACTION: ClassVar[RespAction] = RespAction.READ_RANGE
+        key: str
+        offset: int
+        length: int
+        val_list: list[str]
+
+        def encode(self, buf: bytearray, version: int = 1) -> None:
+            Common.write_str(buf, self.key, version)
+            Common.write_count(buf, self.offset, version)
+            Common.write_count(buf, self.length, version)
+            Common.write_count(buf, len(self.val_list), version)
+            for val in self.val_list:
+                Common.write_str(buf, val, version)
+
+    @dataclass(frozen=True, kw_only=True)
+    class Length:
+        ACTION: ClassVar[RespAction] = RespAction.LENGTH
+        length: int
+
+        def encode(self, buf: bytearray, version: int = 1) -> None:
+            Common.write_count(buf, self.length, version)
+
+    @dataclass(frozen=True, kw_only=True)
+    class Compress:
+        """
+        Resposta ao `Request.Compress`: o método que o servidor vai
+        usar dali em diante (`Compression.NONE` se nenhum).
+        """
+        ACTION: ClassVar[RespAction] = RespAction.COMPRESS
+        method: Compression
+
+        def encode(self, buf: bytearray, version: int = 1) -> None:
+            buf.append(self.method.value)
+
+ResponseInner: TypeAlias = Union[
+    Response.Read,
+    Response.AppendNotExists,
+    Response.AppendExists,
+    Response.MultiRead,
+    Response.MultiAppend,
+    Response.Busy,
+    Response.ReadOnly,
+    Response.Tracking,
+    Response.Invalidate,
+    Response.Hello,
+    Response.Keys,
+    Response.ReadRange,
+    Response.Length,
+    Response.Compress,
+]
+
+class ReadChunks:
+    """
+    Junta os pedaços das `Response.Read` da v2, pelo id da requisição.
+    Entre dois pedaços pode chegar outra resposta (um
+    `Response.Invalidate`), mas não outro pedaço de leitura.
+    """
+    partial: dict[Optional[int], list[str]]
+
+    def __init__(self) -> None:
+        self.partial = dict()
+
+    def add(self, response: Response) -> Optional[Response]:
+        """
+        Retorna a resposta inteira, ou `None` se ainda faltam pedaços.
+        """
+        if not isinstance(response.inner, Response.Read):
+            return response
+        val_list: Optional[list[str]] = self.partial.get(response.req_id)
+        if val_list is None:
+            if not response.inner.more:
+                return response
+            val_list = self.partial[response.req_id] = []
+        val_list.extend(response.inner.val_list)
+        if response.inner.more:
+            return None
+        del self.partial[response.req_id]
+        return Response(Response.Read(
+            key = response.inner.key,
+            val_list = val_list,
+        ), response.req_id, response.version)
@@ -0,0 +1,366 @@
+from __future__ import annotations
+
+from typing import Any, BinaryIO, Optional, Tuple
+
+import threading
+import socket
+import queue
+import json
+import time
+import sys
+import os
+
+from concorrencia import KeyLocks
+from persistencia import Snapshot, SnapshotFormat
+from processamento import Process
+
+# Seconds without records before the primary says it is still there
+HEARTBEAT = 1.0
+# Seconds between acknowledgements from a replica
+ACK_INTERVAL = 0.2
+# A replica this far behind is dropped (and starts over from a snapshot)
+MAX_BACKLOG = 1_000_000
+
+def log(s: str) -> None:
+    print(s, file=sys.stderr)
+
+class Link:
+    """
+    Uma réplica conectada ao primário.
+    """
+    addr: str
+    sock: socket.socket
+    # Lines to send; `None` stops the link
+    pending: queue.SimpleQueue[Optional[str]]
+    sent_seq: int
+    acked_seq: int
+    acked_at: float
+    closed: bool
+
+    def __init__(self, addr: str, sock: socket.socket, seq: int) -> None:
+        self.addr = addr
+        self.sock = sock
+        self.pending = queue.SimpleQueue()
+        self.sent_seq = seq
+        self.acked_seq = 0
+        self.acked_at = time.monotonic()
+        self.closed = False
+
+    def close(self) -> None:
+        if not self.closed:
+            self.closed = True
+            self.pending.put(None)
+            try:
+                self.sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+class Feed:
+    """
+    Lado do primário da replicação.
+
+    Cada mutação do `Process` vira uma linha JSON, como no `Log`, com
+    o número de sequência e a hora na frente:
+      * `[seq, time, "a", key, val]`
+      * `[seq, time, "r", key]`
+      * `[seq, time]`: nada mudou (a cada `HEARTBEAT` segundos)
+
+    Uma réplica que se conecta recebe primeiro um snapshot binário,
+    tirado com o dicionário parado, e depois as linhas das mutações
+    feitas desde então. A réplica responde com o `seq` que já aplicou.
+    """
+    process: Process
+    locks: KeyLocks
+    sock: socket.socket
+    seq: int
+    links: list[Link]
+    lock: threading.Lock
+    accepter: threading.Thread
+    syncs: int
+
+    def __init__(self, port: int, process: Process, locks: KeyLocks) -> None:
+        self.process = process
+        self.locks = locks
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind(('', port))
+        self.sock.listen(8)
+        self.seq = 0
+        self.links = []
+        self.lock = threading.Lock()
+        self.syncs = 0
+        process.feeds.append(self.record)
+        self.accepter = threading.Thread(target=self.accept_loop, daemon=True)
+        self.accepter.start()
+
+    def record(self, record: list[str]) -> None:
+        """
+        Chamada pelo `Process` com a chave da mutação travada, então as
+        mutações de uma chave saem na ordem em que foram feitas.
+        """
+        if record[0] == 'l':
+            self.reset()
+            return
+        with self.lock:
+            self.seq += 1
+            if len(self.links) == 0:
+                return
+            line: str = json.dumps([self.seq, time.time()] + record) + '\n'
+            for link in self.links:
+                if link.pending.qsize() >= MAX_BACKLOG:
+                    log(f"Replica too far behind, dropping: {link.addr}")
+                    link.close()
+                else:
+                    link.pending.put(line)
+            self.links = [ link for link in self.links if not link.closed ]
+
+    def accept_loop(self) -> None:
+        while True:
+            try:
+                sock, addr = self.sock.accept()
+            except OSError:
+                return
+            threading.Thread(
+                target=self.serve,
+                args=(sock, f'{addr[0]} : {addr[1]}'),
+                daemon=True,
+            ).start()
+
+    def serve(self, sock: socket.socket, addr: str) -> None:
+        log(f"Replica connected: {addr} ...")
+        with self.lock:
+            self.syncs += 1
+            target: str = f'{self.process.filename}.sync-{self.syncs}'
+        link: Optional[Link] = None
+        try:
+            # The snapshot and the start of the stream are taken at the
+            # same point: no mutation in between
+            with self.locks.exclusive():
+                snap: Snapshot = Snapshot.start(
+                    target, self.process.dic.dic, format=SnapshotFormat.BINARY,
+                )
+                with self.lock:
+                    link = Link(addr, sock, self.seq)
+                    self.links.append(link)
+            snap.wait()
+            if not snap.ok:
+                log(f"Snapshot for replica failed: {addr}")
+                return
+            receiver: threading.Thread = threading.Thread(
+                target=self.receive_acks, args=(link,), daemon=True,
+            )
+            receiver.start()
+            with open(target, 'rb') as file:
+                size: int = os.fstat(file.fileno()).st_size
+                header: str = json.dumps({ 'seq': link.sent_seq, 'snapshot': size })
+                sock.sendall((header + '\n').encode('utf-8'))
+                sock.sendfile(file)
+            os.remove(target)
+            log(f"Replica synced: {addr} ({snap.total} keys)")
+            self.send_loop(link)
+        except OSError:
+            pass
+        finally:
+            if os.path.exists(target):
+                os.remove(target)
+            if link is not None:
+                with self.lock:
+                    if link in self.links:
+                        self.links.remove(link)
+                link.close()
+            sock.close()
+            log(f"Replica disconnected: {addr} ...")
+
+    def send_loop(self, link: Link) -> None:
+        while True:
+            try:
+                line: Optional[str] = link.pending.get(timeout=HEARTBEAT)
+            except queue.Empty:
+                with self.lock:
+                    line = json.dumps([self.seq, time.time()]) + '\n'
+            if line is None:
+                return
+            lines: list[str] = [line]
+            # Everything already queued goes in the same send
+            while len(lines) < 4096:
+                try:
+                    more: Optional[str] = link.pending.get_nowait()
+                except queue.Empty:
+                    break
+                if more is None:
+                    return
+                lines.append(more)
+            link.sock.sendall(''.join(lines).encode('utf-8'))
+            link.sent_seq = json.loads(lines[-1])[0]
+
+    def receive_acks(self, link: Link) -> None:
+        try:
+            with link.sock.makefile('r', encoding='utf-8') as file:
+                for line in file:
+                    link.acked_seq = int(line)
+                    link.acked_at = time.monotonic()
+        except (OSError, ValueError):
+            pass
+        link.close()
+
+    def reset(self) -> None:
+        """
+        O dicionário foi trocado (`load`): as réplicas precisam começar
+        de novo, de um snapshot.
+        Chamada pelo `Process`, com o dicionário parado.
+        """
+        with self.lock:
+            for link in self.links:
+                link.close()
+            self.links = []
+
+    def status(self) -> str:
+        with self.lock:
+            seq: int = self.seq
+            links: list[Link] = list(self.links)
+        lines: list[str] = [f"primary at seq {seq}, {len(links)} replicas"]
+        now: float = time.monotonic()
+        for link in links:
+            lines.append(
+                f"  {link.addr}: acked {link.acked_seq} "
+                f"({seq - link.acked_seq} behind, "
+                f"heard {now - link.acked_at:.1f}s ago)"
+            )
+        return '\n'.join(lines)
+
+    def close(self) -> None:
+        self.sock.close()
+        self.reset()
+
+class Replica:
+    """
+    Lado da réplica: segue um `Feed` e aplica as mutações no `Process`
+    local, que só atende leituras.
+    Se a conexão cai, reconecta (com espera crescente) e recomeça do
+    snapshot do primário.
+    """
+    primary: Tuple[str, int]
+    process: Process
+    locks: KeyLocks
+    # connecting, syncing, streaming or closed
+    state: str
+    applied_seq: int
+    primary_seq: int
+    # Seconds from the primary writing the last record to applying it
+    delay: float
+    heard_at: float
+    sock: Optional[socket.socket]
+    thread: threading.Thread
+
+    def __init__(self, primary: str, process: Process, locks: KeyLocks) -> None:
+        """
+        `primary` no formato `host:port` (a porta de replicação).
+        """
+        host, port = primary.rsplit(':', 1)
+        self.primary = (host, int(port))
+        self.process = process
+        self.locks = locks
+        self.state = 'connecting'
+        self.applied_seq = 0
+        self.primary_seq = 0
+        self.delay = 0.0
+        self.heard_at = time.monotonic()
+        self.sock = None
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self) -> None:
+        backoff: float = 0.1
+        while self.state != 'closed':
+            try:
+                self.state = 'connecting'
+                self.sock = socket.create_connection(self.primary)
+                if self.state == 'closed':
+                    break
+                with self.sock.makefile('rb') as file:
+                    self.sync(file)
+                    backoff = 0.1
+                    self.stream(file)
+            except (OSError, ValueError) as e:
+                if self.state != 'closed':
+                    log(f"Replication from {self.primary[0]}:{self.primary[1]} "
+                        f"interrupted: {e}")
+            finally:
+                if self.sock is not None:
+                    self.sock.close()
+            if self.state != 'closed':
+                time.sleep(backoff)
+                backoff = min(backoff * 2, 5.0)
+
+    def sync(self, file: BinaryIO) -> None:
+        self.state = 'syncing'
+        header: bytes = file.readline()
+        if not header.endswith(b'\n'):
+            raise ConnectionError('Connection closed')
+        info: dict[str, int] = json.loads(header)
+        tmp: str = self.process.filename + '.sync'
+        remaining: int = info['snapshot']
+        with open(tmp, 'wb') as out:
+            while remaining > 0:
+                chunk: bytes = file.read(min(remaining, 1024 * 1024))
+                if len(chunk) == 0:
+                    raise ConnectionError('Connection closed')
+                out.write(chunk)
+                remaining -= len(chunk)
+        with self.locks.exclusive():
+            os.replace(tmp, self.process.filename)
+            self.process.load()
+        # Possibly another primary, or the same one restarted
+        self.applied_seq = info['seq']
+        self.primary_seq = info['seq']
+        self.heard_at = time.monotonic()
+        log(f"Synced from {self.primary[0]}:{self.primary[1]} "
+            f"at seq {self.applied_seq} ({len(self.process.dic.dic)} keys)")
+
+    def stream(self, file: BinaryIO) -> None:
+        self.state = 'streaming'
+        acked_at: float = 0.0
+        for line in file:
+            if not line.endswith(b'\n'):
+                break
+            record: list[Any] = json.loads(line)
+            seq: int = record[0]
+            self.heard_at = time.monotonic()
+            self.primary_seq = max(self.primary_seq, seq)
+            if len(record) > 2:
+                self.apply(record[2:])
+                self.applied_seq = seq
+                self.delay = time.time() - record[1]
+            now: float = time.monotonic()
+            if len(record) == 2 or now - acked_at >= ACK_INTERVAL:
+                assert self.sock is not None
+                self.sock.sendall(f'{self.applied_seq}\n'.encode('utf-8'))
+                acked_at = now
+
+    def apply(self, record: list[str]) -> None:
+        if record[0] == 'a':
+            with self.locks.write(record[1]):
+                self.process.append(record[1], record[2])
+        elif record[0] == 'r':
+            with self.locks.write(record[1]):
+                self.process.remove(record[1])
+        else:
+            assert False, f"Unknown log record: '{record}'"
+
+    def status(self) -> str:
+        return (
+            f"replica of {self.primary[0]}:{self.primary[1]}, {self.state}: "
+            f"applied {self.applied_seq} of {self.primary_seq} "
+            f"({self.primary_seq - self.applied_seq} behind, "
+            f"last applied {self.delay:.3f}s after written, "
+            f"heard {time.monotonic() - self.heard_at:.1f}s ago)"
+        )
+
+    def close(self) -> None:
+        self.state = 'closed'
+        if self.sock is not None:
+            try:
+                self.sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+        self.thread.join()
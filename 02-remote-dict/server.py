@@ -1,17 +1,29 @@
 from __future__ import annotations
 
-from typing import Any, Callable, Optional, TextIO, Tuple
+from typing import Any, Callable, Iterator, Optional, TextIO, Tuple
 from typing import Generic, TypeVar
 from dataclasses import dataclass, field
 
 import threading
+import argparse
+import queue
 import socket
 import select
 import sys
 
+from cache import FrameCache
 from cli import AdminCli, ParsedCommand
+from concorrencia import KeyLocks
+from disco import Backend
+from indice import Page
+from invalidacao import Tracker, Tracking
+from persistencia import Durability, Snapshot, SnapshotFormat
 from processamento import Process
+from protocol import BUF_SIZE, COMPRESS_THRESHOLD, VERSION
+from protocol import Compression, Compressor, FrameReader, ProtocolError
 from protocol import Request, Response
+from protocol import WireStats
+from replicacao import Feed, Replica
 
 HOST = ''
 PORT = 5000
@@ -23,15 +35,75 @@ def log(s: str) -> None:
 
 @dataclass(eq=False, frozen=True)
 class SharedDict:
-    lock: threading.Lock = field(init=False, default_factory=threading.Lock)
+    """
+    Com `feed`, é o primário de uma replicação;
+    com `replica`, é uma réplica, e só atende leituras.
+    Com `frames`, as leituras são respondidas de um `FrameCache`.
+    As conexões podem pedir os métodos em `compression`.
+    """
     process: Process
+    locks: KeyLocks = field(default_factory=KeyLocks)
+    feed: Optional[Feed] = None
+    replica: Optional[Replica] = None
+    tracking: Tracking = field(default_factory=Tracking)
+    frames: Optional[FrameCache] = None
+    compression: Tuple[Compression, ...] = (Compression.ZLIB, Compression.LZMA)
+    compress_threshold: int = COMPRESS_THRESHOLD
+    wire: WireStats = field(default_factory=WireStats)
+
+    def __post_init__(self) -> None:
+        self.process.feeds.append(self.tracking.record)
+        if self.frames is not None:
+            self.process.feeds.append(self.frames.record)
 
     @staticmethod
-    def from_file(filename: str) -> SharedDict:
-        return SharedDict(Process.from_file(filename))
+    def from_file(filename: str, options: Options) -> SharedDict:
+        process: Process = Process.from_file(
+            filename,
+            options.durability,
+            options.batch_window,
+            options.snapshot_format,
+            options.backend,
+            options.cache_pages,
+        )
+        locks: KeyLocks = KeyLocks()
+        return SharedDict(
+            process,
+            locks,
+            feed = None
+                if options.replication_port is None
+                else Feed(options.replication_port, process, locks),
+            replica = None
+                if options.replica_of is None
+                else Replica(options.replica_of, process, locks),
+            frames = None
+                if options.read_cache <= 0
+                else FrameCache(options.read_cache),
+            compression = options.compression,
+            compress_threshold = options.compress_threshold,
+        )
+
+    def read_only(self) -> bool:
+        return self.replica is not None
+
+    def compressor(self, methods: list[Compression]) -> Optional[Compressor]:
+        """
+        O combinado com um `Request.Compress`: o primeiro método do
+        cliente que o servidor aceita, ou `None`.
+        """
+        for method in methods:
+            if method != Compression.NONE and method in self.compression:
+                return Compressor(method, self.compress_threshold, self.wire)
+        return None
 
 @dataclass()
 class Server(Generic[T]):
+    """
+    Sem `workers`, cada conexão ganha sua própria thread.
+    Com `workers`, as conexões esperam numa fila de tamanho `backlog`
+    até alguma das `workers` threads ficar livre; com a fila cheia,
+    a conexão é recusada com `on_busy`.
+    """
     sock: socket.socket
     port: int
     shared_mut: T
@@ -39,7 +111,12 @@ class Server(Generic[T]):
     on_start: Callable[[T], None]
     on_stdin: Callable[[T, TextIO, TextIO], bool]
     on_newsock: Callable[[T, Tuple[socket.socket, str]], None]
+    on_busy: Callable[[T, Tuple[socket.socket, str]], None]
     on_exit: Callable[[T], None]
+    workers: Optional[int]
+    idle_timeout: Optional[float]
+    pending: Optional[queue.SimpleQueue[Optional[Tuple[socket.socket, str]]]]
+    slots: Optional[threading.Semaphore]
 
     def __init__(self,
             host: str,
@@ -48,13 +125,20 @@ class Server(Generic[T]):
             on_start: Callable[[T], None],
             on_stdin: Callable[[T, TextIO, TextIO], bool],
             on_newsock: Callable[[T, Tuple[socket.socket, str]], None],
+            on_busy: Callable[[T, Tuple[socket.socket, str]], None],
             on_exit: Callable[[T], None],
+            workers: Optional[int] = None,
+            backlog: int = 64,
+            idle_timeout: Optional[float] = None,
             ) -> None:
         self.sock = \
             socket.socket(
                 socket.AF_INET,
                 socket.SOCK_STREAM | socket.SOCK_NONBLOCK
         )
+        # Restarting a server must not wait for the old connections
+        # to leave TIME_WAIT
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         self.sock.bind((host, port))
         self.sock.listen(5)
         assert self.sock.getblocking() == False
@@ -66,7 +150,22 @@ class Server(Generic[T]):
         self.on_start = on_start
         self.on_stdin = on_stdin
         self.on_newsock = on_newsock
+        self.on_busy = on_busy
         self.on_exit = on_exit
+        self.workers = workers
+        self.idle_timeout = idle_timeout
+        self.pending = None
+        self.slots = None
+        if workers is not None:
+            assert workers > 0 and backlog >= 0
+            self.pending = queue.SimpleQueue()
+            # A slot for each worker plus the ones waiting in the queue
+            self.slots = threading.Semaphore(workers + backlog)
+            for _ in range(workers):
+                thread: threading.Thread = \
+                    threading.Thread(target=self.worker)
+                thread.start()
+                self.all_threads.append(thread)
 
     def __enter__(self) -> Server[T]:
         return self
@@ -78,27 +177,55 @@ class Server(Generic[T]):
     def close(self) -> None:
         log(f"Closing socket...")
         self.sock.close()
+        if self.pending is not None:
+            for _ in range(len(self.all_threads)):
+                self.pending.put(None)
         log(f"Waiting for threads...")
         for t in self.all_threads:
             t.join()
         log(f"Exiting...")
 
+    def worker(self) -> None:
+        assert self.pending is not None and self.slots is not None
+        while True:
+            sock_addr: Optional[Tuple[socket.socket, str]] = \
+                self.pending.get()
+            if sock_addr is None:
+                break
+            try:
+                self.on_newsock(self.shared_mut, sock_addr)
+            finally:
+                self.slots.release()
+
+    def reap(self) -> None:
+        self.all_threads = [ t for t in self.all_threads if t.is_alive() ]
+
     def accept(self) -> Tuple[socket.socket, str]:
         args: Tuple[socket.socket, str] = self.sock.accept()
-        thread: threading.Thread = \
-            threading.Thread(
-                target=self.on_newsock,
-                args=(self.shared_mut, args)
-        )
-        thread.start()
-        self.all_threads.append(thread)
+        args[0].settimeout(self.idle_timeout)
+        if self.pending is None or self.slots is None:
+            self.reap()
+            thread: threading.Thread = \
+                threading.Thread(
+                    target=self.on_newsock,
+                    args=(self.shared_mut, args)
+            )
+            thread.start()
+            self.all_threads.append(thread)
+        elif self.slots.acquire(blocking=False):
+            self.pending.put(args)
+        else:
+            self.on_busy(self.shared_mut, args)
         return args
 
     def run(self) -> None:
         stop: bool = False
         ins = [sys.stdin, self.sock]
 
-        log(f"Running on port {self.port}...")
+        if self.workers is None:
+            log(f"Running on port {self.port}...")
+        else:
+            log(f"Running on port {self.port} ({self.workers} workers)...")
         self.on_start(self.shared_mut)
         while not stop:
             read, _write, _exeption = select.select(ins, [], [])
@@ -114,6 +241,191 @@ class Server(Generic[T]):
 def init(shared_mut: SharedDict) -> None:
     AdminCli.help(sys.stdout)
 
+def handle_request(
+        shared_mut: SharedDict,
+        request: Request,
+        tracker: Optional[Tracker] = None,
+        blocking: bool = True,
+        ) -> Response:
+    """
+    Sem `tracker`, a conexão não tem como receber invalidações,
+    e o `Request.Track` é recusado.
+    Sem `blocking`, uma leitura levanta `WouldBlock` antes de fazer
+    qualquer coisa, se teria que esperar uma trava.
+    """
+    if shared_mut.read_only() and is_mutation(request):
+        return Response(Response.ReadOnly(), request.req_id, request.version)
+    if isinstance(request.inner, Request.Read):
+        read_req: Request.Read = request.inner
+        with shared_mut.locks.read(read_req.key, blocking):
+            if tracker is not None and tracker.enabled:
+                shared_mut.tracking.track(tracker, read_req.key)
+            # Copied because the response is encoded after unlocking
+            val_list: list[str] = \
+                list(shared_mut.process.read(read_req.key))
+        return Response(Response.Read(
+            key = read_req.key,
+            val_list = val_list,
+        ), request.req_id, request.version)
+    elif isinstance(request.inner, Request.Append):
+        append_req: Request.Append = request.inner
+        with shared_mut.locks.write(append_req.key):
+            existed_before: bool = \
+                shared_mut.process.append(
+                    append_req.key,
+                    append_req.val,
+            )
+        return Response(
+            Response.AppendExists()
+            if existed_before
+            else Response.AppendNotExists(),
+            request.req_id,
+            request.version,
+        )
+    elif isinstance(request.inner, Request.MultiRead):
+        multi_read_req: Request.MultiRead = request.inner
+        # The whole batch takes the locks only once
+        with shared_mut.locks.read_many(multi_read_req.keys, blocking):
+            if tracker is not None and tracker.enabled:
+                for key in multi_read_req.keys:
+                    shared_mut.tracking.track(tracker, key)
+            entries: list[Tuple[str, list[str]]] = [
+                (key, list(shared_mut.process.read(key)))
+                for key in multi_read_req.keys
+            ]
+        return Response(Response.MultiRead(
+            entries = entries,
+        ), request.req_id, request.version)
+    elif isinstance(request.inner, Request.MultiAppend):
+        multi_append_req: Request.MultiAppend = request.inner
+        with shared_mut.locks.write_many(
+                key for key, _ in multi_append_req.pairs):
+            existed: list[bool] = [
+                shared_mut.process.append(key, val)
+                for key, val in multi_append_req.pairs
+            ]
+        return Response(Response.MultiAppend(
+            existed_before = existed,
+        ), request.req_id, request.version)
+    elif isinstance(request.inner, Request.Track):
+        if tracker is not None:
+            shared_mut.tracking.enable(tracker, request.version)
+        return Response(Response.Tracking(
+            enabled = tracker is not None,
+        ), request.req_id, request.version)
+    elif isinstance(request.inner, Request.Hello):
+        return Response(Response.Hello(
+            version = min(request.inner.version, VERSION),
+        ), request.req_id, request.version)
+    elif isinstance(request.inner, Request.Compress):
+        # The connection switches with `SharedDict.compressor` too
+        compressor: Optional[Compressor] = \
+            shared_mut.compressor(request.inner.methods)
+        return Response(Response.Compress(
+            method = Compression.NONE
+                if compressor is None
+                else compressor.method,
+        ), request.req_id, request.version)
+    elif isinstance(request.inner, Request.ReadRange):
+        range_req: Request.ReadRange = request.inner
+        with shared_mut.locks.read(range_req.key, blocking):
+            length: int = shared_mut.process.length(range_req.key)
+            offset, val_list = shared_mut.process.read_range(
+                range_req.key, range_req.offset, range_req.limit,
+                range_req.from_end,
+            )
+        return Response(Response.ReadRange(
+            key = range_req.key,
+            offset = offset,
+            length = length,
+            val_list = val_list,
+        ), request.req_id, request.version)
+    elif isinstance(request.inner, Request.Length):
+        with shared_mut.locks.read(request.inner.key, blocking):
+            length = shared_mut.process.length(request.inner.key)
+        return Response(Response.Length(
+            length = length,
+        ), request.req_id, request.version)
+    elif isinstance(request.inner, Request.Scan):
+        # The index has its own lock, no key is locked
+        scan_req: Request.Scan = request.inner
+        keys, cursor = shared_mut.process.scan(
+            scan_req.start, scan_req.stop, scan_req.cursor, scan_req.limit,
+        )
+        return Response(Response.Keys(
+            keys = keys,
+            cursor = cursor,
+        ), request.req_id, request.version)
+    elif isinstance(request.inner, Request.Prefix):
+        prefix_req: Request.Prefix = request.inner
+        keys, cursor = shared_mut.process.prefix(
+            prefix_req.prefix, prefix_req.cursor, prefix_req.limit,
+        )
+        return Response(Response.Keys(
+            keys = keys,
+            cursor = cursor,
+        ), request.req_id, request.version)
+    else:
+        assert False, 'unreachable'
+
+def answer(
+        shared_mut: SharedDict,
+        request: Request,
+        tracker: Optional[Tracker],
+        out: bytearray,
+        compressor: Optional[Compressor] = None,
+        blocking: bool = True,
+        ) -> Optional[Iterator[bytearray]]:
+    """
+    Codifica em `out` a resposta a `request`, como `handle_request`;
+    uma leitura sai pronta do `FrameCache`, se estiver nele.
+    De uma leitura em pedaços (v2), só o primeiro vai para `out`:
+    os outros frames são codificados conforme o retorno é percorrido.
+    Com `compressor`, os frames grandes vão comprimidos.
+    `blocking` como em `handle_request`: com `WouldBlock`, `out` não
+    foi alterado.
+    """
+    if not isinstance(request.inner, Request.Read):
+        handle_request(
+            shared_mut, request, tracker, blocking,
+        ).encode(out, compressor)
+        return None
+    frames: Optional[FrameCache] = shared_mut.frames
+    key: str = request.inner.key
+    req_id: Optional[int] = request.req_id
+    version: int = request.version
+    rest: Optional[Iterator[Tuple[bytearray, bool]]] = None
+    with shared_mut.locks.read(key, blocking):
+        if tracker is not None and tracker.enabled:
+            shared_mut.tracking.track(tracker, key)
+        body: Optional[bytes] = \
+            None if frames is None else frames.get(key, version)
+        if body is None:
+            # Copied because the other pieces are encoded after unlocking
+            bodies: Iterator[Tuple[bytearray, bool]] = Response.Read.bodies(
+                key, list(shared_mut.process.read(key)), version,
+            )
+            first, more = next(bodies)
+            body = bytes(first)
+            if more:
+                rest = bodies
+            elif frames is not None:
+                frames.put(key, version, body)
+    Response.encode_read(out, body, req_id, version, compressor)
+    if rest is None:
+        return None
+
+    def chunks(rest: Iterator[Tuple[bytearray, bool]]) -> Iterator[bytearray]:
+        for body, _ in rest:
+            frame: bytearray = bytearray()
+            Response.encode_read(frame, body, req_id, version, compressor)
+            yield frame
+
+    return chunks(rest)
+
+def is_mutation(request: Request) -> bool:
+    return isinstance(request.inner, (Request.Append, Request.MultiAppend))
+
 def run_thread(
         shared_mut: SharedDict,
         sock_addr: Tuple[socket.socket, str]
@@ -121,41 +433,120 @@ def run_thread(
     sock: socket.socket = sock_addr[0]
     addr: str = sock_addr[1][0] + ' : ' + str(sock_addr[1][1])
     log(f"Client connected: {addr} ...")
+    reader: FrameReader = FrameReader(sock)
+    out: bytearray = bytearray()
+    # Invalidations are sent from another thread
+    send_lock: threading.Lock = threading.Lock()
+
+    def send(data: bytes | bytearray) -> None:
+        with send_lock:
+            sock.sendall(data)
+
+    def close() -> None:
+        # Without `send_lock`: also wakes a `send` blocked on the client
+        try:
+            sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    tracker: Tracker = Tracker(send, close)
+    # Set by a `Request.Compress`
+    compressor: Optional[Compressor] = None
+    # Mutations are only acknowledged once durable; a pipelined batch
+    # waits once, for its last mutation
+    durable_point: int = 0
+    try:
+        while True:
+            # Pipelined requests already in the buffer are answered
+            # together, with a single send
+            # Compressed frames only with the method negotiated here
+            accept: Optional[Compression] = \
+                None if compressor is None else compressor.method
+            request: Optional[Request] = \
+                reader.read_buffered(Request.parser(accept))
+            if request is None:
+                if len(out) > 0:
+                    shared_mut.process.wait_durable(durable_point)
+                    send(out)
+                    log(f"Response sent to {addr}")
+                    out = bytearray()
+                request = Request.read(reader, accept)
+                if request is None:
+                    break
+            log(f"Received request from {addr}")
+            if request.packed is not None:
+                shared_mut.wire.received(*request.packed)
+            chunks: Optional[Iterator[bytearray]] = \
+                answer(shared_mut, request, tracker, out, compressor)
+            if is_mutation(request):
+                durable_point = shared_mut.process.durable_point()
+            elif isinstance(request.inner, Request.Compress):
+                compressor = shared_mut.compressor(request.inner.methods)
+            for chunk in chunks or ():
+                if len(out) >= BUF_SIZE:
+                    shared_mut.process.wait_durable(durable_point)
+                    send(out)
+                    out = bytearray()
+                out += chunk
+            if len(out) >= BUF_SIZE:
+                shared_mut.process.wait_durable(durable_point)
+                send(out)
+                out = bytearray()
+    except TimeoutError:
+        log(f"Client idle for too long: {addr} ...")
+    except ConnectionError:
+        pass
+    except ProtocolError as e:
+        log(f"Protocol error from {addr}: {e}")
+    finally:
+        shared_mut.tracking.disable(tracker)
+        with send_lock:
+            sock.close()
+    log(f"Client disconnected: {addr} ...")
+
+def reject_busy(
+        shared_mut: SharedDict,
+        sock_addr: Tuple[socket.socket, str]
+        ) -> None:
+    sock: socket.socket = sock_addr[0]
+    addr: str = sock_addr[1][0] + ' : ' + str(sock_addr[1][1])
+    log(f"Server busy, rejecting: {addr} ...")
+    try:
+        Response(Response.Busy()).write(sock)
+    except OSError:
+        pass
+    finally:
+        sock.close()
+
+def print_pages(
+        next_page: Callable[[Optional[str]], Page],
+        output: TextIO,
+        ) -> None:
+    """
+    Mostra as chaves de um `scan` ou `prefix`, página por página:
+    `next_page` recebe o cursor da anterior.
+    """
+    cursor: Optional[str] = None
+    total: int = 0
     while True:
-        request: Optional[Request] = Request.read(sock)
-        if request is None:
+        keys, cursor = next_page(cursor)
+        total += len(keys)
+        if len(keys) > 0:
+            print(f"=> Keys (len: {len(keys)}): {keys}",
+                file=output)
+        if cursor is None:
             break
-        log(f"Received request from {addr}")
-        assert request is not None
-        response: Optional[Response] = None
-        if isinstance(request.inner, Request.Read):
-            read_req: Request.Read = request.inner
-            with shared_mut.lock:
-                val_list: list[str] = \
-                    shared_mut.process.read(read_req.key)
-            response = Response(Response.Read(
-                key = read_req.key,
-                val_list = val_list,
-            ))
-        elif isinstance(request.inner, Request.Append):
-            append_req: Request.Append = request.inner
-            with shared_mut.lock:
-                existed_before: bool = \
-                    shared_mut.process.append(
-                        append_req.key,
-                        append_req.val,
-                )
-                response = Response(
-                    Response.AppendExists()
-                    if existed_before
-                    else Response.AppendNotExists()
-                )
-        else:
-            assert False, 'unreachable'
-        assert response is not None
-        response.write(sock)
-        log(f"Response sent to {addr}")
-    log(f"Client disconnected: {addr} ...")
+    print(f"=> {total} keys",
+        file=output)
+
+def print_methods(methods: Tuple[Compression, ...]) -> str:
+    if len(methods) == 0:
+        return 'disabled'
+    return ','.join( method.name.lower() for method in methods )
+
+def scan_bound(arg: str) -> Optional[str]:
+    # In the admin command, '-' is no bound
+    return None if arg == '-' else arg
 
 def run_user(
         shared_mut: SharedDict,
@@ -164,12 +555,26 @@ def run_user(
         ) -> bool:
     parsed: Optional[ParsedCommand] = \
         AdminCli.command(input, sys.stdout)
+    return run_admin(shared_mut, parsed, output)
+
+def run_admin(
+        shared_mut: SharedDict,
+        parsed: Optional[ParsedCommand],
+        output: TextIO,
+        ) -> bool:
+    """
+    Executa um comando do admin já lido; retorna se é para sair.
+    """
     if parsed is None:
         # Nothing to do
         pass
+    elif parsed.cmd_name in ('append', 'remove', 'load') \
+            and shared_mut.read_only():
+        print('=> Read-only replica, use the primary',
+            file=output)
     elif parsed.cmd_name == 'append':
         assert len(parsed.args) == 2
-        with shared_mut.lock:
+        with shared_mut.locks.write(parsed.args[0]):
             existed_before: bool = shared_mut.process\
                 .append(parsed.args[0], parsed.args[1])
         if existed_before:
@@ -180,30 +585,81 @@ def run_user(
                 file=output)
     elif parsed.cmd_name == 'read':
         assert len(parsed.args) == 1
-        with shared_mut.lock:
-            val_list = shared_mut.process \
-                .read(parsed.args[0])
+        with shared_mut.locks.read(parsed.args[0]):
+            val_list = list(shared_mut.process \
+                .read(parsed.args[0]))
         print(f"=> Read values (len: {len(val_list)}): {val_list}",
             file=output)
     elif parsed.cmd_name == 'remove':
         assert len(parsed.args) == 1
-        with shared_mut.lock:
+        with shared_mut.locks.write(parsed.args[0]):
             val_list = shared_mut.process. \
             remove(parsed.args[0])
         print(f"=> Removed values (len: {len(val_list)}): {val_list}",
             file=output)
     elif parsed.cmd_name == 'load':
         assert len(parsed.args) == 0
-        with shared_mut.lock:
+        with shared_mut.locks.exclusive():
             shared_mut.process.load()
         print('=> Loaded ok',
             file=output)
     elif parsed.cmd_name == 'store':
         assert len(parsed.args) == 0
-        with shared_mut.lock:
-            shared_mut.process.store()
-        print('=> Stored ok',
+        # Clients are only held back while the snapshot is taken,
+        # it is written in the background
+        with shared_mut.locks.exclusive():
+            snapshot: Optional[Snapshot] = shared_mut.process \
+                .store_background(
+                    lambda snap: print(f"=> Store {snap.status()}",
+                        file=output)
+                )
+        if snapshot is None:
+            assert shared_mut.process.snapshot is not None
+            print(f"=> Store already {shared_mut.process.snapshot.status()}",
+                file=output)
+        else:
+            print(f"=> Store started ({snapshot.total} keys)",
+                file=output)
+    elif parsed.cmd_name == 'replication':
+        assert len(parsed.args) == 0
+        if shared_mut.feed is not None:
+            print(f"=> {shared_mut.feed.status()}",
+                file=output)
+        elif shared_mut.replica is not None:
+            print(f"=> {shared_mut.replica.status()}",
+                file=output)
+        else:
+            print('=> Not replicating',
+                file=output)
+    elif parsed.cmd_name == 'cache':
+        assert len(parsed.args) == 0
+        if shared_mut.frames is not None:
+            print(f"=> Read cache: {shared_mut.frames.status()}",
+                file=output)
+        else:
+            print('=> No read cache',
+                file=output)
+    elif parsed.cmd_name == 'compression':
+        assert len(parsed.args) == 0
+        print(f"=> Compression ({print_methods(shared_mut.compression)}, "
+            f"from {shared_mut.compress_threshold} bytes):",
             file=output)
+        print(shared_mut.wire.status(),
+            file=output)
+    elif parsed.cmd_name == 'scan':
+        assert len(parsed.args) == 2
+        start: Optional[str] = scan_bound(parsed.args[0])
+        stop: Optional[str] = scan_bound(parsed.args[1])
+        print_pages(
+            lambda cursor: shared_mut.process.scan(start, stop, cursor),
+            output,
+        )
+    elif parsed.cmd_name == 'prefix':
+        assert len(parsed.args) == 1
+        print_pages(
+            lambda cursor: shared_mut.process.prefix(parsed.args[0], cursor),
+            output,
+        )
     elif parsed.cmd_name == 'exit':
         return True
     elif parsed.cmd_name == 'help':
@@ -218,23 +674,163 @@ def run_user(
 def noop(shared_mut: T) -> None:
     return None
 
-def create_server(dict_file: str) -> Server[SharedDict]:
-    shared_dict: SharedDict = SharedDict.from_file(dict_file)
+def close_shared(shared_mut: SharedDict) -> None:
+    if shared_mut.replica is not None:
+        shared_mut.replica.close()
+    if shared_mut.feed is not None:
+        shared_mut.feed.close()
+    shared_mut.process.close()
+
+ENGINES: list[str] = ['threaded', 'asyncio', 'processes']
+
+@dataclass(frozen=True, kw_only=True)
+class Options:
+    port: int = PORT
+    dict_file: str = 'start_dict.json'
+    engine: str = 'threaded'
+    workers: Optional[int] = None
+    backlog: int = 64
+    idle_timeout: Optional[float] = None
+    durability: Optional[Durability] = None
+    batch_window: float = 0.002
+    snapshot_format: Optional[SnapshotFormat] = None
+    backend: Backend = Backend.MEMORY
+    cache_pages: int = 4096
+    processes: Optional[int] = None
+    replication_port: Optional[int] = None
+    replica_of: Optional[str] = None
+    read_cache: int = 64 * 1024 * 1024
+    compression: Tuple[Compression, ...] = (Compression.ZLIB, Compression.LZMA)
+    compress_threshold: int = COMPRESS_THRESHOLD
+
+    @staticmethod
+    def parse(argv: Optional[list[str]] = None) -> Options:
+        parser = argparse.ArgumentParser()
+        parser.add_argument('--port', type=int, default=PORT)
+        parser.add_argument('--dict-file', default='start_dict.json')
+        parser.add_argument('--engine', choices=ENGINES, default='threaded')
+        parser.add_argument('--workers', type=int, default=None,
+            help='threaded engine: serve connections with a fixed pool of threads')
+        parser.add_argument('--backlog', type=int, default=64,
+            help='threaded engine: connections waiting for a worker before "busy"')
+        parser.add_argument('--idle-timeout', type=float, default=None,
+            help='threaded engine: seconds before an idle connection is closed')
+        parser.add_argument('--durability',
+            choices=[ d.value for d in Durability ], default=None,
+            help='log every mutation, acknowledged after the write, '
+                'after a group fsync, or after its own fsync '
+                '(default: no log, only the admin store command)')
+        parser.add_argument('--batch-window', type=float, default=0.002,
+            help='batched durability: seconds to gather a group commit')
+        parser.add_argument('--snapshot-format',
+            choices=[ f.value for f in SnapshotFormat ], default=None,
+            help='format written by the store command '
+                '(default: the format of the existing file, or json; '
+                'binary with the disk backend)')
+        parser.add_argument('--backend',
+            choices=[ b.value for b in Backend ], default=Backend.MEMORY.value,
+            help='keep the values in memory (as str lists, or packed '
+                'per key with compact), or in a work file on disk')
+        parser.add_argument('--cache-pages', type=int, default=4096,
+            help='disk backend: pages of the work file kept in memory')
+        parser.add_argument('--processes', type=int, default=None,
+            help='processes engine: worker processes, each owning a '
+                'partition of the keys (default: one per core)')
+        parser.add_argument('--replication-port', type=int, default=None,
+            help='primary: stream the mutations to replicas connecting here')
+        parser.add_argument('--replica-of', default=None, metavar='HOST:PORT',
+            help='run as a read-only replica of the primary with this '
+                'replication port')
+        parser.add_argument('--read-cache', type=int,
+            default=64 * 1024 * 1024, metavar='BYTES',
+            help='threaded and asyncio engines: keep encoded read '
+                'responses of hot keys, up to this size (0 disables)')
+        parser.add_argument('--compression', default='zlib,lzma',
+            help='compression methods the clients may ask for, '
+                'comma-separated ("none" disables)')
+        parser.add_argument('--compress-threshold', type=int,
+            default=COMPRESS_THRESHOLD, metavar='BYTES',
+            help='compress only frames with at least this many bytes')
+        args = parser.parse_args(argv)
+        compression: list[Compression] = []
+        for name in args.compression.split(','):
+            if name.strip().upper() not in Compression.__members__:
+                parser.error(f"unknown compression method: '{name}'")
+            method: Compression = Compression.from_name(name)
+            if method != Compression.NONE:
+                compression.append(method)
+        if args.replica_of is not None and args.durability is not None:
+            parser.error('a replica takes its data from the primary, '
+                'it has no log of its own (--durability)')
+        if Backend(args.backend) == Backend.DISK:
+            if args.snapshot_format == SnapshotFormat.JSON.value:
+                parser.error('the disk backend keeps binary snapshots only')
+            if SnapshotFormat.of_file(args.dict_file) == SnapshotFormat.JSON:
+                parser.error(f"'{args.dict_file}' is a JSON snapshot, read "
+                    'whole into memory; for the disk backend, convert it '
+                    f"first: python binario.py to-binary {args.dict_file} "
+                    '<binary file>')
+        if args.engine == 'processes' and (args.replica_of is not None
+                or args.replication_port is not None):
+            parser.error('the processes engine does not replicate')
+        return Options(
+            port = args.port,
+            dict_file = args.dict_file,
+            engine = args.engine,
+            workers = args.workers,
+            backlog = args.backlog,
+            idle_timeout = args.idle_timeout,
+            durability = None
+                if args.durability is None
+                else Durability(args.durability),
+            batch_window = args.batch_window,
+            snapshot_format = None
+                if args.snapshot_format is None
+                else SnapshotFormat(args.snapshot_format),
+            backend = Backend(args.backend),
+            cache_pages = args.cache_pages,
+            processes = args.processes,
+            replication_port = args.replication_port,
+            replica_of = args.replica_of,
+            read_cache = args.read_cache,
+            compression = tuple(compression),
+            compress_threshold = args.compress_threshold,
+        )
+
+def create_server(
+        dict_file: str,
+        options: Options,
+        ) -> Server[SharedDict]:
+    shared_dict: SharedDict = SharedDict.from_file(dict_file, options)
     return Server(
-        HOST, PORT,
+        HOST, options.port,
         shared_mut = shared_dict,
         on_start = init,
         on_stdin = run_user,
         on_newsock = run_thread,
-        on_exit = noop
+        on_busy = reject_busy,
+        on_exit = close_shared,
+        workers = options.workers,
+        backlog = options.backlog,
+        idle_timeout = options.idle_timeout,
     )
 
-def main(dict_file: str) -> int:
-    with create_server(dict_file) as server:
-        server.run()
+def main(dict_file: str, options: Options = Options()) -> int:
+    if options.engine == 'threaded':
+        with create_server(dict_file, options) as server:
+            server.run()
+    elif options.engine == 'asyncio':
+        from async_server import create_async_server
+        with create_async_server(dict_file, options) as async_server:
+            async_server.run()
+    elif options.engine == 'processes':
+        from multi_server import run_processes
+        return run_processes(dict_file, options)
+    else:
+        assert False, f"Unknown engine: '{options.engine}'"
     return 0
 
 if __name__ == '__main__':
-    dict_file: str = 'start_dict.json'
-    retcode: int = main(dict_file)
+    options: Options = Options.parse()
+    retcode: int = main(options.dict_file, options)
     sys.exit(retcode)
@@ -1,47 +1,149 @@
-from typing import Any, Optional, TextIO
+from __future__ import annotations
+
+from typing import Any, Optional, TextIO, Tuple, TypeAlias, Union
 from dataclasses import dataclass, field
 
 import rpyc # type: ignore
 
+import argparse
 import sys
 
 from cli import AdminCli, ParsedCommand
-
-HOST = 'localhost'
-PORT = 5000
+from hashring import HashRing
+from indice import KeyIndex, Page
+from pool import HOST, PORT, HDDClient
 
 def log(s: str) -> None:
     print(s, file=sys.stderr)
 
+@dataclass(eq=False, slots=True)
+class ShardedRoot:
+    """
+    Faz o papel de `conn.root` para vários servidores, cada um dono
+    de uma parte das chaves, escolhido pelo `HashRing`.
+    `load`, `store`, `scan` e `prefix` vão para todos os servidores.
+    """
+    ring: HashRing
+    conns: dict[str, rpyc.Connection]
+
+    def root_of(self, key: str) -> Any:
+        return self.conns[self.ring.node_of(key)].root
+
+    def append(self, key: str, val: str) -> bool:
+        ret: bool = self.root_of(key).append(key, val)
+        return ret
+
+    def read(self, key: str) -> list[str]:
+        return list(self.root_of(key).read(key))
+
+    def read_range(
+            self,
+            key: str,
+            offset: int = 0,
+            limit: int = 100,
+            from_end: bool = False,
+            ) -> Tuple[int, int, list[str]]:
+        start, length, vals = \
+            self.root_of(key).read_range(key, offset, limit, from_end)
+        return (start, length, list(vals))
+
+    def length(self, key: str) -> int:
+        ret: int = self.root_of(key).length(key)
+        return ret
+
+    def remove(self, key: str) -> list[str]:
+        return list(self.root_of(key).remove(key))
+
+    def read_many(self, keys: list[str]) -> list[list[str]]:
+        """
+        Lê várias chaves, com os servidores atendendo em paralelo.
+        O resultado segue a ordem de `keys`.
+        """
+        pending: list[Any] = [ None ] * len(keys)
+        for node, idxs in self.ring.split(keys).items():
+            read = rpyc.async_(self.conns[node].root.read)
+            for i in idxs:
+                pending[i] = read(keys[i])
+        return [ list(result.value) for result in pending ]
+
+    def scan(
+            self,
+            start: Optional[str] = None,
+            stop: Optional[str] = None,
+            cursor: Optional[str] = None,
+            limit: int = 100,
+            ) -> Page:
+        """
+        As páginas de todos os servidores, pedidas em paralelo,
+        intercaladas numa só.
+        """
+        pending: list[Any] = [
+            rpyc.async_(conn.root.scan)(start, stop, cursor, limit)
+            for conn in self.conns.values()
+        ]
+        return KeyIndex.merge([
+            (list(result.value[0]), result.value[1]) for result in pending
+        ], limit)
+
+    def prefix(
+            self,
+            prefix: str,
+            cursor: Optional[str] = None,
+            limit: int = 100,
+            ) -> Page:
+        pending: list[Any] = [
+            rpyc.async_(conn.root.prefix)(prefix, cursor, limit)
+            for conn in self.conns.values()
+        ]
+        return KeyIndex.merge([
+            (list(result.value[0]), result.value[1]) for result in pending
+        ], limit)
+
+    def load(self) -> None:
+        for conn in self.conns.values():
+            conn.root.load()
+
+    def store(self) -> str:
+        return '; '.join(
+            f"{node}: {conn.root.store()}"
+            for node, conn in self.conns.items()
+        )
+
 @dataclass(eq=False, kw_only=True, slots=True)
-class ConnMan:
-    host: str
-    port: int
-    conn: rpyc.Connection = field(init=False)
+class ShardedConnMan:
+    """
+    Conexões com um cluster: `addrs` no formato `host:port`.
+    """
+    addrs: list[str]
+    vnodes: int = 128
+    conns: dict[str, rpyc.Connection] = field(init=False)
+    root: ShardedRoot = field(init=False)
 
-    def __enter__(self) -> rpyc.Connection:
-        self.conn = rpyc.connect(self.host, self.port)
-        log(f"connected to service: {'conn.root.get_service_name()'}")
-        return self.conn
+    def __enter__(self) -> ShardedConnMan:
+        self.conns = dict()
+        for addr in self.addrs:
+            host, port = addr.rsplit(':', 1)
+            self.conns[addr] = rpyc.connect(host, int(port))
+        log(f"connected to {len(self.conns)} shards")
+        self.root = ShardedRoot(HashRing(self.addrs, self.vnodes), self.conns)
+        return self
 
     def __exit__(self, *args: Any) -> None:
-        self.conn.close()
+        for conn in self.conns.values():
+            conn.close()
 
-def create_conn(
-        host: str,
-        port: int,
-        ) -> ConnMan:
-    return ConnMan(host=host, port=port)
+# Both have the methods of `HDDService`
+Root: TypeAlias = Union[HDDClient, ShardedRoot]
 
 def handle_command(
         parsed: ParsedCommand,
-        conn: rpyc.Connection,
+        root: Root,
         output: TextIO,
         ) -> bool:
     if parsed.cmd_name == 'append':
         assert len(parsed.args) == 2
         in_dict_before = \
-            conn.root.append(parsed.args[0], parsed.args[1])
+            root.append(parsed.args[0], parsed.args[1])
         if not in_dict_before:
             print('=> Just created!',
                 file=output)
@@ -50,23 +152,46 @@ def handle_command(
                 file=output)
     elif parsed.cmd_name == 'read':
         assert len(parsed.args) == 1
-        read_list = conn.root.read(parsed.args[0])
+        read_list = list(root.read(parsed.args[0]))
         print(f"=> Read '{parsed.args[0]}' values (len: {len(read_list)}): {read_list}",
             file=output)
     elif parsed.cmd_name == 'remove':
         assert len(parsed.args) == 1
-        rem_list = conn.root.remove(parsed.args[0])
+        rem_list = list(root.remove(parsed.args[0]))
         print(f"=> Remove '{parsed.args[0]}' values (len: {len(rem_list)}): {rem_list}",
             file=output)
+    elif parsed.cmd_name in ('scan', 'prefix'):
+        cursor: Optional[str] = None
+        total: int = 0
+        while True:
+            if parsed.cmd_name == 'scan':
+                assert len(parsed.args) == 2
+                # In the admin command, '-' is no bound
+                keys, cursor = root.scan(
+                    None if parsed.args[0] == '-' else parsed.args[0],
+                    None if parsed.args[1] == '-' else parsed.args[1],
+                    cursor,
+                )
+            else:
+                assert len(parsed.args) == 1
+                keys, cursor = root.prefix(parsed.args[0], cursor)
+            total += len(keys)
+            if len(keys) > 0:
+                print(f"=> Keys (len: {len(keys)}): {keys}",
+                    file=output)
+            if cursor is None:
+                break
+        print(f"=> {total} keys",
+            file=output)
     elif parsed.cmd_name == 'load':
         assert len(parsed.args) == 0
-        conn.root.load()
+        root.load()
         print(f"=> Dictionary reloaded",
             file=output)
     elif parsed.cmd_name == 'store':
         assert len(parsed.args) == 0
-        conn.root.store()
-        print(f"=> Dictionary stored",
+        status: str = root.store()
+        print(f"=> Store {status}",
             file=output)
     elif parsed.cmd_name == 'exit':
         return True
@@ -79,22 +204,36 @@ def handle_command(
         assert False, f"Unhandled command: '{parsed.cmd_name}'"
     return False
 
-def main() -> int:
+def run_cli(root: Root) -> None:
     infile = sys.stdin
     outfile = sys.stdout
-    with create_conn(HOST, PORT) as conn:
-        should_stop: bool = False
-        AdminCli.help(outfile)
-        while not should_stop:
-            parsed: Optional[ParsedCommand] = \
-                AdminCli.command(infile, outfile)
-            if parsed is None:
-                # Nothing to do
-                pass
-            else:
-                should_stop = handle_command(parsed, conn, outfile)
+    should_stop: bool = False
+    AdminCli.help(outfile)
+    while not should_stop:
+        parsed: Optional[ParsedCommand] = \
+            AdminCli.command(infile, outfile)
+        if parsed is None:
+            # Nothing to do
+            pass
+        else:
+            should_stop = handle_command(parsed, root, outfile)
+
+def main(servers: Optional[list[str]] = None) -> int:
+    if servers is None:
+        with HDDClient.connect(HOST, PORT, max_size=1) as client:
+            run_cli(client)
+    else:
+        with ShardedConnMan(addrs=servers) as sharded:
+            run_cli(sharded.root)
     return 0
 
 if __name__ == "__main__":
-    sys.exit(main())
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--servers', default=None,
+        help='host:port,host:port,... of a sharded cluster '
+            f'(default: a single server at {HOST}:{PORT})')
+    args = parser.parse_args()
+    sys.exit(main(
+        None if args.servers is None else args.servers.split(',')
+    ))
 
@@ -0,0 +1,48 @@
+import subprocess
+import argparse
+import signal
+import sys
+
+from server import PORT
+
+def main() -> int:
+    parser = argparse.ArgumentParser(
+        description='Run several servers on local ports, one shard each. '
+            'Extra arguments go to every server.',
+    )
+    parser.add_argument('--shards', type=int, default=3)
+    parser.add_argument('--base-port', type=int, default=PORT)
+    args, server_args = parser.parse_known_args()
+
+    addrs: list[str] = []
+    procs: list[subprocess.Popen[bytes]] = []
+    for i in range(args.shards):
+        port: int = args.base_port + i
+        addrs.append(f'localhost:{port}')
+        procs.append(subprocess.Popen(
+            [
+                sys.executable, 'server.py',
+                '--port', str(port),
+                '--dict-file', f'shard-{port}.json',
+                *server_args,
+            ],
+            stdout=subprocess.DEVNULL,
+        ))
+    print(f"Running {args.shards} shards, connect with:")
+    print(f"    python client.py --servers {','.join(addrs)}")
+    print("Press Enter (or end the input) to stop them")
+    try:
+        sys.stdin.readline()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        # Same as Ctrl-C on each server
+        for proc in procs:
+            proc.send_signal(signal.SIGINT)
+        for proc in procs:
+            proc.wait()
+    return 0
+
+if __name__ == '__main__':
+    retcode: int = main()
+    sys.exit(retcode)
@@ -0,0 +1,180 @@
+from typing import Any, ContextManager, Iterable, Iterator
+from contextlib import contextmanager
+
+import threading
+
+class RWLock:
+    """
+    Vários leitores ou um único escritor.
+    Escritores esperando têm preferência sobre novos leitores,
+    para que um fluxo contínuo de leituras não trave as escritas.
+    """
+    cond: threading.Condition
+    readers: int
+    writer: bool
+    writers_waiting: int
+
+    def __init__(self) -> None:
+        self.cond = threading.Condition(threading.Lock())
+        self.readers = 0
+        self.writer = False
+        self.writers_waiting = 0
+
+    def acquire_read(self, blocking: bool = True) -> bool:
+        """
+        Como `threading.Lock.acquire`: sem `blocking`, retorna `False`
+        em vez de esperar.
+        """
+        with self.cond:
+            while self.writer or self.writers_waiting > 0:
+                if not blocking:
+                    return False
+                self.cond.wait()
+            self.readers += 1
+            return True
+
+    def release_read(self) -> None:
+        with self.cond:
+            self.readers -= 1
+            if self.readers == 0:
+                self.cond.notify_all()
+
+    def acquire_write(self, blocking: bool = True) -> bool:
+        with self.cond:
+            if not blocking:
+                if self.writer or self.readers > 0:
+                    return False
+                self.writer = True
+                return True
+            self.writers_waiting += 1
+            while self.writer or self.readers > 0:
+                self.cond.wait()
+            self.writers_waiting -= 1
+            self.writer = True
+            return True
+
+    def release_write(self) -> None:
+        with self.cond:
+            self.writer = False
+            self.cond.notify_all()
+
+    @contextmanager
+    def read(self) -> Iterator[None]:
+        self.acquire_read()
+        try:
+            yield
+        finally:
+            self.release_read()
+
+    @contextmanager
+    def write(self) -> Iterator[None]:
+        self.acquire_write()
+        try:
+            yield
+        finally:
+            self.release_write()
+
+class WouldBlock(Exception):
+    """
+    Uma trava pedida sem `blocking` não estava livre.
+    """
+
+class KeyGuard:
+    """
+    Segura a trava global como leitora e as travas de algumas faixas.
+    É uma classe (e não um `contextmanager`) porque é usada em toda
+    requisição.
+    Sem `blocking`, levanta `WouldBlock` (sem segurar nada) em vez de
+    esperar uma das travas.
+    """
+    __slots__ = ('global_lock', 'stripes', 'write', 'blocking')
+    global_lock: RWLock
+    stripes: list[RWLock]
+    write: bool
+    blocking: bool
+
+    def __init__(
+            self,
+            global_lock: RWLock,
+            stripes: list[RWLock],
+            write: bool,
+            blocking: bool = True,
+            ) -> None:
+        self.global_lock = global_lock
+        self.stripes = stripes
+        self.write = write
+        self.blocking = blocking
+
+    def __enter__(self) -> None:
+        if not self.global_lock.acquire_read(self.blocking):
+            raise WouldBlock()
+        held: int = 0
+        try:
+            for lock in self.stripes:
+                acquired: bool = \
+                    lock.acquire_write(self.blocking) if self.write \
+                    else lock.acquire_read(self.blocking)
+                if not acquired:
+                    raise WouldBlock()
+                held += 1
+        except BaseException:
+            self.release(held)
+            raise
+
+    def __exit__(self, *args: Any) -> None:
+        self.release(len(self.stripes))
+
+    def release(self, held: int) -> None:
+        for lock in reversed(self.stripes[:held]):
+            if self.write:
+                lock.release_write()
+            else:
+                lock.release_read()
+        self.global_lock.release_read()
+
+class KeyLocks:
+    """
+    Travas do dicionário inteiro e de cada chave.
+
+    Operações numa chave seguram a trava global como leitoras e a
+    trava da faixa (`stripe`) da chave: leituras em paralelo com tudo
+    menos escritas na mesma faixa, escritas em faixas diferentes
+    em paralelo.
+    Operações no dicionário inteiro (`load`, `store`) usam `exclusive`.
+    As leituras podem ser tentadas sem esperar (`blocking`), por
+    quem não pode parar (o event loop do motor asyncio).
+    """
+    global_lock: RWLock
+    stripes: list[RWLock]
+
+    def __init__(self, stripes: int = 64) -> None:
+        assert stripes > 0
+        self.global_lock = RWLock()
+        self.stripes = [ RWLock() for _ in range(stripes) ]
+
+    def stripe_of(self, key: str) -> RWLock:
+        return self.stripes[hash(key) % len(self.stripes)]
+
+    def stripes_of(self, keys: Iterable[str]) -> list[RWLock]:
+        # Always taken in the same order, to avoid deadlocks
+        idxs: set[int] = set(hash(key) % len(self.stripes) for key in keys)
+        return [ self.stripes[i] for i in sorted(idxs) ]
+
+    def read(self, key: str, blocking: bool = True) -> ContextManager[None]:
+        return KeyGuard(self.global_lock, [self.stripe_of(key)], False, blocking)
+
+    def write(self, key: str) -> ContextManager[None]:
+        return KeyGuard(self.global_lock, [self.stripe_of(key)], True)
+
+    def read_many(
+            self,
+            keys: Iterable[str],
+            blocking: bool = True,
+            ) -> ContextManager[None]:
+        return KeyGuard(self.global_lock, self.stripes_of(keys), False, blocking)
+
+    def write_many(self, keys: Iterable[str]) -> ContextManager[None]:
+        return KeyGuard(self.global_lock, self.stripes_of(keys), True)
+
+    def exclusive(self) -> ContextManager[None]:
+        return self.global_lock.write()
@@ -1,8 +1,28 @@
+from __future__ import annotations
+
+from typing import Any, ItemsView, Iterable, Iterator, Mapping, MutableMapping, Optional, Tuple
+from typing import Union
 from dataclasses import dataclass, field
+from abc import abstractmethod
+from array import array
+
+import sys
+
+from indice import KeyIndex, Page
 
 @dataclass(eq=False, frozen=True, slots=True)
 class Dicionario:
-    dic: dict[str, list[str]] = field(default_factory=dict)
+    """
+    `index` tem as chaves de `dic` em ordem, para `scan` e `prefix`.
+    Com um `AppendDict` (`CompactDict`, `DiskDict`), os valores são
+    alterados e lidos nele, sem passar pela `list[str]` inteira.
+    """
+    dic: MutableMapping[str, list[str]] = field(default_factory=dict)
+    index: KeyIndex = field(init=False)
+
+    def __post_init__(self) -> None:
+        # Frozen, but derived from `dic`
+        object.__setattr__(self, 'index', KeyIndex(self.dic))
 
     def append(self, key: str, val: str) -> bool:
         """
@@ -12,10 +32,16 @@ class Dicionario:
         ela estará duplicada.
         **Altera estado interno.**
         """
-        in_dict: bool = key in self.dic
-        old_val: list[str] = self.dic.get(key, [])
-        old_val.append(val)
-        self.dic[key] = old_val
+        in_dict: bool
+        if isinstance(self.dic, AppendDict):
+            in_dict = self.dic.append(key, val)
+        else:
+            in_dict = key in self.dic
+            old_val: list[str] = self.dic.get(key, [])
+            old_val.append(val)
+            self.dic[key] = old_val
+        if not in_dict:
+            self.index.add(key)
         return in_dict
 
     def read(self, key: str) -> list[str]:
@@ -27,6 +53,43 @@ class Dicionario:
         assert key not in self.dic or len(val) > 0
         return val
 
+    def read_range(
+            self,
+            key: str,
+            offset: int = 0,
+            limit: int = 100,
+            from_end: bool = False,
+            ) -> Tuple[int, list[str]]:
+        """
+        Até `limit` valores de `key`, a partir de `offset`.
+        Com `from_end`, `offset` conta do fim da lista: `offset=0` são
+        os últimos `limit` valores (ainda na ordem da lista).
+        Retorna também a posição do primeiro valor retornado.
+        """
+        assert offset >= 0 and limit >= 0
+        length: int = self.length(key)
+        start: int
+        stop: int
+        if from_end:
+            stop = max(length - offset, 0)
+            start = max(stop - limit, 0)
+        else:
+            start = min(offset, length)
+            stop = min(start + limit, length)
+        if start == stop:
+            return (start, [])
+        if isinstance(self.dic, AppendDict):
+            return (start, self.dic.read_range(key, start, stop))
+        return (start, self.dic[key][start:stop])
+
+    def length(self, key: str) -> int:
+        """
+        Quantos valores `key` tem (0 se não está no dicionário).
+        """
+        if isinstance(self.dic, AppendDict):
+            return self.dic.length(key)
+        return len(self.dic.get(key, []))
+
     def remove(self, key: str) -> list[str]:
         """
         Remove os valores de `key`.
@@ -34,7 +97,264 @@ class Dicionario:
         **Altera estado interno.**
         """
         if key in self.dic:
-            return self.dic.pop(key)
+            vals: list[str] = self.dic.pop(key)
+            self.index.discard(key)
+            return vals
         else:
             return []
 
+    def scan(
+            self,
+            start: Optional[str] = None,
+            stop: Optional[str] = None,
+            cursor: Optional[str] = None,
+            limit: int = 100,
+            ) -> Page:
+        """
+        Até `limit` chaves, em ordem, de `start` (inclusive) até `stop`
+        (exclusive). Retorna também o cursor para pedir a próxima página
+        (`None` se acabou).
+        """
+        return self.index.scan(start, stop, cursor, limit)
+
+    def prefix(
+            self,
+            prefix: str,
+            cursor: Optional[str] = None,
+            limit: int = 100,
+            ) -> Page:
+        """
+        Como `scan`, com as chaves que começam com `prefix`.
+        """
+        return self.index.prefix(prefix, cursor, limit)
+
+class AppendDict(MutableMapping[str, list[str]]):
+    """
+    Dicionário com um formato próprio para os valores de cada chave,
+    que `Dicionario` altera e lê com estes métodos, em vez de ler e
+    reescrever a `list[str]` inteira.
+    """
+    @abstractmethod
+    def append(self, key: str, val: str) -> bool:
+        """
+        Retorna se `key` já existia.
+        """
+        ...
+
+    @abstractmethod
+    def read_range(self, key: str, start: int, stop: int) -> list[str]:
+        ...
+
+    @abstractmethod
+    def length(self, key: str) -> int:
+        ...
+
+class IterItems(ItemsView[str, list[str]]):
+    """
+    `items()` que usa o `iter_items` do mapeamento,
+    em vez de buscar cada chave de novo.
+    """
+    _mapping: Any
+
+    def __iter__(self) -> Iterator[Tuple[str, list[str]]]:
+        it: Iterator[Tuple[str, list[str]]] = self._mapping.iter_items()
+        return it
+
+class LazyDict(MutableMapping[str, list[str]]):
+    """
+    Dicionário sobre uma `base` somente leitura (o snapshot binário).
+    A lista de uma chave da base só é decodificada quando a chave
+    é usada, e daí em diante fica em `overlay`.
+    Chaves da base que foram removidas ficam em `removed`;
+    chaves que não estão na base ficam também em `added`.
+
+    Como um `dict`, pode ser usado por várias threads desde que
+    cada chave só seja alterada por uma de cada vez.
+    """
+    base: Mapping[str, list[str]]
+    overlay: dict[str, list[str]]
+    removed: set[str]
+    added: set[str]
+
+    def __init__(self, base: Mapping[str, list[str]]) -> None:
+        self.base = base
+        self.overlay = dict()
+        self.removed = set()
+        self.added = set()
+
+    def __getitem__(self, key: str) -> list[str]:
+        vals: Optional[list[str]] = self.overlay.get(key)
+        if vals is not None:
+            return vals
+        if key in self.removed:
+            raise KeyError(key)
+        vals = self.base[key]
+        self.overlay[key] = vals
+        return vals
+
+    def __setitem__(self, key: str, vals: list[str]) -> None:
+        if key not in self.overlay:
+            if key in self.removed:
+                self.removed.discard(key)
+            elif key not in self.base:
+                self.added.add(key)
+        self.overlay[key] = vals
+
+    def __delitem__(self, key: str) -> None:
+        if key in self.overlay:
+            del self.overlay[key]
+            if key in self.added:
+                self.added.discard(key)
+            else:
+                self.removed.add(key)
+        elif key not in self.removed and key in self.base:
+            self.removed.add(key)
+        else:
+            raise KeyError(key)
+
+    def __contains__(self, key: object) -> bool:
+        if key in self.overlay:
+            return True
+        return key not in self.removed and key in self.base
+
+    def __len__(self) -> int:
+        return len(self.base) - len(self.removed) + len(self.added)
+
+    def __iter__(self) -> Iterator[str]:
+        # Without the values of the base
+        yield from self.overlay
+        for key in self.base:
+            if key not in self.overlay and key not in self.removed:
+                yield key
+
+    def iter_items(self) -> Iterator[Tuple[str, list[str]]]:
+        """
+        Sem decodificar para `overlay`: usado para escrever o dicionário
+        inteiro, o que não deve dobrar a memória.
+        """
+        yield from self.overlay.items()
+        for key, vals in self.base.items():
+            if key not in self.overlay and key not in self.removed:
+                yield key, vals
+
+    def items(self) -> ItemsView[str, list[str]]:
+        return IterItems(self)
+
+@dataclass(eq=False, slots=True)
+class Values:
+    """
+    Os valores de uma chave num `CompactDict`: em UTF-8, um depois do
+    outro em `data`, e onde cada um termina em `ends`.
+    """
+    data: bytearray
+    ends: array[int]
+
+    def __len__(self) -> int:
+        return len(self.ends)
+
+    def append(self, val: bytes) -> None:
+        self.data += val
+        assert len(self.data) <= 0xFFFFFFFF, 'Values of a key over 4 GiB'
+        self.ends.append(len(self.data))
+
+    def decode(self, start: int, stop: int) -> list[str]:
+        view: memoryview = memoryview(self.data)
+        ends: array[int] = self.ends
+        begin: int = 0 if start == 0 else ends[start - 1]
+        vals: list[str] = []
+        for i in range(start, stop):
+            end: int = ends[i]
+            vals.append(str(view[begin:end], 'utf-8'))
+            begin = end
+        return vals
+
+# A single value is kept as its bytes, without `Values`
+Entry = Union[bytes, Values]
+
+class CompactDict(AppendDict):
+    """
+    Dicionário que guarda os valores de cada chave juntos, em `Values`,
+    sem um objeto `str` e uma posição de `list` por valor; uma chave
+    com um só valor guarda só os `bytes` dele. As chaves são internadas
+    (`sys.intern`), então as requisições, o índice e o log repetem a
+    mesma `str`.
+
+    Os valores só viram `list[str]` quando são lidos, e só os pedidos
+    (`read_range`): uma lista lida e alterada não muda o dicionário,
+    por isso `Dicionario` altera com `append`.
+
+    Como um `dict`, pode ser usado por várias threads desde que
+    cada chave só seja alterada por uma de cada vez.
+    """
+    entries: dict[str, Entry]
+
+    def __init__(self) -> None:
+        self.entries = dict()
+
+    @staticmethod
+    def from_items(items: Iterable[Tuple[str, list[str]]]) -> CompactDict:
+        dic: CompactDict = CompactDict()
+        for key, vals in items:
+            dic[key] = vals
+        return dic
+
+    @staticmethod
+    def encode(vals: list[str]) -> Entry:
+        if len(vals) == 1:
+            return vals[0].encode('utf-8')
+        entry: Values = Values(bytearray(), array('I'))
+        for val in vals:
+            entry.append(val.encode('utf-8'))
+        return entry
+
+    def append(self, key: str, val: str) -> bool:
+        """
+        Retorna se `key` já existia.
+        """
+        data: bytes = val.encode('utf-8')
+        entry: Optional[Entry] = self.entries.get(key)
+        if entry is None:
+            self.entries[sys.intern(key)] = data
+            return False
+        if isinstance(entry, bytes):
+            values: Values = Values(bytearray(entry), array('I', [len(entry)]))
+            values.append(data)
+            self.entries[key] = values
+        else:
+            entry.append(data)
+        return True
+
+    def read_range(self, key: str, start: int, stop: int) -> list[str]:
+        entry: Entry = self.entries[key]
+        if isinstance(entry, bytes):
+            return [entry.decode('utf-8')][start:stop]
+        return entry.decode(start, stop)
+
+    def length(self, key: str) -> int:
+        entry: Optional[Entry] = self.entries.get(key)
+        if entry is None:
+            return 0
+        if isinstance(entry, bytes):
+            return 1
+        return len(entry)
+
+    def __getitem__(self, key: str) -> list[str]:
+        entry: Entry = self.entries[key]
+        if isinstance(entry, bytes):
+            return [entry.decode('utf-8')]
+        return entry.decode(0, len(entry))
+
+    def __setitem__(self, key: str, vals: list[str]) -> None:
+        self.entries[sys.intern(key)] = CompactDict.encode(vals)
+
+    def __delitem__(self, key: str) -> None:
+        del self.entries[key]
+
+    def __contains__(self, key: object) -> bool:
+        return key in self.entries
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.entries)
@@ -0,0 +1,380 @@
+from __future__ import annotations
+
+from typing import ItemsView, Iterable, Iterator, MutableMapping, Optional, Tuple
+from collections import OrderedDict
+from dataclasses import dataclass
+from enum import Enum
+
+import threading
+import os
+
+from binario import Binario
+from dicionario import AppendDict, CompactDict, IterItems
+
+PAGE_SIZE = 4096
+
+class PageCache:
+    """
+    Páginas de `PAGE_SIZE` bytes lidas do arquivo, no máximo `capacity`;
+    quando enche, sai a usada há mais tempo (LRU).
+    """
+    capacity: int
+    pages: OrderedDict[int, bytes]
+    hits: int
+    misses: int
+
+    def __init__(self, capacity: int) -> None:
+        assert capacity > 0
+        self.capacity = capacity
+        self.pages = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, fd: int, page: int) -> bytes:
+        data: Optional[bytes] = self.pages.get(page)
+        if data is not None:
+            self.pages.move_to_end(page)
+            self.hits += 1
+            return data
+        self.misses += 1
+        data = os.pread(fd, PAGE_SIZE, page * PAGE_SIZE)
+        self.pages[page] = data
+        if len(self.pages) > self.capacity:
+            self.pages.popitem(last=False)
+        return data
+
+    def invalidate(self, start: int, end: int) -> None:
+        """
+        Esquece as páginas com bytes em `[start, end)`.
+        """
+        for page in range(start // PAGE_SIZE, (end - 1) // PAGE_SIZE + 1):
+            self.pages.pop(page, None)
+
+    def clear(self) -> None:
+        self.pages.clear()
+
+# Where a piece of a key's values is: (offset, bytes, values)
+Extent = Tuple[int, int, int]
+
+@dataclass(eq=False, slots=True)
+class Chain:
+    """
+    Os valores de uma chave no `DiskDict`, em `extents` espalhados
+    pelo arquivo, na ordem da lista. O último ainda tem `free` bytes
+    reservados logo depois dos usados; `allocated` conta os usados e
+    os reservados de todos.
+    """
+    extents: list[Extent]
+    free: int
+    count: int
+    allocated: int
+
+class DiskDict(AppendDict):
+    """
+    Dicionário com os valores no disco, para quando eles não cabem
+    na memória. Só as chaves ficam na memória, em `index`, cada uma
+    com a sua `Chain`.
+
+    O arquivo `path` é de trabalho (recomeça vazio ao abrir). Cada
+    valor é gravado como em `Binario.write_str`, nos extents da chave:
+    `append` grava só o valor novo, no espaço livre do último extent
+    ou num extent novo, reservado no fim do arquivo com pelo menos o
+    tamanho de todos os anteriores (então uma chave tem O(log n)
+    extents). Os bytes já gravados nunca mudam: `__setitem__` e
+    `__delitem__` deixam os extents antigos como lixo. Quando o lixo
+    passa dos dados vivos, os valores vivos são copiados para um
+    arquivo novo, um extent por chave (`compact`).
+    As leituras passam pelo `PageCache`.
+
+    Cada operação é atômica (`lock`), como num `dict`.
+    """
+    COMPACT_MIN_BYTES = 1024 * 1024
+    # Smallest extent reserved by `append`
+    MIN_EXTENT = 64
+
+    path: str
+    fd: int
+    end: int
+    index: dict[str, Chain]
+    live_bytes: int
+    cache: PageCache
+    lock: threading.Lock
+
+    def __init__(self, path: str, cache_pages: int = 4096) -> None:
+        self.path = path
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o644)
+        self.end = 0
+        self.index = dict()
+        self.live_bytes = 0
+        self.cache = PageCache(cache_pages)
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def from_items(
+            path: str,
+            items: Iterable[Tuple[str, list[str]]],
+            cache_pages: int = 4096,
+            ) -> DiskDict:
+        dic: DiskDict = DiskDict(path, cache_pages)
+        buf: bytearray = bytearray()
+        for key, vals in items:
+            start: int = len(buf)
+            DiskDict.encode(buf, vals)
+            size: int = len(buf) - start
+            dic.index[key] = Chain(
+                [(dic.end + start, size, len(vals))], 0, len(vals), size,
+            )
+            dic.live_bytes += size
+            if len(buf) >= 1024 * 1024:
+                os.pwrite(dic.fd, buf, dic.end)
+                dic.end += len(buf)
+                buf = bytearray()
+        os.pwrite(dic.fd, buf, dic.end)
+        dic.end += len(buf)
+        return dic
+
+    @staticmethod
+    def encode(buf: bytearray, vals: list[str]) -> None:
+        for val in vals:
+            Binario.write_str(buf, val)
+
+    @staticmethod
+    def decode(data: bytes, start: int, size: int) -> list[str]:
+        vals: list[str] = []
+        off: int = start
+        while off < start + size:
+            val, off = Binario.read_str(data, off)
+            vals.append(val.decode('utf-8'))
+        return vals
+
+    def write(self, off: int, data: bytes | bytearray) -> None:
+        """
+        Precisa de `lock`.
+        """
+        os.pwrite(self.fd, data, off)
+        self.cache.invalidate(off, off + len(data))
+
+    def reserve(self, size: int) -> int:
+        """
+        Offset de `size` bytes novos no fim do arquivo.
+        Precisa de `lock`.
+        """
+        off: int = self.end
+        self.end += size
+        self.live_bytes += size
+        return off
+
+    def read_extent(self, extent: Extent) -> list[str]:
+        """
+        Precisa de `lock`.
+        """
+        off, size, _ = extent
+        if size == 0:
+            return []
+        first: int = off // PAGE_SIZE
+        last: int = (off + size - 1) // PAGE_SIZE
+        data: bytes = b''.join(
+            self.cache.get(self.fd, page) for page in range(first, last + 1)
+        )
+        return DiskDict.decode(data, off - first * PAGE_SIZE, size)
+
+    def read_extents(self, extents: list[Extent]) -> list[str]:
+        """
+        Precisa de `lock`.
+        """
+        vals: list[str] = []
+        for extent in extents:
+            vals += self.read_extent(extent)
+        return vals
+
+    def __getitem__(self, key: str) -> list[str]:
+        with self.lock:
+            return self.read_extents(self.index[key].extents)
+
+    def __setitem__(self, key: str, vals: list[str]) -> None:
+        buf: bytearray = bytearray()
+        DiskDict.encode(buf, vals)
+        with self.lock:
+            old: Optional[Chain] = self.index.get(key)
+            if old is not None:
+                self.live_bytes -= old.allocated
+            off: int = self.reserve(len(buf))
+            self.write(off, buf)
+            self.index[key] = Chain(
+                [(off, len(buf), len(vals))], 0, len(vals), len(buf),
+            )
+            self.maybe_compact()
+
+    def append(self, key: str, val: str) -> bool:
+        buf: bytearray = bytearray()
+        Binario.write_str(buf, val)
+        with self.lock:
+            chain: Optional[Chain] = self.index.get(key)
+            if chain is None:
+                size: int = max(len(buf), DiskDict.MIN_EXTENT)
+                off: int = self.reserve(size)
+                self.write(off, buf)
+                self.index[key] = Chain(
+                    [(off, len(buf), 1)], size - len(buf), 1, size,
+                )
+                return False
+            if len(buf) <= chain.free:
+                off, used, count = chain.extents[-1]
+                self.write(off + used, buf)
+                chain.extents[-1] = (off, used + len(buf), count + 1)
+                chain.free -= len(buf)
+            else:
+                # Doubles what the key has, so appends stay O(1) amortized
+                size = max(len(buf), chain.allocated, DiskDict.MIN_EXTENT)
+                off = self.reserve(size)
+                self.write(off, buf)
+                chain.extents.append((off, len(buf), 1))
+                chain.free = size - len(buf)
+                chain.allocated += size
+            chain.count += 1
+            return True
+
+    def read_range(self, key: str, start: int, stop: int) -> list[str]:
+        """
+        Só lê os extents com valores em `[start, stop)`.
+        """
+        with self.lock:
+            vals: list[str] = []
+            first: int = 0
+            for extent in self.index[key].extents:
+                last: int = first + extent[2]
+                if first < stop and start < last:
+                    vals += self.read_extent(extent)[
+                        max(start - first, 0) : stop - first
+                    ]
+                first = last
+            return vals
+
+    def length(self, key: str) -> int:
+        with self.lock:
+            chain: Optional[Chain] = self.index.get(key)
+            return 0 if chain is None else chain.count
+
+    def __delitem__(self, key: str) -> None:
+        with self.lock:
+            chain: Chain = self.index.pop(key)
+            self.live_bytes -= chain.allocated
+            self.maybe_compact()
+
+    def __contains__(self, key: object) -> bool:
+        return key in self.index
+
+    def __len__(self) -> int:
+        return len(self.index)
+
+    def __iter__(self) -> Iterator[str]:
+        with self.lock:
+            keys: list[str] = list(self.index)
+        return iter(keys)
+
+    def by_position(self) -> list[Tuple[str, list[Extent]]]:
+        """
+        As chaves e os seus extents, em ordem de posição no arquivo.
+        """
+        return sorted(
+            (
+                (key, list(chain.extents))
+                for key, chain in self.index.items()
+            ),
+            key = lambda entry: entry[1][0][0],
+        )
+
+    def iter_items(self) -> Iterator[Tuple[str, list[str]]]:
+        """
+        Em ordem de posição no arquivo e sem passar pelo `cache`,
+        para não expulsar as páginas mais usadas.
+        Ninguém pode alterar o dicionário durante a iteração.
+        """
+        for key, extents in self.by_position():
+            vals: list[str] = []
+            for off, size, _ in extents:
+                vals += DiskDict.decode(os.pread(self.fd, size, off), 0, size)
+            yield key, vals
+
+    def items(self) -> ItemsView[str, list[str]]:
+        return IterItems(self)
+
+    def maybe_compact(self) -> None:
+        garbage: int = self.end - self.live_bytes
+        if garbage > max(self.live_bytes, DiskDict.COMPACT_MIN_BYTES):
+            self.compact()
+
+    def compact(self) -> None:
+        """
+        Copia os valores vivos para um arquivo novo e troca de arquivo.
+        Os extents de cada chave viram um só, sem espaço reservado.
+        O arquivo antigo continua válido para quem ainda o tem aberto
+        (um snapshot em outro processo, por exemplo).
+        Precisa de `lock`.
+        """
+        tmp: str = self.path + '.compact'
+        fd: int = os.open(tmp, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o644)
+        index: dict[str, Chain] = dict()
+        end: int = 0
+        buf: bytearray = bytearray()
+        for key, extents in self.by_position():
+            start: int = len(buf)
+            for off, size, _ in extents:
+                buf += os.pread(self.fd, size, off)
+            count: int = self.index[key].count
+            index[key] = Chain(
+                [(end + start, len(buf) - start, count)],
+                0, count, len(buf) - start,
+            )
+            if len(buf) >= 1024 * 1024:
+                os.pwrite(fd, buf, end)
+                end += len(buf)
+                buf = bytearray()
+        os.pwrite(fd, buf, end)
+        end += len(buf)
+        os.replace(tmp, self.path)
+        os.close(self.fd)
+        self.fd = fd
+        self.end = end
+        self.index = index
+        self.live_bytes = end
+        self.cache.clear()
+
+    def close(self) -> None:
+        with self.lock:
+            os.close(self.fd)
+            os.remove(self.path)
+
+class Backend(Enum):
+    """
+    Onde ficam os valores do dicionário:
+      * `MEMORY`: num `dict` (ou `LazyDict`, com snapshot binário)
+      * `COMPACT`: na memória, num `CompactDict`
+      * `DISK`: num `DiskDict`
+    """
+    MEMORY  = 'memory'
+    COMPACT = 'compact'
+    DISK    = 'disk'
+
+    def open(
+            self,
+            filename: str,
+            loaded: MutableMapping[str, list[str]],
+            cache_pages: int = 4096,
+            ) -> MutableMapping[str, list[str]]:
+        """
+        O dicionário de trabalho, com o conteúdo de `loaded`.
+        O arquivo de trabalho do `DISK` fica ao lado de `filename`.
+        """
+        if self == Backend.DISK:
+            return DiskDict.from_items(
+                filename + '.pages', loaded.items(), cache_pages,
+            )
+        elif self == Backend.COMPACT:
+            return CompactDict.from_items(loaded.items())
+        return loaded
+
+    @staticmethod
+    def close(dic: MutableMapping[str, list[str]]) -> None:
+        if isinstance(dic, DiskDict):
+            dic.close()
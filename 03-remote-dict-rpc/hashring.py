@@ -0,0 +1,68 @@
+from typing import Iterable, Sequence, Tuple
+
+import hashlib
+import bisect
+
+class HashRing:
+    """
+    Anel de hashing consistente.
+    Cada nó ocupa `vnodes` pontos do anel (nós virtuais), e uma chave
+    pertence ao nó do primeiro ponto a partir do hash dela.
+    Com os nós virtuais, as chaves se espalham por igual, e incluir ou
+    tirar um nó só move ~1/N das chaves.
+
+    O hash não é o `hash` do Python, que muda a cada processo:
+    todos os clientes precisam concordar sobre o dono de cada chave.
+    """
+    vnodes: int
+    nodes: list[str]
+    # Sorted points of the ring and the node of each one
+    points: list[int]
+    owners: list[str]
+
+    def __init__(self, nodes: Iterable[str], vnodes: int = 128) -> None:
+        assert vnodes > 0
+        self.vnodes = vnodes
+        self.nodes = []
+        self.points = []
+        self.owners = []
+        for node in nodes:
+            self.add(node)
+
+    @staticmethod
+    def hash(s: str) -> int:
+        digest: bytes = hashlib.blake2b(s.encode('utf-8'), digest_size=8).digest()
+        return int.from_bytes(digest, 'big')
+
+    def add(self, node: str) -> None:
+        assert node not in self.nodes, f"Node already in the ring: '{node}'"
+        self.nodes.append(node)
+        for i in range(self.vnodes):
+            point: int = HashRing.hash(f'{node}#{i}')
+            idx: int = bisect.bisect_left(self.points, point)
+            self.points.insert(idx, point)
+            self.owners.insert(idx, node)
+
+    def remove(self, node: str) -> None:
+        self.nodes.remove(node)
+        kept: list[Tuple[int, str]] = [
+            (point, owner)
+            for point, owner in zip(self.points, self.owners)
+            if owner != node
+        ]
+        self.points = [ point for point, _ in kept ]
+        self.owners = [ owner for _, owner in kept ]
+
+    def node_of(self, key: str) -> str:
+        assert len(self.points) > 0, 'Empty ring'
+        idx: int = bisect.bisect_right(self.points, HashRing.hash(key))
+        return self.owners[idx % len(self.owners)]
+
+    def split(self, keys: Sequence[str]) -> dict[str, list[int]]:
+        """
+        Os índices de `keys` que pertencem a cada nó, em ordem.
+        """
+        parts: dict[str, list[int]] = dict()
+        for i, key in enumerate(keys):
+            parts.setdefault(self.node_of(key), []).append(i)
+        return parts
@@ -0,0 +1,290 @@
+from __future__ import annotations
+
+from typing import Any, Iterator, Optional, Tuple
+from contextlib import contextmanager
+from dataclasses import dataclass
+
+import rpyc # type: ignore
+
+import threading
+import time
+
+from indice import Page
+
+HOST = 'localhost'
+PORT = 5000
+
+# What a broken connection raises; anything else came from the service
+BROKEN = (EOFError, OSError)
+
+@dataclass(eq=False, slots=True)
+class Idle:
+    conn: rpyc.Connection
+    since: float
+
+class ConnPool:
+    """
+    Conexões reutilizáveis com um `HDDService`, para várias threads.
+
+    Abre `min_size` conexões logo de início e no máximo `max_size`;
+    com todas emprestadas, `acquire` espera uma ser devolvida.
+    Uma conexão parada há mais de `check_after` segundos passa por um
+    `ping` antes de ser emprestada, e é trocada se não responder.
+    Cada conexão nova é tentada até `retries` vezes, com espera
+    crescente entre as tentativas (até `max_backoff` segundos).
+    """
+    host: str
+    port: int
+    min_size: int
+    max_size: int
+    check_after: float
+    retries: int
+    max_backoff: float
+    # Most recently returned last
+    idle: list[Idle]
+    # Open connections, idle or borrowed
+    size: int
+    cond: threading.Condition
+    closed: bool
+
+    def __init__(
+            self,
+            host: str = HOST,
+            port: int = PORT,
+            min_size: int = 1,
+            max_size: int = 8,
+            check_after: float = 30.0,
+            retries: int = 5,
+            max_backoff: float = 2.0,
+            ) -> None:
+        assert 0 <= min_size <= max_size and max_size > 0
+        self.host = host
+        self.port = port
+        self.min_size = min_size
+        self.max_size = max_size
+        self.check_after = check_after
+        self.retries = retries
+        self.max_backoff = max_backoff
+        self.idle = []
+        self.size = 0
+        self.cond = threading.Condition(threading.Lock())
+        self.closed = False
+        for _ in range(min_size):
+            self.idle.append(Idle(self.connect(), time.monotonic()))
+            self.size += 1
+
+    def __enter__(self) -> ConnPool:
+        return self
+
+    def __exit__(self, *args: Any) -> None:
+        self.close()
+
+    def connect(self) -> rpyc.Connection:
+        delay: float = 0.05
+        for attempt in range(self.retries + 1):
+            try:
+                return rpyc.connect(self.host, self.port)
+            except OSError:
+                if attempt == self.retries:
+                    raise
+            time.sleep(delay)
+            delay = min(delay * 2, self.max_backoff)
+        assert False, 'unreachable'
+
+    def healthy(self, idle: Idle) -> bool:
+        if idle.conn.closed:
+            return False
+        if time.monotonic() - idle.since < self.check_after:
+            return True
+        try:
+            idle.conn.ping(timeout=1.0)
+            return True
+        except Exception:
+            return False
+
+    def acquire(self, timeout: Optional[float] = None) -> rpyc.Connection:
+        """
+        Sem `timeout`, espera o quanto for preciso por uma conexão;
+        com `timeout`, desiste com `TimeoutError`.
+        """
+        deadline: Optional[float] = \
+            None if timeout is None else time.monotonic() + timeout
+        idle: Optional[Idle] = None
+        with self.cond:
+            while True:
+                assert not self.closed, 'Pool closed'
+                if len(self.idle) > 0:
+                    idle = self.idle.pop()
+                    break
+                if self.size < self.max_size:
+                    # Reserved now, connected outside of the lock
+                    self.size += 1
+                    break
+                remaining: Optional[float] = \
+                    None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    raise TimeoutError('No connection available in the pool')
+                self.cond.wait(remaining)
+        if idle is not None:
+            if self.healthy(idle):
+                return idle.conn
+            idle.conn.close()
+        try:
+            return self.connect()
+        except BaseException:
+            with self.cond:
+                self.size -= 1
+                self.cond.notify()
+            raise
+
+    def release(self, conn: rpyc.Connection, broken: bool = False) -> None:
+        with self.cond:
+            keep: bool = not (broken or self.closed or conn.closed)
+            if keep:
+                self.idle.append(Idle(conn, time.monotonic()))
+            else:
+                self.size -= 1
+            self.cond.notify()
+        if not keep:
+            conn.close()
+
+    @contextmanager
+    def borrow(self, timeout: Optional[float] = None) -> Iterator[rpyc.Connection]:
+        """
+        A conexão volta para o pool no fim do `with`; se ela quebrou
+        no meio, é descartada.
+        """
+        conn: rpyc.Connection = self.acquire(timeout)
+        broken: bool = False
+        try:
+            yield conn
+        except BROKEN:
+            broken = True
+            raise
+        finally:
+            self.release(conn, broken)
+
+    def close(self) -> None:
+        """
+        Fecha as conexões paradas; as emprestadas são fechadas quando
+        forem devolvidas.
+        """
+        with self.cond:
+            self.closed = True
+            idle: list[Idle] = self.idle
+            self.idle = []
+            self.size -= len(idle)
+            self.cond.notify_all()
+        for i in idle:
+            i.conn.close()
+
+class HDDClient:
+    """
+    Interface tipada do `HDDService`, sobre um `ConnPool`:
+    pode ser usada por várias threads ao mesmo tempo.
+
+    Leituras que pegam uma conexão quebrada são repetidas uma vez,
+    com outra conexão. Escritas não: não dá para saber se o servidor
+    chegou a aplicar.
+    """
+    pool: ConnPool
+
+    def __init__(self, pool: ConnPool) -> None:
+        self.pool = pool
+
+    @staticmethod
+    def connect(host: str = HOST, port: int = PORT, **pool_args: Any) -> HDDClient:
+        return HDDClient(ConnPool(host, port, **pool_args))
+
+    def __enter__(self) -> HDDClient:
+        return self
+
+    def __exit__(self, *args: Any) -> None:
+        self.close()
+
+    def close(self) -> None:
+        self.pool.close()
+
+    def append(self, key: str, val: str) -> bool:
+        with self.pool.borrow() as conn:
+            return bool(conn.root.append(key, val))
+
+    def read(self, key: str) -> list[str]:
+        try:
+            with self.pool.borrow() as conn:
+                return list(conn.root.read(key))
+        except BROKEN:
+            with self.pool.borrow() as conn:
+                return list(conn.root.read(key))
+
+    def read_range(
+            self,
+            key: str,
+            offset: int = 0,
+            limit: int = 100,
+            from_end: bool = False,
+            ) -> Tuple[int, int, list[str]]:
+        """
+        A posição do primeiro valor, quantos `key` tem, e os valores.
+        """
+        try:
+            with self.pool.borrow() as conn:
+                start, length, vals = \
+                    conn.root.read_range(key, offset, limit, from_end)
+        except BROKEN:
+            with self.pool.borrow() as conn:
+                start, length, vals = \
+                    conn.root.read_range(key, offset, limit, from_end)
+        return (start, length, list(vals))
+
+    def length(self, key: str) -> int:
+        try:
+            with self.pool.borrow() as conn:
+                return int(conn.root.length(key))
+        except BROKEN:
+            with self.pool.borrow() as conn:
+                return int(conn.root.length(key))
+
+    def remove(self, key: str) -> list[str]:
+        with self.pool.borrow() as conn:
+            return list(conn.root.remove(key))
+
+    def scan(
+            self,
+            start: Optional[str] = None,
+            stop: Optional[str] = None,
+            cursor: Optional[str] = None,
+            limit: int = 100,
+            ) -> Page:
+        try:
+            with self.pool.borrow() as conn:
+                keys, next_cursor = conn.root.scan(start, stop, cursor, limit)
+        except BROKEN:
+            with self.pool.borrow() as conn:
+                keys, next_cursor = conn.root.scan(start, stop, cursor, limit)
+        return (list(keys), next_cursor)
+
+    def prefix(
+            self,
+            prefix: str,
+            cursor: Optional[str] = None,
+            limit: int = 100,
+            ) -> Page:
+        try:
+            with self.pool.borrow() as conn:
+                keys, next_cursor = conn.root.prefix(prefix, cursor, limit)
+        except BROKEN:
+            with self.pool.borrow() as conn:
+                keys, next_cursor = conn.root.prefix(prefix, cursor, limit)
+        return (list(keys), next_cursor)
+
+    def load(self) -> None:
+        with self.pool.borrow() as conn:
+            conn.root.load()
+
+    def store(self) -> str:
+        """
+        Começa um snapshot no servidor e retorna como ele está.
+        """
+        with self.pool.borrow() as conn:
+            return str(conn.root.store())
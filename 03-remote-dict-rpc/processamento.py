@@ -1,40 +1,151 @@
 from __future__ import annotations
 
+from typing import Callable, Optional, Tuple
 from dataclasses import dataclass, fields
 
-from persistencia import Persistencia
+from persistencia import Durability, Log, Persistencia, Snapshot, SnapshotFormat
 from dicionario import Dicionario
+from disco import Backend
+from indice import Page
 
 @dataclass(eq=False, kw_only=True, slots=True)
 class Process:
     dic: Dicionario
     filename: str
+    log: Log
+    format: SnapshotFormat = SnapshotFormat.JSON
+    backend: Backend = Backend.MEMORY
+    cache_pages: int = 4096
+    snapshot: Optional[Snapshot] = None
 
     @staticmethod
-    def from_file(filename: str) -> Process:
-        dic = Dicionario(Persistencia.load(filename))
+    def from_file(
+            filename: str,
+            durability: Durability = Durability.NONE,
+            batch_window: float = 0.002,
+            format: Optional[SnapshotFormat] = None,
+            backend: Backend = Backend.MEMORY,
+            cache_pages: int = 4096,
+            ) -> Process:
+        """
+        Sem `format`, os snapshots seguem o formato do arquivo existente
+        (sem arquivo, JSON; binário com `Backend.DISK`).
+        `Backend.DISK` não aceita um snapshot em JSON, que seria lido
+        inteiro na memória: tem que ser convertido antes (`binario.py`).
+        """
+        if backend == Backend.DISK:
+            assert SnapshotFormat.of_file(filename) != SnapshotFormat.JSON, \
+                f"JSON snapshot with the disk backend: '{filename}'"
+        if format is None:
+            format = SnapshotFormat.of_file(filename) or (
+                SnapshotFormat.BINARY if backend == Backend.DISK
+                else SnapshotFormat.JSON
+            )
+        dic = Dicionario(backend.open(
+            filename, Persistencia.load_logged(filename), cache_pages,
+        ))
         return Process(
             dic = dic,
-            filename = filename
+            filename = filename,
+            log = Log(filename, durability, batch_window),
+            format = format,
+            backend = backend,
+            cache_pages = cache_pages,
         )
 
     def load(self) -> None:
-        self.dic = Dicionario(
-            Persistencia.load(self.filename)
-        )
+        # A running snapshot still needs the files it started with
+        self.wait_snapshot()
+        Backend.close(self.dic.dic)
+        # Batched records already acknowledged must be in the file
+        with self.log.io_lock:
+            self.log.flush_pending()
+        self.dic = Dicionario(self.backend.open(
+            self.filename, Persistencia.load_logged(self.filename),
+            self.cache_pages,
+        ))
 
     def store(self) -> None:
-        Persistencia.store(self.filename, self.dic.dic)
+        self.wait_snapshot()
+        Persistencia.checkpoint(
+            self.filename, self.dic.dic, self.log, self.format,
+        )
+
+    def store_background(
+            self,
+            report: Optional[Callable[[Snapshot], None]] = None,
+            ) -> Optional[Snapshot]:
+        """
+        Como `store`, mas escreve em segundo plano (ver `Snapshot`):
+        só precisa do dicionário parado durante a chamada.
+        Retorna `None` se já tem um snapshot em andamento.
+        """
+        if self.snapshot is not None and self.snapshot.running():
+            return None
+        self.snapshot = Snapshot.start(
+            self.filename, self.dic.dic, self.log, report,
+            format = self.format,
+        )
+        return self.snapshot
+
+    def wait_snapshot(self) -> None:
+        if self.snapshot is not None:
+            self.snapshot.wait()
 
     def append(self, key: str, val: str) -> bool:
         ret: bool = self.dic.append(key, val)
-        self.store()
+        self.log.append(key, val)
         return ret
 
     def read(self, key: str) -> list[str]:
         return self.dic.read(key)
 
+    def read_range(
+            self,
+            key: str,
+            offset: int = 0,
+            limit: int = 100,
+            from_end: bool = False,
+            ) -> Tuple[int, list[str]]:
+        return self.dic.read_range(key, offset, limit, from_end)
+
+    def length(self, key: str) -> int:
+        return self.dic.length(key)
+
+    def scan(
+            self,
+            start: Optional[str] = None,
+            stop: Optional[str] = None,
+            cursor: Optional[str] = None,
+            limit: int = 100,
+            ) -> Page:
+        return self.dic.scan(start, stop, cursor, limit)
+
+    def prefix(
+            self,
+            prefix: str,
+            cursor: Optional[str] = None,
+            limit: int = 100,
+            ) -> Page:
+        return self.dic.prefix(prefix, cursor, limit)
+
     def remove(self, key: str) -> list[str]:
         ret: list[str] = self.dic.remove(key)
-        self.store()
+        if len(ret) > 0:
+            self.log.remove(key)
         return ret
+
+    def durable_point(self) -> int:
+        """
+        Depois de `wait_durable(durable_point())`, todas as mutações
+        feitas até aqui estão no disco (conforme a `Durability`).
+        """
+        return self.log.point()
+
+    def wait_durable(self, point: int) -> None:
+        self.log.wait_durable(point)
+
+    def close(self) -> None:
+        self.wait_snapshot()
+        Backend.close(self.dic.dic)
+        self.log.close()
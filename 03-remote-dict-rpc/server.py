@@ -1,18 +1,21 @@
-from typing import Any
+from typing import Any, Optional, Tuple
 from dataclasses import dataclass, field
 
 import rpyc # type: ignore
 
-import threading
+import argparse
 import sys
 
+from concorrencia import KeyLocks
+from disco import Backend
+from persistencia import Durability, Snapshot, SnapshotFormat
 from processamento import Process
 
 PORT = 5000
 
 @dataclass(eq=False, frozen=True, slots=True)
 class HDDService(rpyc.Service): # type: ignore
-    lock: threading.Lock = field(init=False, default_factory=threading.Lock)
+    locks: KeyLocks = field(init=False, default_factory=KeyLocks)
     process: Process
 
     def on_connect(self, conn: rpyc.Connection) -> None:
@@ -22,35 +25,151 @@ class HDDService(rpyc.Service): # type: ignore
         print('Someone disconnected')
 
     def exposed_load(self) -> None:
-        with self.lock:
+        with self.locks.exclusive():
             return self.process.load()
 
-    def exposed_store(self) -> None:
-        with self.lock:
-            return self.process.store()
+    def exposed_store(self) -> str:
+        """
+        Começa um snapshot em segundo plano e retorna como ele está.
+        """
+        with self.locks.exclusive():
+            snapshot: Optional[Snapshot] = self.process.store_background()
+        if snapshot is None:
+            assert self.process.snapshot is not None
+            return f"already {self.process.snapshot.status()}"
+        return snapshot.status()
+
+    # Mutations wait to be durable after releasing the locks,
+    # so other keys aren't held back by the fsync
 
     def exposed_append(self, key: str, val: str) -> bool:
-        with self.lock:
-            return self.process.append(key, val)
+        with self.locks.write(key):
+            ret: bool = self.process.append(key, val)
+            point: int = self.process.durable_point()
+        self.process.wait_durable(point)
+        return ret
+
+    # Values go as tuples too, copied to the client in one go
+
+    def exposed_read(self, key: str) -> Tuple[str, ...]:
+        with self.locks.read(key):
+            return tuple(self.process.read(key))
+
+    def exposed_read_range(
+            self,
+            key: str,
+            offset: int = 0,
+            limit: int = 100,
+            from_end: bool = False,
+            ) -> Tuple[int, int, Tuple[str, ...]]:
+        """
+        Até `limit` valores de `key`, a partir de `offset` (do fim, com
+        `from_end`): a posição do primeiro, quantos a chave tem no
+        total, e os valores, numa tupla, copiada para o cliente de uma
+        vez.
+        """
+        with self.locks.read(key):
+            length: int = self.process.length(key)
+            start, vals = self.process.read_range(key, offset, limit, from_end)
+        return (start, length, tuple(vals))
 
-    def exposed_read(self, key: str) -> list[str]:
-        with self.lock:
-            return self.process.read(key)
+    def exposed_length(self, key: str) -> int:
+        with self.locks.read(key):
+            return self.process.length(key)
 
-    def exposed_remove(self, key: str) -> list[str]:
-        with self.lock:
-            return self.process.remove(key)
+    def exposed_remove(self, key: str) -> Tuple[str, ...]:
+        with self.locks.write(key):
+            ret: list[str] = self.process.remove(key)
+            point: int = self.process.durable_point()
+        self.process.wait_durable(point)
+        return tuple(ret)
 
-def main(dict_file: str) -> int:
+    # Pages go as tuples, copied to the client in one go,
+    # and without key locks: the index has its own
+
+    def exposed_scan(
+            self,
+            start: Optional[str] = None,
+            stop: Optional[str] = None,
+            cursor: Optional[str] = None,
+            limit: int = 100,
+            ) -> Tuple[Tuple[str, ...], Optional[str]]:
+        """
+        Até `limit` chaves, em ordem, de `start` (inclusive) até `stop`
+        (exclusive), e o cursor para pedir a próxima página
+        (`None` se acabou).
+        """
+        keys, next_cursor = self.process.scan(start, stop, cursor, limit)
+        return (tuple(keys), next_cursor)
+
+    def exposed_prefix(
+            self,
+            prefix: str,
+            cursor: Optional[str] = None,
+            limit: int = 100,
+            ) -> Tuple[Tuple[str, ...], Optional[str]]:
+        keys, next_cursor = self.process.prefix(prefix, cursor, limit)
+        return (tuple(keys), next_cursor)
+
+def main(
+        dict_file: str,
+        durability: Durability = Durability.NONE,
+        batch_window: float = 0.002,
+        format: Optional[SnapshotFormat] = None,
+        backend: Backend = Backend.MEMORY,
+        cache_pages: int = 4096,
+        port: int = PORT,
+        ) -> int:
     from rpyc.utils.server import ThreadedServer # type: ignore
-    srv = ThreadedServer(
-        HDDService(Process.from_file(dict_file)),
-        port = PORT
+    process: Process = Process.from_file(
+        dict_file, durability, batch_window, format, backend, cache_pages,
     )
-    srv.start()
+    srv = ThreadedServer(HDDService(process), port = port)
+    try:
+        srv.start()
+    finally:
+        process.close()
     return 0
 
 if __name__ == "__main__":
-    dict_file: str = 'start_dict.json'
-    retcode: int = main(dict_file)
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--port', type=int, default=PORT)
+    parser.add_argument('--dict-file', default='start_dict.json')
+    parser.add_argument('--durability',
+        choices=[ d.value for d in Durability ],
+        default=Durability.NONE.value,
+        help='when a mutation is acknowledged: after the write, '
+            'after a group fsync, or after its own fsync')
+    parser.add_argument('--batch-window', type=float, default=0.002,
+        help='batched durability: seconds to gather a group commit')
+    parser.add_argument('--snapshot-format',
+        choices=[ f.value for f in SnapshotFormat ], default=None,
+        help='format written by store '
+            '(default: the format of the existing file, or json; '
+            'binary with the disk backend)')
+    parser.add_argument('--backend',
+        choices=[ b.value for b in Backend ], default=Backend.MEMORY.value,
+        help='keep the values in memory (as str lists, or packed '
+            'per key with compact), or in a work file on disk')
+    parser.add_argument('--cache-pages', type=int, default=4096,
+        help='disk backend: pages of the work file kept in memory')
+    args = parser.parse_args()
+    if Backend(args.backend) == Backend.DISK:
+        if args.snapshot_format == SnapshotFormat.JSON.value:
+            parser.error('the disk backend keeps binary snapshots only')
+        if SnapshotFormat.of_file(args.dict_file) == SnapshotFormat.JSON:
+            parser.error(f"'{args.dict_file}' is a JSON snapshot, read "
+                'whole into memory; for the disk backend, convert it '
+                f"first: python binario.py to-binary {args.dict_file} "
+                '<binary file>')
+    retcode: int = main(
+        args.dict_file,
+        Durability(args.durability),
+        args.batch_window,
+        None if args.snapshot_format is None
+            else SnapshotFormat(args.snapshot_format),
+        Backend(args.backend),
+        args.cache_pages,
+        args.port,
+    )
     sys.exit(retcode)